@@ -26,6 +26,42 @@ if __name__ == "__main__":
         help="sub-command help",
         dest="subcommand")
 
+    # CDD search
+    cdd_search = subparsers.add_parser(
+        "cdd-search",
+        help="Searches the target sequences against CDD with rpsblast. The"
+             " queries are split into shards with about the same number of"
+             " residues, which are searched concurrently, and the results"
+             " are merged in query order.",
+    )
+    cdd_search.set_defaults(func=commands.cdd_search)
+    cdd_search.add_argument("-i", "--in-file", required=True,
+                            help="Path to the target sequences (FASTA"
+                                 " format)")
+    cdd_search.add_argument("-o", "--out-file", required=True,
+                            help="Path to the output file (rpsblast"
+                                 " -outfmt 7)")
+    cdd_search.add_argument("-b", "--bin", default=None,
+                            help="rpsblast command (default: CDD_BIN from"
+                                 " the configuration file)")
+    cdd_search.add_argument("-d", "--db", default=None,
+                            help="CDD database name (default: CDD_DB from"
+                                 " the configuration file, or mycdd)")
+    cdd_search.add_argument("-c", "--cpu-count", type=int, default=-1,
+                            help="Number of concurrent searches (default:"
+                                 " number of cores)")
+    cdd_search.add_argument("-s", "--shards", type=int, default=-1,
+                            help="Number of shards (default: one per"
+                                 " concurrent search)")
+    cdd_search.add_argument("-r", "--retries", type=int, default=2,
+                            help="Number of times a failed shard is"
+                                 " retried")
+    cdd_search.add_argument("-w", "--work-dir", default=None,
+                            help="Directory for the shards, it must be"
+                                 " visible to the rpsblast command"
+                                 " (default: a temporary directory next to"
+                                 " the output file)")
+
     # Extract Domains
     extract_domains = subparsers.add_parser(
         "extract-domains",
@@ -48,6 +84,28 @@ if __name__ == "__main__":
                                  help="Path to the output file (FASTA format)",
                                  type=str,
                                  required=True)
+    extract_domains.add_argument("--fasta-index", action="store_true",
+                                 help="Read only the sequences with domains"
+                                      " through a .fai index of the FASTA"
+                                      " file (built on first use), instead"
+                                      " of loading the whole file")
+    extract_domains.add_argument("--stream", action="store_true",
+                                 help="Write domains while reading the CDD"
+                                      " results one query at a time. Without"
+                                      " --fasta-index, the FASTA file must"
+                                      " list the queries in the same order"
+                                      " as the search results")
+
+    # Index FASTA
+    index_fasta = subparsers.add_parser(
+        "index-fasta",
+        help="Builds a samtools-compatible .fai index of a FASTA file."
+             " `extract-domains --fasta-index` builds it on first use, this"
+             " command is meant to build it ahead of time.",
+    )
+    index_fasta.set_defaults(func=commands.index_fasta)
+    index_fasta.add_argument("-f", "--fasta-file", required=True,
+                             help="Path to the FASTA file")
 
     # Extract Domains ECOD
     extract_domains_ecod = subparsers.add_parser(
@@ -95,6 +153,18 @@ if __name__ == "__main__":
                                   help="Path to the output directory",
                                   type=str,
                                   required=True)
+    create_ecod_pdbs.add_argument("-c", "--cpu-count", type=int, default=-1,
+                                  help="Number of cores to use for parallel"
+                                       " processing")
+    create_ecod_pdbs.add_argument("--engine", choices=["biopython", "text"],
+                                  default="biopython",
+                                  help="Parse chains with Biopython, or copy"
+                                       " the matching ATOM/HETATM records"
+                                       " directly (text, faster)")
+    create_ecod_pdbs.add_argument("--pdb-index", default=None,
+                                  help="Path to the persisted index of the"
+                                       " PDB directory (default:"
+                                       " <pdb-dir>/.sif-pdb-index)")
 
     # Extract Chains
     extract_chains = subparsers.add_parser(
@@ -112,6 +182,12 @@ if __name__ == "__main__":
                                      " with .pdb or .ent.gz extensions",
                                 type=str,
                                 required=True)
+    extract_chains.add_argument("-c", "--cpu-count", type=int, default=-1,
+                                help="Number of cores to use for parallel"
+                                     " processing")
+    extract_chains.add_argument("-f", "--force", action="store_true",
+                                help="Extract chains even from files whose"
+                                     " chain files are up to date")
 
     # Make SKA database
     ska_db = subparsers.add_parser(
@@ -134,11 +210,44 @@ if __name__ == "__main__":
     ska_db.add_argument("-r", "--trolltop", required=True,
                         help="value for the TROLLTOP environment variable")
     ska_db.add_argument("-i", "--array-idx", type=int, required=True,
-                        help="Index of the query to run")
+                        help="Index of the query to run. With"
+                             " --queries-per-task N, index of the slice of N"
+                             " queries to run")
     ska_db.add_argument("-n", "--batch-size", type=int, required=True,
                         help="Batch size for the inner loop")
     ska_db.add_argument("-c", "--cpu-count", type=int, default=-1,
                         help="Number of cores to use for parallel processing")
+    ska_db.add_argument("--stream", action="store_true",
+                        help="Append each alignment to the output file as it"
+                             " arrives instead of buffering all of them in"
+                             " memory. Interrupted streaming runs resume from"
+                             " their checkpoint when restarted (even without"
+                             " --stream). Runs without --stream keep no"
+                             " checkpoint, and an interrupted query restarts"
+                             " from scratch")
+    ska_db.add_argument("--queries-per-task", type=int, default=1,
+                        help="Number of queries processed by each array"
+                             " task, sharing one process pool and one"
+                             " loaded database")
+    ska_db.add_argument("--backend", choices=["shell", "exec"],
+                        default="shell",
+                        help="How ska is started for each pair: through"
+                             " /bin/sh (shell), or by executing the binary"
+                             " directly from the pool workers (exec)")
+    ska_db.add_argument("--container", default=None,
+                        help="Name of a running container where ska is"
+                             " executed with `docker exec` (requires"
+                             " --backend exec). --bin is then the path of"
+                             " ska inside the container")
+    ska_db.add_argument("--prefilter-psd", type=float, default=None,
+                        help="Only store the full alignment of pairs with a"
+                             " PSD <= this value, every other pair is stored"
+                             " with its RMSD and PSD only. It should not be"
+                             " lower than the --psd-threshold used in"
+                             " `neighborhood-clusters`")
+    ska_db.add_argument("-w", "--max-in-flight", type=int, default=None,
+                        help="Maximum number of pairs submitted to the pool"
+                             " and not gathered yet (default: 4 per core)")
 
     # Make SKA database
     ska_map = subparsers.add_parser(
@@ -168,6 +277,48 @@ if __name__ == "__main__":
                          help="Batch size")
     ska_map.add_argument("-c", "--cpu-count", type=int, default=-1,
                          help="Number of cores to use for parallel processing")
+    ska_map.add_argument("--stream", action="store_true",
+                         help="Append each alignment to the output file as it"
+                              " arrives instead of buffering all of them in"
+                              " memory. Interrupted streaming runs resume from"
+                              " their checkpoint when restarted (even without"
+                              " --stream). Runs without --stream keep no"
+                              " checkpoint, and an interrupted query restarts"
+                              " from scratch")
+    ska_map.add_argument("--backend", choices=["shell", "exec"],
+                         default="shell",
+                         help="How ska is started for each pair: through"
+                              " /bin/sh (shell), or by executing the binary"
+                              " directly from the pool workers (exec)")
+    ska_map.add_argument("--container", default=None,
+                         help="Name of a running container where ska is"
+                              " executed with `docker exec` (requires"
+                              " --backend exec). --bin is then the path of"
+                              " ska inside the container")
+    ska_map.add_argument("--prefilter-psd", type=float, default=None,
+                         help="Only store the full alignment of pairs with a"
+                              " PSD <= this value, every other pair is stored"
+                              " with its RMSD and PSD only. It should not be"
+                              " lower than the --psd-threshold used in"
+                              " `neighborhood-clusters`")
+    ska_map.add_argument("-w", "--max-in-flight", type=int, default=None,
+                         help="Maximum number of pairs submitted to the pool"
+                              " and not gathered yet (default: 4 per core)")
+
+    # SKA store
+    ska_store = subparsers.add_parser(
+        "ska-store",
+        help="Converts the .ska files of a `ska-db` output directory into an"
+             " indexed SQLite store, where single pairs or all the subjects"
+             " of a query under a PSD threshold can be looked up without"
+             " parsing the .ska files.",
+    )
+    ska_store.set_defaults(func=commands.ska_store)
+    ska_store.add_argument("-s", "--ska-dir", required=True,
+                           help="Path to the ska-db directory")
+    ska_store.add_argument("-o", "--output-file", required=True,
+                           help="Path to the SQLite store (will be created,"
+                                " or updated if it exists)")
 
     get_neighborhood_clusters = subparsers.add_parser(
         "neighborhood-clusters",
@@ -203,6 +354,12 @@ if __name__ == "__main__":
                                            default=-1,
                                            help="Number of cores to use for"
                                                 " parallel processing")
+    get_neighborhood_clusters.add_argument("-w", "--max-in-flight", type=int,
+                                           default=None,
+                                           help="Maximum number of targets"
+                                                " submitted to the pool and"
+                                                " not gathered yet (default:"
+                                                " 4 per core)")
 
     # Extract Chains
     expand_clusters = subparsers.add_parser(
@@ -239,6 +396,180 @@ if __name__ == "__main__":
                                       " indexed by the center of the PDB ID",
                                  type=str,
                                  required=True)
+    expand_clusters.add_argument("--pdb-index", default=None,
+                                 help="Path to the persisted index of the"
+                                      " PDB directory (default:"
+                                      " <pdb-dir>/.sif-pdb-index)")
+    expand_clusters.add_argument("--cache-dir", default=None,
+                                 help="Directory to cache the index of"
+                                      " `--cdhit-clusters` in (default:"
+                                      " $SIF_CACHE_DIR, or next to the"
+                                      " file)")
+
+    # Extract alignments
+    extract_ska_alignments = subparsers.add_parser(
+        "extract-ska-alignments",
+        help="Extracts the alignments of the finished `.ska` files of a"
+             " directory to a tab-separated file with the columns acc1,"
+             " acc2, method, start1, seq1, start2 and seq2.",
+    )
+    extract_ska_alignments.set_defaults(func=commands.extract_ska_alignments)
+    extract_ska_alignments.add_argument("-s", "--ska-dir", required=True,
+                                        help="Path to a directory with the"
+                                             " output of `ska-db`")
+    extract_ska_alignments.add_argument("-o", "--output-file", required=True,
+                                        help="Path to the alignment file"
+                                             " (will be created)")
+    extract_ska_alignments.add_argument("-c", "--cpu-count", type=int,
+                                        default=-1,
+                                        help="Number of cores to use for"
+                                             " parallel processing")
+    extract_ska_alignments.add_argument("--max-in-flight", type=int,
+                                        default=None,
+                                        help="Maximum number of files parsed"
+                                             " and not written yet (default:"
+                                             " the number of cores)")
+
+    extract_homstrad_alignments = subparsers.add_parser(
+        "extract-homstrad-alignments",
+        help="Extracts the alignments of Foldseek's"
+             " `homstrad_alignments.txt` file, in the same format as"
+             " `extract-ska-alignments`.",
+    )
+    extract_homstrad_alignments.set_defaults(
+        func=commands.extract_homstrad_alignments)
+    extract_homstrad_alignments.add_argument("-f", "--homstrad-file",
+                                             required=True,
+                                             help="Path to the"
+                                                  " `homstrad_alignments.txt`"
+                                                  " file")
+    extract_homstrad_alignments.add_argument("-o", "--output-file",
+                                             required=True,
+                                             help="Path to the alignment"
+                                                  " file (will be created)")
+
+    # Evaluate alignments
+    evaluate_alignment = subparsers.add_parser(
+        "evaluate-alignment",
+        help="Computes the sensitivity and precision of alignments against"
+             " reference alignments (e.g. HOMSTRAD's), both in the format of"
+             " `extract-ska-alignments`.",
+    )
+    evaluate_alignment.set_defaults(func=commands.evaluate_alignment)
+    evaluate_alignment.add_argument("-g", "--ground-truth", required=True,
+                                    help="Path to the reference alignments")
+    evaluate_alignment.add_argument("-r", "--ground-truth-method",
+                                    default=None,
+                                    help="If given, only the reference"
+                                         " alignments of this method are"
+                                         " used")
+    evaluate_alignment.add_argument("-a", "--alignments", required=True,
+                                    help="Path to the alignments to"
+                                         " evaluate")
+    evaluate_alignment.add_argument("-m", "--method", default=None,
+                                    help="If given, only the alignments of"
+                                         " this method are evaluated")
+    evaluate_alignment.add_argument("-o", "--output-file", default=None,
+                                    help="Path to a TSV file with the"
+                                         " sensitivity and precision of each"
+                                         " pair (will be created)")
+
+    # Incremental clustering
+    cluster_incremental = subparsers.add_parser(
+        "cluster-incremental",
+        help="Adds new sequences to an existing CD-HIT clustering, instead of"
+             " reclustering all the sequences. Writes the updated"
+             " representatives to `--output` and the clusters to"
+             " `<output>.clstr`, as CD-HIT's `-o` does.",
+    )
+    cluster_incremental.set_defaults(func=commands.cluster_incremental)
+    cluster_incremental.add_argument("-i", "--cdhit-clusters", required=True,
+                                     help="Path to a CD-HIT output file"
+                                          " (.clstr)")
+    cluster_incremental.add_argument("-r", "--representatives", default=None,
+                                     help="Path to the representative"
+                                          " sequences of the clusters"
+                                          " (default: the `--cdhit-clusters`"
+                                          " path without `.clstr`)")
+    cluster_incremental.add_argument("-n", "--new-sequences", required=True,
+                                     help="Path to the sequences to add"
+                                          " (FASTA format), sequences already"
+                                          " clustered are skipped")
+    cluster_incremental.add_argument("-o", "--output", required=True,
+                                     help="Path to the updated representative"
+                                          " sequences (will be created)")
+    cluster_incremental.add_argument("-t", "--identity", type=float,
+                                     default=0.6,
+                                     help="Sequence identity threshold, as"
+                                          " CD-HIT's `-c` (default: 0.6)")
+    cluster_incremental.add_argument("-k", "--word-length", type=int,
+                                     default=4,
+                                     help="k-mer length of the prefilter, as"
+                                          " CD-HIT's `-n` (default: 4)")
+    cluster_incremental.add_argument("-m", "--max-candidates", type=int,
+                                     default=10,
+                                     help="Number of representatives aligned"
+                                          " to each sequence, the ones"
+                                          " sharing the most k-mers with it"
+                                          " (default: 10)")
+    cluster_incremental.add_argument("-c", "--cpu-count", type=int,
+                                     default=-1,
+                                     help="Number of cores to use for parallel"
+                                          " processing")
+
+    # Index clusters
+    index_clusters = subparsers.add_parser(
+        "index-clusters",
+        help="Builds the array-backed index of a CD-HIT cluster file"
+             " (`<file>.index`), which `expand-clusters` memory-maps instead"
+             " of parsing the file. It is built on first use, this command"
+             " is meant to build it ahead of time.",
+    )
+    index_clusters.set_defaults(func=commands.index_clusters)
+    index_clusters.add_argument("-c", "--cdhit-clusters", required=True,
+                                help="Path to a CD-HIT output file (.clstr)")
+    index_clusters.add_argument("--cache-dir", default=None,
+                                help="Directory to write the index to"
+                                     " (default: $SIF_CACHE_DIR, or next to"
+                                     " the file)")
+
+    # Index mapping
+    index_mapping = subparsers.add_parser(
+        "index-mapping",
+        help="Indexes a mapping file created with `expand-clusters`, so that"
+             " each `ska-db-map` task reads only the rows of its query."
+             " `expand-clusters` already writes this index, this command is"
+             " meant for older or edited mapping files. If the rows are not"
+             " grouped by query, a grouped copy (`<stem>.grouped<suffix>`)"
+             " is written and indexed, and should be used instead.",
+    )
+    index_mapping.set_defaults(func=commands.index_mapping)
+    index_mapping.add_argument("-m", "--mapping-file", required=True,
+                               help="Path to the mapping file (tsv)")
+
+    # Pipeline
+    pipeline = subparsers.add_parser(
+        "pipeline",
+        help="Runs the whole pipeline with the files and binaries configured"
+             " in the `.env` file. Content hashes of the inputs and outputs"
+             " of each stage and target are kept in `PIPELINE_DIR`, and only"
+             " the targets and stages whose inputs changed are recomputed.",
+    )
+    pipeline.set_defaults(func=commands.pipeline)
+    pipeline.add_argument("-s", "--stages", nargs="+", default=None,
+                          help="Stages to run, among cdd-search,"
+                               " extract-domains, cdhit, ska-db,"
+                               " ska-db-domains, neighborhood-clusters and"
+                               " expand-clusters (default: all of them, in"
+                               " pipeline order)")
+    pipeline.add_argument("-f", "--force", action="store_true",
+                          help="Recompute every target of the selected"
+                               " stages")
+    pipeline.add_argument("-n", "--dry-run", action="store_true",
+                          help="Only report what would be recomputed")
+    pipeline.add_argument("-c", "--cpu-count", type=int, default=-1,
+                          help="Number of cores to use for parallel"
+                               " processing")
 
     # Parse the arguments and route the function call
     args = parser.parse_args()
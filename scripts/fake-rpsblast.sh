@@ -0,0 +1,56 @@
+#!/bin/sh
+# Stand-in for rpsblast, useful to try `cdd-search` without the CDD data,
+# e.g.:
+#   python SIF.py cdd-search ... -b scripts/fake-rpsblast.sh
+# Prints `-outfmt 7` output for each sequence of `-query`, with one hit
+# covering the first half of sequences of 20 or more residues. Set
+# FAKE_RPSBLAST_FAIL to a percentage to make that share of the runs fail.
+query=""
+db=""
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -query) query="$2"; shift ;;
+        -db) db="$2"; shift ;;
+    esac
+    shift
+done
+awk -v fail="${FAKE_RPSBLAST_FAIL:-0}" -v seed="$$" -v db="$db" '
+function report() {
+    print "# RPSBLAST 2.13.0+"
+    print "# Query: " header
+    print "# Database: " db
+    if (len < 20) {
+        print "# 0 hits found"
+        return
+    }
+    print "# Fields: query acc.ver, subject acc.ver, % identity, alignment" \
+          " length, mismatches, gap opens, q. start, q. end, s. start," \
+          " s. end, evalue, bit score"
+    print "# 1 hits found"
+    half = int(len / 2)
+    printf "%s\tCDD:%d\t35.000\t%d\t10\t1\t1\t%d\t1\t%d\t1.00e-05\t50.0\n",
+           name, len % 1000, half, half, half
+}
+BEGIN {
+    srand(seed)
+    if (rand() * 100 < fail) {
+        print "fake rpsblast failure" > "/dev/stderr"
+        failed = 1
+        exit 1
+    }
+}
+/^>/ {
+    if (name != "") report()
+    header = substr($0, 2)
+    split(header, words, " ")
+    name = words[1]
+    len = 0
+    n++
+    next
+}
+{ len += length($0) }
+END {
+    if (failed) exit 1
+    if (name != "") report()
+    printf "# BLAST processed %d queries\n", n
+}' "$query"
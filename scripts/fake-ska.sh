@@ -0,0 +1,14 @@
+#!/bin/sh
+# Stand-in for the ska binary, useful to benchmark `ska-db` without a ska
+# licence, e.g.:
+#   python SIF.py ska-db ... -b scripts/fake-ska.sh --backend exec
+# Prints a small alignment in ska's output format, with a PSD derived from
+# the names of the two input files.
+h=$(printf '%s%s' "$1" "$2" | cksum | cut -d' ' -f1)
+psd=$((h % 100))
+echo "RMSD: 1.$psd"
+echo "PSD: 0.$psd"
+echo "  tc_sse: 1 HHHHHH"
+echo "  tc: 1 ACDEFG"
+echo "  tc_sse: 3 HHH-HH"
+echo "  tc: 3 ACD-FG"
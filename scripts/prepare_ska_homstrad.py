@@ -1,5 +1,7 @@
 from pathlib import Path
-from typing import Tuple
+from collections import Counter
+from typing import Optional, Tuple
+from siflib.io.pdb_resolver import PDBResolver
 import logging
 
 
@@ -14,37 +16,83 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-def run(homstrad_file: Path, output_file: Path, pdb_dir: Path):
+def run(homstrad_file: Path, output_file: Path, pdb_dir: Path,
+        pdb_index: Optional[Path] = None,
+        num_threads: Optional[int] = None,
+        unresolved_file: Optional[Path] = None):
+    pairs = []
+    with homstrad_file.open() as hf:
+        for line in hf:
+            _, pdb1, pdb2 = line.strip().split()
+            pairs.append((pdb1, pdb2))
+    pdbs = {pdb for pair in pairs for pdb in pair}
+    # only the subdirectories of the needed entries are scanned, and the
+    # index is only persisted if one is given
+    resolver = PDBResolver(pdb_dir, pdb_index,
+                           subdirs={pdb[1:3] for pdb in pdbs},
+                           persist=pdb_index is not None,
+                           num_threads=num_threads)
 
-    def get_pdbfile(pdb: str) -> Tuple:
-        pdb_subdir = pdb[1:3]
+    def get_pdbfile(pdb: str) -> Tuple[Optional[Path], Optional[str]]:
+        """
+        Returns the file of `pdb` and None, or None and the reason it could
+        not be resolved.
+        """
         if len(pdb) == 4:  # no chain
-            candidates = sorted((pdb_dir / pdb_subdir).glob(f"pdb{pdb}*.pdb"))
+            candidates = list(resolver.chains(pdb).values())
+            entry = resolver.path(pdb)
+            if entry is not None and entry.suffix == ".pdb":
+                candidates.append(entry)
             if len(candidates) == 1:
-                return pdb, str(candidates[0])
+                return candidates[0], None
+            if candidates:
+                return None, f"{len(candidates)} candidate files"
         elif len(pdb) == 5:  # last char is the chain, case insensitive
-            chain = pdb[-1]
-            candidates = sorted((pdb_dir / pdb_subdir).glob(f"pdb{pdb[:-1]}*.pdb"))
-            for candidate in candidates:
-                file_chain = str(candidate).split("_")[-1].replace(".pdb", "")
-                if file_chain.upper() == chain.upper():
-                    return pdb, str(candidate)
-        return None, None
+            path = resolver.chain_path(pdb[:-1], pdb[-1],
+                                       case_sensitive=False)
+            if path is not None:
+                return path, None
+            if resolver.chains(pdb[:-1]):
+                return None, "chain not found or ambiguous"
+        else:
+            return None, "not a PDB ID"
+        return None, "not found"
 
-    pdbs = set()
-    with homstrad_file.open() as hf:
-        for line in hf:
-            _, pdb1, pdb2 = line.strip().split()
-            # we only want to keep the pairs with existing PDBs
-            p1, path1 = get_pdbfile(pdb1)
-            p2, path2 = get_pdbfile(pdb2)
-            if p1 is not None and p2 is not None:
-                pdbs.add((p1, path1))
-                pdbs.add((p2, path2))
+    paths = {}
+    unresolved = {}
+    for pdb in sorted(pdbs):
+        path, reason = get_pdbfile(pdb)
+        if path is None:
+            unresolved[pdb] = reason
+        else:
+            paths[pdb] = path
 
+    # we only want to keep the pairs with existing PDBs
+    kept = set()
+    num_pairs = 0
+    for pdb1, pdb2 in pairs:
+        if pdb1 in paths and pdb2 in paths:
+            kept.update((pdb1, pdb2))
+            num_pairs += 1
     with output_file.open("w") as of:
-        for pdb, path in pdbs:
-            of.write(f"{pdb}\t{path}\n")
+        for pdb in sorted(kept):
+            of.write(f"{pdb}\t{paths[pdb]}\n")
+
+    logger.info(f"kept {num_pairs} of {len(pairs)} pairs, {len(kept)}"
+                f" structures saved to {output_file}")
+    if unresolved:
+        reasons = Counter(unresolved.values())
+        logger.warning(f"{len(unresolved)} of {len(pdbs)} IDs could not be"
+                       " resolved: " + ", ".join(
+                           f"{n} {reason}" for reason, n
+                           in reasons.most_common()))
+        logger.warning("unresolved IDs: " + " ".join(list(unresolved)[:20])
+                       + (" ..." if len(unresolved) > 20 else ""))
+        if unresolved_file is not None:
+            with unresolved_file.open("w") as uf:
+                for pdb, reason in unresolved.items():
+                    uf.write(f"{pdb}\t{reason}\n")
+            logger.info(f"unresolved IDs saved to {unresolved_file}")
 
 
 if __name__ == "__main__":
@@ -57,8 +105,21 @@ if __name__ == "__main__":
                         help="Path to the PDB directory")
     parser.add_argument("-o", "--output-file", required=True,
                         help="Path to the output file")
+    parser.add_argument("--pdb-index", default=None,
+                        help="Path to a persisted index of the PDB"
+                             " directory to reuse and update (default: the"
+                             " needed subdirectories are scanned, and the"
+                             " index is not saved)")
+    parser.add_argument("-t", "--threads", type=int, default=None,
+                        help="Number of subdirectories scanned concurrently")
+    parser.add_argument("-u", "--unresolved-file", default=None,
+                        help="Path to a file listing the IDs that could not"
+                             " be resolved, and why")
     args = parser.parse_args()
     run(Path(args.homstrad_pairs_file),
         Path(args.output_file),
         Path(args.pdb_dir),
+        Path(args.pdb_index) if args.pdb_index else None,
+        args.threads,
+        Path(args.unresolved_file) if args.unresolved_file else None,
         )
@@ -0,0 +1,221 @@
+"""
+In-process API for the SIF pipeline.
+
+The `SIF.py` commands read their inputs from files and write their results
+back to files. The functions in this module run the same steps on in-memory
+structures instead, so a notebook or a service can chain them (and reuse
+the reference data loaded by `load_ecod_mapping` and `load_clusters`)
+without starting an interpreter per step. Files are only written when an
+output path is given.
+
+Example
+-------
+>>> ecod = load_ecod_mapping(Path("ecod-mapping.tsv"))
+>>> clusters = load_clusters(Path("pdb-cdhit.clstr"))
+>>> neighborhood = neighborhood_clusters(targets, ska_dir, domain_dir, ecod)
+>>> members = expand_clusters(neighborhood, clusters)
+>>> database = ska_database(members, pdb_dir)
+"""
+from pathlib import Path
+from concurrent.futures import Executor
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from siflib.core import neighborhood as _neighborhood
+from siflib.io.cluster_index import ClusterIndex
+from siflib.io.extract_domains import iter_domain_sequences
+from siflib.io.parsers import parse_cdd, parse_ecod_mapping, parse_fasta
+from siflib.io.ska_wrapper import align_queries
+import logging
+
+
+log = logging.getLogger(__name__)
+
+# (representative, minimum PSD) pairs of each target
+Neighborhood = Dict[str, List[Tuple[str, float]]]
+
+
+def load_ecod_mapping(ecod_mapping_file: Path) -> Dict[str, List[str]]:
+    """
+    Loads the ECOD domain to chains mapping used by `neighborhood_clusters`.
+    """
+    return parse_ecod_mapping(ecod_mapping_file)
+
+
+def load_clusters(clusters_file: Path,
+                  cache_dir: Optional[Path] = None) -> ClusterIndex:
+    """
+    Loads the representative to members mapping of a CD-HIT `.clstr` file,
+    used by `expand_clusters`. The index is memory-mapped, so it can be
+    loaded once and shared. It is cached in `cache_dir` if given.
+    """
+    return _neighborhood.cluster_members(clusters_file, cache_dir)
+
+
+def domain_sequences(cdd_result: Union[Path, Dict],
+                     sequences: Union[Path, Dict],
+                     out_file: Optional[Path] = None) -> List[Tuple[str, str]]:
+    """
+    Extracts the sequence of each domain found in a CDD search.
+
+    Parameters
+    ----------
+    cdd_result : Path or Dict
+        rpsblast output, or its contents as returned by `parse_cdd`
+    sequences : Path or Dict
+        FASTA file used in the search, or its contents as returned by
+        `parse_fasta(..., uniprot_header=False)`
+    out_file : Path, optional
+        If given, the domains are also written to this FASTA file
+
+    Returns
+    -------
+    List[Tuple[str, str]]
+        (header, sequence) of each domain
+    """
+    if isinstance(cdd_result, Path):
+        cdd_result = parse_cdd(cdd_result)
+    if isinstance(sequences, Path):
+        sequences = parse_fasta(sequences, uniprot_header=False,
+                                skip_metadata=True)
+    domains = list(iter_domain_sequences(cdd_result, sequences))
+    if out_file is not None:
+        with out_file.open("w") as of:
+            for header, sequence in domains:
+                of.write(f">{header}\n{sequence}\n")
+    return domains
+
+
+def align(queries: Dict[str, str],
+          database: Dict[str, str],
+          output_dir: Path,
+          submat: str,
+          trolltop: str,
+          skabin: str,
+          num_cpu: Optional[int] = None,
+          **kwargs) -> Dict[str, Path]:
+    """
+    Aligns `queries` against `database` (both mapping IDs to structure
+    paths) with ska, skipping the queries that are already done in
+    `output_dir`. Other keyword arguments are passed to
+    `ska_wrapper.align_queries`.
+
+    Returns
+    -------
+    Dict[str, Path]
+        The `.ska` file of each query
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    pending = {q: p for q, p in queries.items()
+               if not (output_dir / f"{q}.ska.done").is_file()}
+    if pending:
+        align_queries(pending, database, output_dir, submat, trolltop,
+                      skabin, num_cpu=num_cpu, **kwargs)
+    return {q: output_dir / f"{q}.ska" for q in queries}
+
+
+def neighborhood_clusters(targets: Iterable[str],
+                          ska_dir: Path,
+                          domain_ska_dir: Path,
+                          ecod_mapping: Union[Path, Dict[str, List[str]]],
+                          psd_threshold: float = 0.6,
+                          num_cpu: Optional[int] = None,
+                          executor: Optional[Executor] = None,
+                          output_file: Optional[Path] = None,
+                          ) -> Neighborhood:
+    """
+    Finds the cluster representatives of each target, as the
+    `neighborhood-clusters` command does.
+
+    Parameters
+    ----------
+    targets : Iterable[str]
+        Target IDs, targets without `.ska` files are skipped
+    ska_dir : Path
+        Directory with the `.ska` files of the targets against the chains
+    domain_ska_dir : Path
+        Directory with the `.ska` files of the targets against ECOD domains
+    ecod_mapping : Path or Dict
+        ECOD mapping file, or its contents as returned by
+        `load_ecod_mapping`
+    psd_threshold : float, default 0.6
+        SKA PSD cutoff
+    num_cpu : int, optional
+        Number of cores to use, all if None
+    executor : Executor, optional
+        Pool to reuse across calls, a new one is created if None
+    output_file : Path, optional
+        If given, the result is also written to this file
+
+    Returns
+    -------
+    Dict[str, List[Tuple[str, float]]]
+        (representative, minimum PSD) pairs of each target
+    """
+    if isinstance(ecod_mapping, Path):
+        ecod_mapping = load_ecod_mapping(ecod_mapping)
+    target_files = []
+    for target in targets:
+        ska_file = ska_dir / f"{target}.ska"
+        domain_file = domain_ska_dir / f"{target}.ska"
+        if ska_file.is_file() and domain_file.is_file():
+            target_files.append((target, ska_file, domain_file))
+        else:
+            log.info(f"SKA files for {target} not found, skipping")
+    aggregator = _neighborhood.compute_neighborhood_clusters(
+        target_files, ecod_mapping, psd_threshold, num_cpu,
+        executor=executor, total=len(target_files))
+    if output_file is not None:
+        aggregator.write(output_file)
+    return aggregator.clusters()
+
+
+def expand_clusters(neighborhood: Neighborhood,
+                    clusters: Union[Path, ClusterIndex],
+                    mapping_output_file: Optional[Path] = None,
+                    ) -> Dict[str, List[str]]:
+    """
+    Maps each target to the members of the clusters of its representatives,
+    as the `expand-clusters` command does.
+
+    Parameters
+    ----------
+    neighborhood : Dict[str, List[Tuple[str, float]]]
+        Output of `neighborhood_clusters`
+    clusters : Path or ClusterIndex
+        CD-HIT `.clstr` file, or its index as returned by `load_clusters`
+    mapping_output_file : Path, optional
+        If given, the mapping (and its index) is also written to this file,
+        for use with `ska-db-map`
+
+    Returns
+    -------
+    Dict[str, List[str]]
+        Cluster members of each target
+    """
+    if isinstance(clusters, Path):
+        clusters = load_clusters(clusters)
+    target_to_reps = {target: [r for r, _ in reps]
+                      for target, reps in neighborhood.items()}
+    members = _neighborhood.expand_clusters(target_to_reps, clusters)
+    if mapping_output_file is not None:
+        _neighborhood.write_expanded_mapping(members, mapping_output_file)
+    return members
+
+
+def ska_database(target_to_members: Dict[str, List[str]],
+                 pdb_dir: Path,
+                 pdb_index: Optional[Path] = None,
+                 output_file: Optional[Path] = None) -> Dict[str, str]:
+    """
+    Resolves the cluster members returned by `expand_clusters` to their
+    files in the PDB mirror `pdb_dir`.
+
+    Returns
+    -------
+    Dict[str, str]
+        Structure path of each member, suitable as the `database` of `align`
+    """
+    members = {m for ms in target_to_members.values() for m in ms}
+    paths = _neighborhood.resolve_members(members, pdb_dir, pdb_index)
+    if output_file is not None:
+        _neighborhood.write_ska_database(paths, output_file)
+    return {member: str(path) for member, path in paths.items()}
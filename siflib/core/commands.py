@@ -8,7 +8,31 @@ def extract_domains(args, config):
     in_file = Path(args.in_file)
     fasta_file = Path(args.fasta_file)
     out_file = Path(args.out_file)
-    extract_domains(in_file, fasta_file, out_file)
+    extract_domains(in_file, fasta_file, out_file, args.fasta_index,
+                    args.stream)
+
+
+def cdd_search(args, config):
+    from siflib.io.cdd_search import run_cdd_search
+    cdd_bin = args.bin or config.get("CDD_BIN")
+    assert cdd_bin, "set CDD_BIN in the configuration file or pass --bin"
+    cdd_db = args.db or config.get("CDD_DB") or "mycdd"
+    num_jobs = None if args.cpu_count <= 0 else args.cpu_count
+    num_shards = None if args.shards <= 0 else args.shards
+    work_dir = Path(args.work_dir) if args.work_dir else None
+    run_cdd_search(Path(args.in_file),
+                   Path(args.out_file),
+                   cdd_bin,
+                   cdd_db,
+                   num_jobs,
+                   num_shards,
+                   args.retries,
+                   work_dir)
+
+
+def index_fasta(args, config):
+    from siflib.io.fasta_index import build_fasta_index
+    build_fasta_index(Path(args.fasta_file))
 
 
 def extract_domains_ecod(args, config):
@@ -24,13 +48,17 @@ def create_ecod_pdbs(args, config):
     pdb_dir = Path(args.pdb_dir)
     ecod_mapping_file = Path(args.ecod_mapping_file)
     out_dir = Path(args.out_dir)
-    create_ecod_pdbs(pdb_dir, ecod_mapping_file, out_dir)
+    num_cpu = None if args.cpu_count <= 0 else args.cpu_count
+    pdb_index = Path(args.pdb_index) if args.pdb_index else None
+    create_ecod_pdbs(pdb_dir, ecod_mapping_file, out_dir, num_cpu,
+                     args.engine, pdb_index)
 
 
 def extract_chains(args, config):
     from siflib.io.extract_chains import run
     in_dir = Path(args.in_dir)
-    run(in_dir)
+    num_cpu = None if args.cpu_count <= 0 else args.cpu_count
+    run(in_dir, num_cpu, args.force)
 
 
 def ska_database(args, config):
@@ -44,7 +72,13 @@ def ska_database(args, config):
         args.bin,
         args.array_idx,
         args.batch_size,
-        num_cpu)
+        num_cpu,
+        args.stream,
+        args.queries_per_task,
+        args.backend,
+        args.container,
+        args.prefilter_psd,
+        args.max_in_flight)
 
 
 def ska_database_map(args, config):
@@ -59,7 +93,24 @@ def ska_database_map(args, config):
                      args.bin,
                      args.array_idx,
                      args.batch_size,
-                     num_cpu)
+                     num_cpu,
+                     args.stream,
+                     args.backend,
+                     args.container,
+                     args.prefilter_psd,
+                     args.max_in_flight)
+
+
+def ska_store(args, config):
+    from siflib.io.ska_store import build_ska_store
+    ska_dir = Path(args.ska_dir)
+    ska_files = []
+    for ska_file in sorted(ska_dir.glob("*.ska")):
+        if ska_file.with_name(f"{ska_file.name}.done").is_file():
+            ska_files.append(ska_file)
+        else:
+            log.warning(f"{ska_file} is not finished, skipping")
+    build_ska_store(ska_files, Path(args.output_file))
 
 
 def get_neighborhood_clusters(args, config):
@@ -71,26 +122,68 @@ def get_neighborhood_clusters(args, config):
                               Path(args.ecod_mapping_file),
                               Path(args.output_file),
                               args.psd_threshold,
-                              num_cpu)
+                              num_cpu,
+                              args.max_in_flight)
 
 
 def expand_neighborhood_clusters(args, config):
     from siflib.core.neighborhood import expand_neighborhood_clusters
+    pdb_index = Path(args.pdb_index) if args.pdb_index else None
+    cache_dir = Path(args.cache_dir) if args.cache_dir else None
     expand_neighborhood_clusters(Path(args.in_file),
                                  Path(args.cdhit_clusters),
                                  Path(args.pdb_dir),
                                  Path(args.ska_output_file),
                                  Path(args.mapping_output_file),
+                                 pdb_index,
+                                 cache_dir,
                                  )
 
 
+def cluster_incremental(args, config):
+    from siflib.core.incremental_clustering import cluster_incremental
+    clusters_file = Path(args.cdhit_clusters)
+    if args.representatives:
+        representatives_file = Path(args.representatives)
+    else:
+        representatives_file = clusters_file.with_suffix("")
+    num_cpu = None if args.cpu_count <= 0 else args.cpu_count
+    cluster_incremental(clusters_file,
+                        representatives_file,
+                        Path(args.new_sequences),
+                        Path(args.output),
+                        args.identity,
+                        args.word_length,
+                        args.max_candidates,
+                        num_cpu)
+
+
+def index_clusters(args, config):
+    from siflib.io.cluster_index import build_cluster_index, index_dir
+    cache_dir = Path(args.cache_dir) if args.cache_dir else None
+    clusters_file = Path(args.cdhit_clusters)
+    build_cluster_index(clusters_file, index_dir(clusters_file, cache_dir))
+
+
+def index_mapping(args, config):
+    from siflib.io.mapping_index import index_mapping_file
+    index_mapping_file(Path(args.mapping_file))
+
+
+def pipeline(args, config):
+    from siflib.core.pipeline import Pipeline
+    num_cpu = None if args.cpu_count <= 0 else args.cpu_count
+    Pipeline(config, num_cpu, args.force, args.dry_run).run(args.stages)
+
+
 def extract_ska_alignments(args, config):
-    from siflib.io.extract_alingments import (extract_alignments_ska_dir,
-                                              extract_alingments_to_file)
-    extract_alingments_to_file(
-        extract_alignments_ska_dir(Path(args.ska_dir)),
-        Path(args.output_file)
-    )
+    from siflib.io.extract_alingments import \
+        extract_alignments_ska_dir_to_file
+    num_cpu = None if args.cpu_count <= 0 else args.cpu_count
+    extract_alignments_ska_dir_to_file(Path(args.ska_dir),
+                                       Path(args.output_file),
+                                       num_cpu,
+                                       args.max_in_flight)
 
 
 def extract_homstrad_alignments(args, config):
@@ -103,4 +196,20 @@ def extract_homstrad_alignments(args, config):
 
 
 def evaluate_alignment(args, config):
-    fkkk
+    from siflib.evaluation.alignment import (alignment_tuples,
+                                             evaluate_alignment,
+                                             summarize_evaluation,
+                                             write_evaluation)
+    from siflib.io.extract_alingments import iter_alignments_file
+    ground_truth = alignment_tuples(
+        iter_alignments_file(Path(args.ground_truth)),
+        args.ground_truth_method)
+    method_alignments = alignment_tuples(
+        iter_alignments_file(Path(args.alignments)), args.method)
+    results = evaluate_alignment(ground_truth, method_alignments)
+    if args.output_file:
+        write_evaluation(results, Path(args.output_file))
+    summary = summarize_evaluation(results)
+    log.info(f"{summary['pairs']} pairs, mean sensitivity"
+             f" {summary['sensitivity']:.4f}, mean precision"
+             f" {summary['precision']:.4f}")
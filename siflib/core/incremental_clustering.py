@@ -0,0 +1,394 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from Bio.Align import PairwiseAligner, substitution_matrices
+from siflib.core.scheduler import bounded_map, default_window
+from siflib.io.cluster_index import ClusterIndex
+from siflib.io.parsers import iter_fasta
+import numpy as np
+import logging
+import math
+import os
+import shutil
+
+
+log = logging.getLogger(__name__)
+
+ALPHABET = "ACDEFGHIKLMNPQRSTVWY"
+# any other residue is encoded as len(ALPHABET)
+_ENCODING = np.full(256, len(ALPHABET), dtype=np.int64)
+_ENCODING[np.frombuffer(ALPHABET.encode(), dtype=np.uint8)] = \
+    np.arange(len(ALPHABET))
+
+# (accession, length, identity %) of a sequence assigned to a cluster
+Assignment = Tuple[str, int, float]
+
+
+def kmer_codes(sequence: str, k: int) -> np.ndarray:
+    """
+    Returns the distinct k-mers of `sequence`, each encoded as an integer.
+    """
+    encoded = _ENCODING[np.frombuffer(sequence.upper().encode(),
+                                      dtype=np.uint8)]
+    n = len(encoded) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    codes = np.zeros(n, dtype=np.int64)
+    for i in range(k):
+        codes = codes * (len(ALPHABET) + 1) + encoded[i:i + n]
+    return np.unique(codes)
+
+
+def min_shared_kmers(length: int,
+                     identity: float,
+                     k: int,
+                     distinct: int) -> int:
+    """
+    Minimum number of k-mers that a sequence of `length` residues, with
+    `distinct` distinct k-mers, shares with any sequence it is at least
+    `identity` identical to: each of its `(1 - identity) * length`
+    mismatches breaks at most `k` of its `length - k + 1` k-mers.
+
+    Shared k-mers are counted once (see `kmer_codes`), so the bound is
+    capped at `distinct`, otherwise low-complexity sequences (His-tags,
+    poly-Q stretches) would fail it even against identical sequences. Low
+    identities give a bound of 1.
+    """
+    mismatches = math.floor((1 - identity) * length)
+    return max(1, min(length - k + 1 - mismatches * k, distinct))
+
+
+class KmerIndex:
+    """
+    Inverted index from k-mers to the sequences containing them, stored as
+    CSR arrays (k-mer code -> sequence IDs), used to count the k-mers that
+    a query shares with every indexed sequence with a single `bincount`.
+    """
+
+    def __init__(self, sequences: List[str], k: int):
+        self.k = k
+        self.size = len(sequences)
+        per_sequence = [kmer_codes(s, k) for s in sequences]
+        codes = np.concatenate(per_sequence) if per_sequence else \
+            np.empty(0, dtype=np.int64)
+        ids = np.repeat(np.arange(self.size, dtype=np.int32),
+                        [len(c) for c in per_sequence])
+        order = np.argsort(codes, kind="stable")
+        self.indices = ids[order]
+        counts = np.bincount(codes, minlength=(len(ALPHABET) + 1) ** k)
+        self.indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.indptr[1:])
+
+    def shared(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Returns the number of the k-mers in `codes` (see `kmer_codes`)
+        found in each indexed sequence.
+        """
+        if len(codes) == 0:
+            return np.zeros(self.size, dtype=np.int64)
+        hits = np.concatenate([self.indices[self.indptr[c]:self.indptr[c + 1]]
+                               for c in codes.tolist()])
+        return np.bincount(hits, minlength=self.size)
+
+
+def make_aligner() -> PairwiseAligner:
+    """
+    Global aligner with BLOSUM62 and free end gaps (gap open -11, extend
+    -1), so the shorter sequence can be placed anywhere in the longer one.
+    """
+    return PairwiseAligner(
+        mode="global",
+        substitution_matrix=substitution_matrices.load("BLOSUM62"),
+        open_gap_score=-11,
+        extend_gap_score=-1,
+        end_gap_score=0,
+    )
+
+
+def sequence_identity(aligner: PairwiseAligner,
+                      representative: str,
+                      sequence: str) -> float:
+    """
+    CD-HIT's default identity (`-G 1`): identical aligned residues divided
+    by the length of the shorter sequence, as a percentage.
+    """
+    alignment = aligner.align(representative, sequence)[0]
+    shorter = min(len(representative), len(sequence))
+    return 100 * alignment.counts().identities / shorter
+
+
+def best_candidates(index: KmerIndex,
+                    lengths: np.ndarray,
+                    sequence: str,
+                    identity: float,
+                    max_candidates: int) -> np.ndarray:
+    """
+    Returns up to `max_candidates` indexed sequences, most shared k-mers
+    first, that are at least as long as `sequence` and share enough k-mers
+    with it to reach `identity` (see `min_shared_kmers`).
+    """
+    codes = kmer_codes(sequence, index.k)
+    shared = index.shared(codes)
+    needed = min_shared_kmers(len(sequence), identity, index.k, len(codes))
+    candidates = np.flatnonzero((shared >= needed) &
+                                (lengths >= len(sequence)))
+    order = np.argsort(-shared[candidates], kind="stable")
+    return candidates[order[:max_candidates]]
+
+
+# state of the workers of `assign_to_clusters`, set by `_init_worker`
+_worker = {}
+
+
+def _init_worker(index: KmerIndex,
+                 sequences: List[str],
+                 identity: float,
+                 max_candidates: int):
+    _worker["index"] = index
+    _worker["sequences"] = sequences
+    _worker["lengths"] = np.array([len(s) for s in sequences])
+    _worker["identity"] = identity
+    _worker["max_candidates"] = max_candidates
+    _worker["aligner"] = make_aligner()
+
+
+def _assign_worker(accession: str,
+                   sequence: str) -> Tuple[str, Optional[int], float]:
+    """
+    Returns the first candidate representative that `sequence` is at least
+    `identity` identical to, and that identity, or None.
+    """
+    for candidate in best_candidates(_worker["index"], _worker["lengths"],
+                                     sequence, _worker["identity"],
+                                     _worker["max_candidates"]).tolist():
+        pct = sequence_identity(_worker["aligner"],
+                                _worker["sequences"][candidate], sequence)
+        if pct >= _worker["identity"] * 100:
+            return accession, candidate, pct
+    return accession, None, 0.0
+
+
+def assign_to_clusters(newcomers: List[Tuple[str, str]],
+                       representatives: List[str],
+                       identity: float = 0.6,
+                       k: int = 4,
+                       max_candidates: int = 10,
+                       num_cpu: Optional[int] = None,
+                       ) -> Tuple[Dict[int, List[Assignment]],
+                                  List[Tuple[str, str, List[Assignment]]]]:
+    """
+    Greedily assigns new sequences to clusters, CD-HIT style: a sequence
+    joins the cluster of a representative at least as long as itself when
+    they are at least `identity` identical, and otherwise becomes the
+    representative of a new cluster.
+
+    Newcomers are first compared, in parallel, against `representatives`.
+    The ones left are then clustered among themselves, longest first.
+    Candidate representatives are prefiltered by shared k-mers, and only
+    the `max_candidates` sharing the most k-mers are aligned, so a match
+    that CD-HIT would find may occasionally be missed.
+
+    Parameters
+    ----------
+    newcomers : List[Tuple[str, str]]
+        (accession, sequence) of the new sequences, only the first
+        sequence of a repeated accession is clustered
+    representatives : List[str]
+        Sequence of the representative of each existing cluster
+    identity : float, default 0.6
+        Identity threshold, as CD-HIT's `-c`
+    k : int, default 4
+        k-mer length, as CD-HIT's `-n`
+    max_candidates : int, default 10
+        Number of candidate representatives aligned per sequence
+    num_cpu : int, optional
+        Number of workers, all cores if None
+
+    Returns
+    -------
+    Dict[int, List[Tuple[str, int, float]]]
+        (accession, length, identity %) of the newcomers assigned to each
+        existing cluster
+    List[Tuple[str, str, List[Tuple[str, int, float]]]]
+        (accession, sequence, members) of each new cluster, where `members`
+        does not include the representative
+    """
+    sequences = {}
+    for accession, sequence in newcomers:
+        sequences.setdefault(accession, sequence)
+    if len(sequences) < len(newcomers):
+        log.warning(f"{len(newcomers) - len(sequences)} repeated accessions"
+                    " were skipped")
+        newcomers = list(sequences.items())
+    assigned: Dict[int, List[Assignment]] = {}
+    leftover = []
+    if representatives:
+        log.info(f"indexing {len(representatives)} representatives")
+        index = KmerIndex(representatives, k)
+        with ProcessPoolExecutor(max_workers=num_cpu,
+                                 initializer=_init_worker,
+                                 initargs=(index, representatives, identity,
+                                           max_candidates)) as executor:
+            for accession, cluster, pct in bounded_map(
+                    executor, _assign_worker, newcomers,
+                    default_window(num_cpu), len(newcomers),
+                    unit="sequences"):
+                if cluster is None:
+                    leftover.append(accession)
+                    continue
+                if cluster not in assigned:
+                    assigned[cluster] = []
+                assigned[cluster].append(
+                    (accession, len(sequences[accession]), pct))
+    else:
+        leftover = [accession for accession, _ in newcomers]
+    log.info(f"{len(newcomers) - len(leftover)} sequences joined existing"
+             f" clusters, clustering the other {len(leftover)}")
+
+    # the remaining sequences are few, so the index of the new
+    # representatives is a plain dictionary that grows as they are added
+    leftover.sort(key=lambda a: -len(sequences[a]))
+    aligner = make_aligner()
+    new_clusters: List[Tuple[str, str, List[Assignment]]] = []
+    kmer_reps: Dict[int, List[int]] = {}
+    for accession in leftover:
+        sequence = sequences[accession]
+        codes = kmer_codes(sequence, k)
+        shared: Dict[int, int] = {}
+        for code in codes.tolist():
+            for rep in kmer_reps.get(code, []):
+                shared[rep] = shared.get(rep, 0) + 1
+        needed = min_shared_kmers(len(sequence), identity, k, len(codes))
+        candidates = sorted((r for r, n in shared.items() if n >= needed),
+                            key=lambda r: -shared[r])[:max_candidates]
+        for rep in candidates:
+            pct = sequence_identity(aligner, new_clusters[rep][1], sequence)
+            if pct >= identity * 100:
+                new_clusters[rep][2].append((accession, len(sequence), pct))
+                break
+        else:
+            for code in codes.tolist():
+                if code not in kmer_reps:
+                    kmer_reps[code] = []
+                kmer_reps[code].append(len(new_clusters))
+            new_clusters.append((accession, sequence, []))
+    return assigned, new_clusters
+
+
+def _member_line(position: int, member: Assignment) -> str:
+    accession, length, pct = member
+    return f"{position}\t{length}aa, >{accession}... at {pct:.2f}%\n"
+
+
+def write_clusters(clusters_file: Path,
+                   out_file: Path,
+                   assigned: Dict[int, List[Assignment]],
+                   new_clusters: List[Tuple[str, str, List[Assignment]]]):
+    """
+    Writes a `.clstr` file with the clusters of `clusters_file` (their
+    lines are copied verbatim) extended with the `assigned` members,
+    followed by the `new_clusters`.
+    """
+    cluster = -1
+    size = 0
+
+    def flush(of):
+        for j, member in enumerate(assigned.get(cluster, []), start=size):
+            of.write(_member_line(j, member))
+
+    with clusters_file.open() as cf, out_file.open("w") as of:
+        for line in cf:
+            if line.startswith(">Cluster"):
+                flush(of)
+                cluster += 1
+                size = 0
+            else:
+                size += 1
+            of.write(line)
+        flush(of)
+        for i, (accession, sequence, members) in enumerate(new_clusters):
+            of.write(f">Cluster {cluster + 1 + i}\n")
+            of.write(f"0\t{len(sequence)}aa, >{accession}... *\n")
+            for j, member in enumerate(members, start=1):
+                of.write(_member_line(j, member))
+
+
+def cluster_incremental(clusters_file: Path,
+                        representatives_file: Path,
+                        new_sequences_file: Path,
+                        output: Path,
+                        identity: float = 0.6,
+                        k: int = 4,
+                        max_candidates: int = 10,
+                        num_cpu: Optional[int] = None):
+    """
+    Updates a CD-HIT clustering with new sequences instead of reclustering
+    everything (see `assign_to_clusters`).
+
+    Like CD-HIT's `-o`, writes the representative sequences to `output`
+    (the existing ones followed by the new ones) and the clusters to
+    `<output>.clstr`, so the result can be updated again later.
+
+    Parameters
+    ----------
+    clusters_file : Path
+        Existing `.clstr` file
+    representatives_file : Path
+        Sequences of the existing representatives (the `-o` FASTA file of
+        CD-HIT)
+    new_sequences_file : Path
+        New sequences (FASTA format), the ones that are already clustered
+        are ignored, so this may be the whole updated sequence file
+    output : Path
+        Path of the updated representatives, the clusters are written to
+        `<output>.clstr`
+    """
+    assert 0 < identity <= 1, "the identity threshold must be in (0, 1]"
+    clusters = ClusterIndex(clusters_file)
+    rep_names = [clusters.representative_of(i) for i in range(len(clusters))]
+    wanted = set(rep_names)
+    rep_sequences = {}
+    for header, sequence in iter_fasta(representatives_file):
+        accession = header.split()[0]
+        if accession in wanted:
+            rep_sequences[accession] = sequence
+    missing = wanted - rep_sequences.keys()
+    if missing:
+        log.warning(f"{len(missing)} representatives are not in"
+                    f" {representatives_file}, their clusters will not"
+                    " receive new members")
+    # clusters without a sequence get an empty one, which never matches
+    representatives = [rep_sequences.get(r, "") for r in rep_names]
+
+    clustered = set(clusters.names.tolist())
+    newcomers = []
+    skipped = 0
+    for header, sequence in iter_fasta(new_sequences_file):
+        accession = header.split()[0]
+        if accession.encode() in clustered:
+            skipped += 1
+        elif sequence:
+            newcomers.append((accession, sequence))
+    if skipped:
+        log.info(f"{skipped} sequences of {new_sequences_file} are already"
+                 " clustered, skipping them")
+    log.info(f"{len(newcomers)} new sequences to cluster")
+
+    assigned, new_clusters = assign_to_clusters(newcomers, representatives,
+                                                identity, k, max_candidates,
+                                                num_cpu)
+
+    out_clusters = Path(f"{output}.clstr")
+    tmp_clusters = out_clusters.with_name(f"{out_clusters.name}.tmp")
+    write_clusters(clusters_file, tmp_clusters, assigned, new_clusters)
+    tmp_output = output.with_name(f"{output.name}.tmp")
+    with tmp_output.open("w") as of:
+        with representatives_file.open() as rf:
+            shutil.copyfileobj(rf, of)
+        for accession, sequence, _ in new_clusters:
+            of.write(f">{accession}\n{sequence}\n")
+    os.replace(tmp_output, output)
+    os.replace(tmp_clusters, out_clusters)
+    log.info(f"{sum(len(m) for m in assigned.values())} sequences added to"
+             f" existing clusters, {len(new_clusters)} new clusters written"
+             f" to {out_clusters}")
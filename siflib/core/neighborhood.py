@@ -1,23 +1,171 @@
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from typing import Optional, Dict, Tuple
-from siflib.io.parsers import parse_ska_db, parse_cdhit_clusters
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Optional, Dict, Iterable, List, Tuple, Union
+from siflib.io.cluster_index import ClusterIndex
+from siflib.io.parsers import parse_ska_scores, parse_ecod_mapping
+from siflib.core.scheduler import bounded_map, default_window
+from siflib.io.mapping_index import write_mapping_index
+from siflib.io.pdb_resolver import PDBResolver
+import numpy as np
 import logging
 import queue
 import threading
 log = logging.getLogger(__name__)
 
 
+class MinPSDAggregator:
+    """
+    Array-backed aggregation of the minimum PSD between targets and cluster
+    representatives.
+
+    Targets and subjects (PDB chains) are interned to integer IDs, and hits
+    are kept as (target_id, subject_id, psd) arrays. Hits to ECOD domains
+    are expanded to the chains containing them through a CSR mapping
+    (domain_id -> chain subject IDs), and the minimum PSD per
+    (target, subject) pair is computed with a single grouped min.
+
+    Parameters
+    ----------
+    ecod_mapping : Dict
+        ECOD domain to list of chains, as returned by `parse_ecod_mapping`
+    """
+
+    def __init__(self, ecod_mapping: Dict[str, List[str]]):
+        self.target_names = []
+        self.target_ids = {}
+        self.subject_names = []
+        self.subject_ids = {}
+        self.domain_ids = {}
+        indptr = [0]
+        indices = []
+        for domain, chains in ecod_mapping.items():
+            self.domain_ids[domain] = len(self.domain_ids)
+            indices.extend(self._intern_subject(c) for c in chains)
+            indptr.append(len(indices))
+        self.domain_indptr = np.array(indptr, dtype=np.int64)
+        self.domain_indices = np.array(indices, dtype=np.int64)
+        # chunks of (target_id, subject_id, psd) and
+        # (target_id, domain_id, psd) arrays
+        self._hits = []
+        self._domain_hits = []
+
+    def _intern_subject(self, subject: str) -> int:
+        subject_id = self.subject_ids.get(subject)
+        if subject_id is None:
+            subject_id = len(self.subject_names)
+            self.subject_ids[subject] = subject_id
+            self.subject_names.append(subject)
+        return subject_id
+
+    def add(self,
+            target: str,
+            subjects: List[str],
+            psds: List[float],
+            domains: List[str],
+            domain_psds: List[float]) -> None:
+        """
+        Adds the hits of `target` to chains (`subjects`) and to ECOD domains
+        (`domains`). Domains missing from the ECOD mapping are ignored.
+        """
+        target_id = self.target_ids.get(target)
+        if target_id is None:
+            target_id = len(self.target_names)
+            self.target_ids[target] = target_id
+            self.target_names.append(target)
+        if subjects:
+            subject_ids = np.fromiter(
+                (self._intern_subject(s) for s in subjects),
+                dtype=np.int64, count=len(subjects))
+            self._hits.append((np.full(len(subjects), target_id),
+                               subject_ids,
+                               np.asarray(psds, dtype=np.float64)))
+        if domains:
+            domain_ids = np.fromiter(
+                (self.domain_ids.get(d, -1) for d in domains),
+                dtype=np.int64, count=len(domains))
+            known = domain_ids >= 0
+            self._domain_hits.append(
+                (np.full(known.sum(), target_id),
+                 domain_ids[known],
+                 np.asarray(domain_psds, dtype=np.float64)[known]))
+
+    def _expand_domain_hits(self) -> Tuple[np.ndarray, ...]:
+        target_ids, domain_ids, psds = self._concat(self._domain_hits)
+        starts = self.domain_indptr[domain_ids]
+        counts = self.domain_indptr[domain_ids + 1] - starts
+        total = counts.sum()
+        # position of each expanded hit inside its domain's chain list
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts,
+                                               counts)
+        subject_ids = self.domain_indices[np.repeat(starts, counts) + offsets]
+        return (np.repeat(target_ids, counts), subject_ids,
+                np.repeat(psds, counts))
+
+    @staticmethod
+    def _concat(chunks) -> Tuple[np.ndarray, ...]:
+        if not chunks:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                    np.empty(0, dtype=np.float64))
+        return tuple(np.concatenate(column) for column in zip(*chunks))
+
+    def result(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns
+        -------
+        np.ndarray
+            target IDs, indices into `target_names`
+        np.ndarray
+            subject IDs, indices into `subject_names`
+        np.ndarray
+            minimum PSD for each (target, subject) pair
+
+        Pairs are sorted by target ID, then subject ID.
+        """
+        chain_hits = self._concat(self._hits)
+        domain_hits = self._expand_domain_hits()
+        target_ids, subject_ids, psds = (
+            np.concatenate([c, d]) for c, d in zip(chain_hits, domain_hits))
+        keys = target_ids * len(self.subject_names) + subject_ids
+        order = np.lexsort((psds, keys))
+        keys = keys[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        order = order[first]
+        return target_ids[order], subject_ids[order], psds[order]
+
+    def clusters(self) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        Returns the (representative, minimum PSD) pairs of each target.
+        """
+        target_ids, subject_ids, psds = self.result()
+        clusters = {}
+        for t, s, p in zip(target_ids.tolist(), subject_ids.tolist(),
+                           psds.tolist()):
+            target = self.target_names[t]
+            if target not in clusters:
+                clusters[target] = []
+            clusters[target].append((self.subject_names[s], p))
+        return clusters
+
+    def write(self, output_file: Path) -> None:
+        target_ids, subject_ids, psds = self.result()
+        targets = np.array(self.target_names, dtype=object)[target_ids]
+        subjects = np.array(self.subject_names, dtype=object)[subject_ids]
+        with output_file.open("w") as of:
+            of.write("target\trepresentative\tscore\n")
+            of.writelines(f"{t}\t{s}\t{p}\n" for t, s, p in
+                          zip(targets, subjects, psds.tolist()))
+
+
 def _get_neighboorhood_clusters_worker(target: str,
                                        ska_file: Path,
                                        domain_file: Path,
-                                       ecod_mapping_file: Path,
                                        psd_threshold: float,
-                                       ) -> Tuple[str, Dict[str, float]]:
+                                       ) -> Tuple[str, List[str], List[float],
+                                                  List[str], List[float]]:
     """
-    returns a list of cluster representatives that match to the target with
-    a PSD <= `psd_threshold` either directly or through one of the component
-    ECOD domains.
+    returns the cluster representatives and ECOD domains that match to the
+    target with a PSD <= `psd_threshold`.
 
 
     Parameters
@@ -28,8 +176,6 @@ def _get_neighboorhood_clusters_worker(target: str,
         Path to the SKA-db result file
     domain_file: Path
         Path to the domain SKA-db result file
-    ecod_mapping_file: Path
-        Path to the ECOD `domain.txt` files
     psd_threshold : float, optional
         if provided, only PSD values below this threshold will be included in
         the result.
@@ -38,47 +184,120 @@ def _get_neighboorhood_clusters_worker(target: str,
     -------
     str
         `target`
-    Dict
-        Keys are subjects found in `ska_file`, and the value is the minimum
-        PSD found to it or one of its domains.
+    List
+        subjects found in `ska_file`
+    List
+        PSD of each subject
+    List
+        ECOD domains found in `domain_file`
+    List
+        PSD of each domain
+
+    Note
+    ----
+    Hits are aggregated and domains mapped to their chains by
+    `MinPSDAggregator`.
     """
-    results = {}
-    # domain to list of chains
-    ecod_mapping = {}
+    ska_scores = parse_ska_scores(ska_file,
+                                  psd_threshold=psd_threshold)
+    ska_domain_scores = parse_ska_scores(domain_file,
+                                         psd_threshold=psd_threshold)
 
-    with ecod_mapping_file.open() as emf:
-        for line in emf:
-            if line.startswith("#"):
-                continue
-            pdb_chain, _, ecod_domain_id, _ = line.strip().split("\t")
-            if ecod_domain_id not in ecod_mapping:
-                ecod_mapping[ecod_domain_id] = []
-            ecod_mapping[ecod_domain_id].append(pdb_chain)
-    ska_matches = parse_ska_db(ska_file,
-                               psd_threshold=psd_threshold)
-    ska_domain_matches = parse_ska_db(domain_file,
-                                      psd_threshold=psd_threshold)
-
-    if target in ska_matches:
-        # from the full mapping, representatives are added directly
-        for subject, scores in ska_matches[target].items():
-            if subject not in results:
-                results[subject] = scores["PSD"]
-            results[subject] = min(results[subject], scores["PSD"])
-    else:
+    subjects = []
+    psds = []
+    for (query, subject), (psd, _) in ska_scores.items():
+        if query == target:
+            subjects.append(subject)
+            psds.append(psd)
+    if not subjects:
         log.info(f"{target} not found in ska_matches")
 
-    if target in ska_domain_matches:
-        # from the domain mapping, representatives need checked in the mapping
-        for domain, scores in ska_domain_matches.items():
-            subjects = ecod_mapping.get(domain, [])
-            for subject in subjects:
-                if subject not in results:
-                    results[subject] = scores["PSD"]
-                results[subject] = min(results[subject], scores["PSD"])
-    else:
+    domains = []
+    domain_psds = []
+    for (query, domain), (psd, _) in ska_domain_scores.items():
+        if query == target:
+            domains.append(domain)
+            domain_psds.append(psd)
+    if not domains:
         log.info(f"{target} not found in ska_domain_matches")
-    return target, results
+    return target, subjects, psds, domains, domain_psds
+
+
+def compute_neighborhood_clusters(targets: Iterable[Tuple[str, Path, Path]],
+                                  ecod_mapping: Dict[str, List[str]],
+                                  psd_threshold: float,
+                                  num_cpu: Optional[int] = None,
+                                  max_in_flight: Optional[int] = None,
+                                  executor: Optional[Executor] = None,
+                                  total: Optional[int] = None,
+                                  ) -> MinPSDAggregator:
+    """
+    Aggregates the minimum PSD between each target and the cluster
+    representatives in memory, without writing any file.
+
+    Parameters
+    ----------
+    targets : Iterable[Tuple[str, Path, Path]]
+        (target, ska_file, domain_file) of each target
+    ecod_mapping : Dict[str, List[str]]
+        ECOD domain to list of chains, as returned by `parse_ecod_mapping`
+    psd_threshold : float
+        SKA PSD cutoff
+    num_cpu : int, optional
+        Number of workers of the pool, all cores if None
+    max_in_flight : int, optional
+        Maximum number of targets submitted and not gathered yet
+    executor : Executor, optional
+        Pool to run the targets in. If None, a process pool is created for
+        this call
+    total : int, optional
+        Number of targets, only used to report progress
+
+    Returns
+    -------
+    MinPSDAggregator
+        The aggregated hits, see `MinPSDAggregator.clusters` and
+        `MinPSDAggregator.write`
+    """
+    assert psd_threshold > 0, "the PSD cutoff must be positive"
+    aggregator = MinPSDAggregator(ecod_mapping)
+
+    results_queue = queue.Queue()
+
+    def gatherer_worker():
+        while True:
+            result = results_queue.get()
+            if result is None:
+                break
+            aggregator.add(*result)
+            results_queue.task_done()
+
+    gatherer_thread = threading.Thread(target=gatherer_worker)
+    gatherer_thread.start()
+
+    # TODO(mateo): make this into an argument if useful
+    batch_size = 1000
+    if max_in_flight is None:
+        max_in_flight = default_window(num_cpu)
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=num_cpu)
+    try:
+        log.info("Gathering results in parallel...")
+        tasks = ((target, ska_file, domain_file, psd_threshold)
+                 for target, ska_file, domain_file in targets)
+        for result in bounded_map(executor,
+                                  _get_neighboorhood_clusters_worker,
+                                  tasks, max_in_flight, total, batch_size,
+                                  "targets"):
+            results_queue.put(result)
+    finally:
+        if own_executor:
+            executor.shutdown()
+        log.info("Submitting sentinel to queue...")
+        results_queue.put(None)
+        gatherer_thread.join()
+    return aggregator
 
 
 def get_neighborhood_clusters(targets_file: Path,
@@ -87,7 +306,8 @@ def get_neighborhood_clusters(targets_file: Path,
                               ecod_mapping_file: Path,
                               output_file: Path,
                               psd_threshold: float,
-                              num_cpu: Optional[int] = None):
+                              num_cpu: Optional[int] = None,
+                              max_in_flight: Optional[int] = None):
     assert targets_file.is_file(), "The target file must be a file"
     assert ska_directory.is_dir(), "The SKA db is not a directory"
     assert ska_domains_dir.is_dir(), "The SKA domains db is not a directory"
@@ -109,69 +329,35 @@ def get_neighborhood_clusters(targets_file: Path,
     total = len(targets)
     log.info(f"Checking {total} targets")
 
-    results = {}
-    results_queue = queue.Queue()
-
-    def gatherer_worker():
-        while True:
-            target, data = results_queue.get()
-            if target is None and data is None:
-                break
-            results[target] = data
-            results_queue.task_done()
-
-    gatherer_thread = threading.Thread(target=gatherer_worker)
-    gatherer_thread.start()
-
-    # TODO(mateo): make this into an argument if useful
-    batch_size = 1000
-    with ProcessPoolExecutor(max_workers=num_cpu) as executor:
-        futures = []
-        for i, (target, ska_file, domain_file) in enumerate(targets, start=1):
-            futures.append(
-                executor.submit(_get_neighboorhood_clusters_worker,
-                                target, ska_file, domain_file,
-                                ecod_mapping_file, psd_threshold)
-            )
-            if i % batch_size == 0 or i == total:
-                log.info(f"submitted {i} jobs {i/total*100:.2f}%")
-        log.info("Gathering results in parallel...")
-        gathered = 0
-        for future in as_completed(futures):
-            results_queue.put(future.result())
-            gathered += 1
-            if gathered % batch_size == 0 or gathered == total:
-                log.info(f"gathered {gathered} jobs {gathered/total*100:.2f}%")
-    log.info("Submitting sentinel to queue...")
-    results_queue.put((None, None))
-    gatherer_thread.join()
+    log.info(f"Reading ECOD mapping from {ecod_mapping_file}")
+    ecod_mapping = parse_ecod_mapping(ecod_mapping_file)
+    aggregator = compute_neighborhood_clusters(targets, ecod_mapping,
+                                               psd_threshold, num_cpu,
+                                               max_in_flight, total=total)
 
     log.info(f"Writing results to {output_file}")
-    with output_file.open("w") as of:
-        of.write("target\trepresentative\tscore\n")
-        for target, data in results.items():
-            for representative, score in data.items():
-                of.write(f"{target}\t{representative}\t{score}\n")
+    aggregator.write(output_file)
     log.info("Done")
 
 
-def expand_neighborhood_clusters(target_to_reps_file: Path,
-                                 clusters_file: Path,
-                                 pdb_dir: Path,
-                                 ska_output_file: Path,
-                                 mapping_output_file: Path):
-    assert target_to_reps_file.is_file()
-    assert clusters_file.is_file()
-    log.info(f"reading clusters from: {clusters_file}")
-    clusters = parse_cdhit_clusters(clusters_file)
-    log.info("changing cluster dictionary")
-    clustermap = {}
-    for key, data in clusters.items():
-        clustermap[data["representative"]] = data["members"]
+def cluster_members(clusters_file: Path,
+                    cache_dir: Optional[Path] = None) -> ClusterIndex:
+    """
+    Maps each representative in a CD-HIT cluster file to the accessions of
+    the members of its cluster (including itself), through the cached
+    `ClusterIndex` of the file (kept in `cache_dir` if given).
+    """
+    log.info(f"loading the cluster index of: {clusters_file}")
+    return ClusterIndex(clusters_file, cache_dir)
+
+
+def read_target_to_reps(target_to_reps_file: Path) -> Dict[str, List[str]]:
+    """
+    Reads the output of `get_neighborhood_clusters` into a dictionary that
+    maps each target to its cluster representatives.
+    """
     log.info(f"reading query -> cluster map from: {target_to_reps_file}")
     target_to_reps = {}
-    # this will be used for the ska-db file, and mapped to entries in `pdb_dir`
-    mapped_members = set()
     with target_to_reps_file.open() as ttr:
         header = True
         for line in ttr:
@@ -187,17 +373,100 @@ def expand_neighborhood_clusters(target_to_reps_file: Path,
             if query not in target_to_reps:
                 target_to_reps[query] = []
             target_to_reps[query].append(representative)
-    with mapping_output_file.open("w") as mof:
-        mof.write("query\tcluster member\n")
-        for query, representatives in target_to_reps.items():
-            for r in representatives:
-                for member in clustermap[r]:
-                    mapped_members.add(member["accession"])
-                    mof.write(f'{query}\t{member["accession"]}\n')
+    return target_to_reps
+
+
+def expand_clusters(target_to_reps: Dict[str, List[str]],
+                    clustermap: Union[ClusterIndex, Dict[str, List[str]]],
+                    ) -> Dict[str, List[str]]:
+    """
+    Maps each target to the members of the clusters of its representatives.
+
+    Parameters
+    ----------
+    target_to_reps : Dict[str, List[str]]
+        Representatives of each target, see `read_target_to_reps`
+    clustermap : ClusterIndex or Dict[str, List[str]]
+        Members of each representative, see `cluster_members`
+
+    Returns
+    -------
+    Dict[str, List[str]]
+        Cluster members of each target, in the order of `target_to_reps`
+    """
+    return {query: [m for r in representatives for m in clustermap[r]]
+            for query, representatives in target_to_reps.items()}
+
+
+def resolve_members(members: Iterable[str],
+                    pdb_dir: Path,
+                    pdb_index: Optional[Path] = None) -> Dict[str, Path]:
+    """
+    Resolves cluster members (`<pdb_id>_<chain>`) to their files in the PDB
+    mirror `pdb_dir`. Members without a file are left out with a warning.
+    """
+    members = set(members)
     # /share/yu/resources/PDB-2024-01/0m/pdb10mh_A.pdb
+    resolver = PDBResolver(pdb_dir, pdb_index,
+                           subdirs={m[1:3] for m in members})
+    paths = {}
+    missing = 0
+    for member in sorted(members):
+        fname = resolver.path(member)
+        if fname is None:
+            log.warning(f"Couldn't find a PDB file for {member}")
+            missing += 1
+            continue
+        paths[member] = fname
+    if missing:
+        log.warning(f"{missing} cluster members without a PDB file were"
+                    " left out of the database")
+    return paths
+
+
+def write_expanded_mapping(target_to_members: Dict[str, List[str]],
+                           mapping_output_file: Path):
+    """
+    Writes the `query\tcluster member` mapping used by `ska-db-map`, along
+    with its offset index.
+    """
+    # byte offsets of the rows of each query, used to index the mapping
+    offsets = {}
+    with mapping_output_file.open("wb") as mof:
+        position = mof.write(b"query\tcluster member\n")
+        for query, members in target_to_members.items():
+            start = position
+            for member in members:
+                position += mof.write(f'{query}\t{member}\n'.encode())
+            offsets[query] = (start, position)
+    write_mapping_index(mapping_output_file, offsets)
+
+
+def write_ska_database(member_paths: Dict[str, Path], ska_output_file: Path):
+    """
+    Writes a `ska-db` database file, one `member path` line per member.
+    """
     with ska_output_file.open("w") as sof:
-        for member in sorted(mapped_members):
-            sub_dir = member[1:3]
-            fname = pdb_dir / sub_dir / f"pdb{member}.pdb"
+        for member, fname in member_paths.items():
             sof.write(f"{member}\t{fname}\n")
+
+
+def expand_neighborhood_clusters(target_to_reps_file: Path,
+                                 clusters_file: Path,
+                                 pdb_dir: Path,
+                                 ska_output_file: Path,
+                                 mapping_output_file: Path,
+                                 pdb_index: Optional[Path] = None,
+                                 cache_dir: Optional[Path] = None):
+    assert target_to_reps_file.is_file()
+    assert clusters_file.is_file()
+    clustermap = cluster_members(clusters_file, cache_dir)
+    target_to_reps = read_target_to_reps(target_to_reps_file)
+    target_to_members = expand_clusters(target_to_reps, clustermap)
+    write_expanded_mapping(target_to_members, mapping_output_file)
+    # this will be used for the ska-db file, and mapped to entries in `pdb_dir`
+    mapped_members = {m for members in target_to_members.values()
+                      for m in members}
+    write_ska_database(resolve_members(mapped_members, pdb_dir, pdb_index),
+                       ska_output_file)
     log.info("Done")
@@ -0,0 +1,504 @@
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+from siflib.io.cdd_search import CDD_ARGS, run_cdd_search
+from siflib.io.parsers import iter_cdd_blocks, parse_fasta
+import hashlib
+import json
+import logging
+import os
+import shlex
+import subprocess
+
+
+log = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+# unit name of the stages that are not split per target
+WHOLE = "all"
+STAGES = ["cdd-search",
+          "extract-domains",
+          "cdhit",
+          "ska-db",
+          "ska-db-domains",
+          "neighborhood-clusters",
+          "expand-clusters"]
+# arguments passed to CD-HIT, same as in `scripts/cluster-pdb.sh`
+CDHIT_ARGS = ["-c", "0.6", "-n", "4", "-d", "0"]
+
+
+def text_digest(*parts: Optional[str]) -> str:
+    """
+    Returns the sha256 of `parts`, separated so that ("ab", "c") and
+    ("a", "bc") have different digests.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def file_digest(path: Path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Content hashes of the inputs and outputs of every pipeline stage, for
+    each unit of work (a target, or "all" for stages that run as a whole),
+    persisted as JSON in `path`.
+
+    File digests are cached by (size, mtime), so files that did not change
+    since the last run are not hashed again.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        # resolved path -> [size, mtime_ns, sha256]
+        self.files: Dict[str, List] = {}
+        # stage -> unit -> {"inputs": digest, "outputs": digest}
+        self.stages: Dict[str, Dict[str, Dict[str, str]]] = {}
+        if path.is_file():
+            with path.open() as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.files = data["files"]
+                self.stages = data["stages"]
+            else:
+                log.warning(f"{path} has an unknown format, ignoring it")
+
+    def digest(self, path: Path) -> Optional[str]:
+        """
+        Returns the sha256 of the contents of `path`, or None if it does not
+        exist.
+        """
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        key = str(path.resolve())
+        cached = self.files.get(key)
+        if cached is not None and cached[0] == st.st_size \
+                and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        digest = file_digest(path)
+        self.files[key] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def unit(self, stage: str, unit: str) -> Optional[Dict[str, str]]:
+        return self.stages.get(stage, {}).get(unit)
+
+    def is_current(self,
+                   stage: str,
+                   unit: str,
+                   inputs: str,
+                   outputs: Optional[str]) -> bool:
+        """
+        True if `unit` was computed from `inputs` and its outputs were not
+        modified or removed since.
+        """
+        record = self.unit(stage, unit)
+        return outputs is not None and record is not None \
+            and record["inputs"] == inputs and record["outputs"] == outputs
+
+    def record(self, stage: str, unit: str, inputs: str, outputs: str):
+        self.stages.setdefault(stage, {})[unit] = {"inputs": inputs,
+                                                   "outputs": outputs}
+
+    def prune(self, stage: str, units: Iterable[str]):
+        """
+        Forgets the units of `stage` that are not in `units`.
+        """
+        keep = set(units)
+        records = self.stages.get(stage, {})
+        for unit in [u for u in records if u not in keep]:
+            del records[unit]
+
+    def save(self):
+        tmp_file = self.path.with_name(f"{self.path.name}.tmp")
+        with tmp_file.open("w") as f:
+            json.dump({"version": MANIFEST_VERSION,
+                       "files": self.files,
+                       "stages": self.stages}, f)
+        os.replace(tmp_file, self.path)
+
+
+class Pipeline:
+    """
+    Runs the pipeline stages in `STAGES` (the steps of `main.sh`) with the
+    files and binaries configured in the `.env` file, recomputing only what
+    changed since the last run.
+
+    A `Manifest` in `PIPELINE_DIR` records, per stage, the content hashes of
+    the inputs and outputs of each unit of work. Per-target stages
+    (`cdd-search`, `ska-db`, `ska-db-domains` and `neighborhood-clusters`)
+    only recompute the targets whose inputs changed and merge them with the
+    previous results, the other stages are rerun as a whole when any of
+    their inputs changed. Since the outputs of a stage are the inputs of
+    the next ones, changes propagate downstream.
+
+    Parameters
+    ----------
+    config : Dict[str, Optional[str]]
+        Configuration variables, see `dot.env.example`
+    num_cpu : int, optional
+        Number of cores to use, all if None
+    force : bool, default False
+        If true, every unit of the selected stages is recomputed
+    dry_run : bool, default False
+        If true, only report what would be recomputed. Stages are checked
+        against the files currently on disk, so changes that would
+        propagate from upstream stages are not reported
+    """
+
+    def __init__(self,
+                 config: Dict[str, Optional[str]],
+                 num_cpu: Optional[int] = None,
+                 force: bool = False,
+                 dry_run: bool = False):
+        self.config = config
+        self.num_cpu = num_cpu
+        self.force = force
+        self.dry_run = dry_run
+        self.work_dir = self.path("PIPELINE_DIR")
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest = Manifest(self.work_dir / "manifest.json")
+        self.stages: Dict[str, Callable[[], None]] = {
+            "cdd-search": self.cdd_search,
+            "extract-domains": self.extract_domains,
+            "cdhit": self.cdhit,
+            "ska-db": lambda: self.ska_db("ska-db", "SKA_DATABASE",
+                                          "SKA_DIR"),
+            "ska-db-domains": lambda: self.ska_db("ska-db-domains",
+                                                  "SKA_DOMAIN_DATABASE",
+                                                  "SKA_DOMAIN_DIR"),
+            "neighborhood-clusters": self.neighborhood_clusters,
+            "expand-clusters": self.expand_clusters,
+        }
+
+    def value(self, key: str) -> str:
+        value = self.config.get(key)
+        if not value:
+            raise KeyError(f"{key} is not set in the configuration file")
+        return value
+
+    def path(self, key: str) -> Path:
+        return Path(self.value(key))
+
+    def run(self, stages: Optional[Iterable[str]] = None):
+        """
+        Runs `stages` (all of them if None) in pipeline order.
+        """
+        selected = set(STAGES if stages is None else stages)
+        unknown = selected - set(STAGES)
+        if unknown:
+            raise ValueError(f"unknown stages: {', '.join(sorted(unknown))}"
+                             f" (expected one of {', '.join(STAGES)})")
+        for stage in STAGES:
+            if stage not in selected:
+                continue
+            log.info(f"stage {stage}")
+            self.stages[stage]()
+            if not self.dry_run:
+                self.manifest.save()
+
+    def _stale(self,
+               stage: str,
+               inputs: Dict[str, str],
+               outputs: Dict[str, Optional[str]]) -> List[str]:
+        """
+        Returns the units of `stage` that must be recomputed, and forgets
+        the units that are no longer part of it.
+        """
+        self.manifest.prune(stage, inputs)
+        if self.force:
+            stale = list(inputs)
+        else:
+            stale = [unit for unit, digest in inputs.items()
+                     if not self.manifest.is_current(stage, unit, digest,
+                                                     outputs[unit])]
+        log.info(f"{stage}: {len(stale)} of {len(inputs)} to recompute")
+        return stale
+
+    def _outputs_digest(self, outputs: List[Path]) -> Optional[str]:
+        digests = [self.manifest.digest(p) for p in outputs]
+        if None in digests:
+            return None
+        return text_digest(*digests)
+
+    def _run_whole(self,
+                   stage: str,
+                   params: List[str],
+                   inputs: List[Path],
+                   outputs: List[Path],
+                   fn: Callable[[], None]):
+        """
+        Runs `fn` if the `params`, `inputs` or `outputs` of a stage that is
+        not split per target changed.
+        """
+        digests = [self.manifest.digest(p) for p in inputs]
+        missing = [str(p) for p, d in zip(inputs, digests) if d is None]
+        if missing:
+            if self.dry_run:
+                log.info(f"{stage}: missing inputs {', '.join(missing)}")
+                return
+            raise FileNotFoundError(f"{stage}: missing inputs"
+                                    f" {', '.join(missing)}")
+        input_digest = text_digest(*params, *digests)
+        stale = self._stale(stage, {WHOLE: input_digest},
+                            {WHOLE: self._outputs_digest(outputs)})
+        if not stale or self.dry_run:
+            return
+        fn()
+        self.manifest.record(stage, WHOLE, input_digest,
+                             self._outputs_digest(outputs))
+
+    def _run_tool(self, key: str, args: List[str],
+                  stdout_file: Optional[Path] = None):
+        argv = shlex.split(self.value(key)) + args
+        log.info(f"running {' '.join(argv)}")
+        if stdout_file is None:
+            subprocess.run(argv, check=True)
+            return
+        with stdout_file.open("w") as out:
+            subprocess.run(argv, stdout=out, check=True)
+
+    def _targets(self) -> Dict[str, str]:
+        from siflib.io.ska_wrapper import read_structure_list
+        return read_structure_list(self.path("TARGET_STRUCTURES"))
+
+    def cdd_search(self):
+        """
+        Searches CDD for the sequences of `INPUT_FASTA` whose sequence
+        changed, and merges the new blocks into `CDD_RESULT`.
+        """
+        stage = "cdd-search"
+        fasta_file = self.path("INPUT_FASTA")
+        result_file = self.path("CDD_RESULT")
+        params = text_digest(self.value("CDD_BIN"), self.value("CDD_DB"),
+                             *CDD_ARGS)
+        sequences = parse_fasta(fasta_file, uniprot_header=False,
+                                skip_metadata=True)
+        inputs = {acc: text_digest(params, seq["sequence"])
+                  for acc, seq in sequences.items()}
+        blocks = {}
+        if result_file.is_file():
+            blocks = dict(iter_cdd_blocks(result_file))
+        outputs = {acc: text_digest(blocks[acc]) if acc in blocks else None
+                   for acc in inputs}
+        stale = self._stale(stage, inputs, outputs)
+        if self.dry_run or (not stale and blocks.keys() == inputs.keys()):
+            return
+        if stale:
+            query_file = self.work_dir / "cdd-search.fasta"
+            with query_file.open("w") as qf:
+                for acc in stale:
+                    qf.write(f">{acc}\n{sequences[acc]['sequence']}\n")
+            out_file = self.work_dir / "cdd-search.out"
+            run_cdd_search(query_file, out_file, self.value("CDD_BIN"),
+                           self.value("CDD_DB"), self.num_cpu,
+                           work_dir=self.work_dir / "cdd-search")
+            blocks.update(iter_cdd_blocks(out_file))
+        # blocks are written in the order of `INPUT_FASTA`, and the blocks
+        # of targets that were removed from it are dropped
+        tmp_file = result_file.with_name(f"{result_file.name}.tmp")
+        with tmp_file.open("w") as of:
+            for acc in inputs:
+                if acc not in blocks:
+                    log.error(f"no CDD search result for {acc}")
+                    continue
+                of.write(blocks[acc])
+            of.write(f"# BLAST processed {len(inputs)} queries\n")
+        os.replace(tmp_file, result_file)
+        for acc in stale:
+            if acc in blocks:
+                self.manifest.record(stage, acc, inputs[acc],
+                                     text_digest(blocks[acc]))
+
+    def extract_domains(self):
+        from siflib.io.extract_domains import extract_domains
+        result_file = self.path("CDD_RESULT")
+        fasta_file = self.path("INPUT_FASTA")
+        domains_file = self.path("CALCULATED_DOMAINS")
+        # `cdd_search` writes the results in the order of `INPUT_FASTA`, so
+        # both files can be streamed in lockstep
+        self._run_whole("extract-domains", [],
+                        [result_file, fasta_file], [domains_file],
+                        lambda: extract_domains(result_file, fasta_file,
+                                                domains_file, stream=True))
+
+    def cdhit(self):
+        sequences_file = self.path("PDB_SEQUENCES_FILTERED")
+        clusters = self.path("CDHIT_CLUSTERS")
+        self._run_whole("cdhit", [self.value("CDHIT_BIN"), *CDHIT_ARGS],
+                        [sequences_file],
+                        [clusters, Path(f"{clusters}.clstr")],
+                        lambda: self._run_tool("CDHIT_BIN",
+                                               ["-i", str(sequences_file),
+                                                "-o", str(clusters),
+                                                *CDHIT_ARGS]))
+
+    def ska_db(self, stage: str, database_key: str, output_key: str):
+        """
+        Aligns the targets of `TARGET_STRUCTURES` whose structure, or the
+        database in `database_key`, changed. Results are written to the
+        directory in `output_key`, as with the `ska-db` command.
+
+        The database digest covers the list file and the contents of every
+        structure in it, so a structure replaced at the same path is
+        detected. Since every target is aligned against the whole
+        database, any change to it recomputes every target.
+
+        Finished `.ska` files that predate the manifest are adopted as they
+        are (unless `force` is set), so an existing run is not recomputed.
+        """
+        from siflib.io.ska_wrapper import align_queries, read_structure_list
+        database_file = self.path(database_key)
+        output_dir = self.path(output_key)
+        list_digest = self.manifest.digest(database_file)
+        if list_digest is None:
+            raise FileNotFoundError(f"{stage}: missing input {database_file}")
+        database = read_structure_list(database_file)
+        # cached by size and mtime, so unchanged structures cost a `stat`
+        database_digest = text_digest(
+            list_digest, *(self.manifest.digest(Path(path))
+                           for _, path in sorted(database.items())))
+        params = text_digest(self.value("SKA_BIN"), self.value("SKA_SUBMAT"),
+                             self.value("SKA_TROLLTOP"), database_digest)
+        targets = self._targets()
+        inputs = {}
+        outputs = {}
+        for target, structure in targets.items():
+            structure_digest = self.manifest.digest(Path(structure))
+            if structure_digest is None:
+                log.warning(f"{stage}: {structure} not found, skipping"
+                            f" {target}")
+                continue
+            inputs[target] = text_digest(params, structure_digest)
+            outputs[target] = None
+            if (output_dir / f"{target}.ska.done").is_file():
+                outputs[target] = self.manifest.digest(
+                    output_dir / f"{target}.ska")
+        stale = self._stale(stage, inputs, outputs)
+        if not self.force:
+            adopted = [t for t in stale if outputs[t] is not None
+                       and self.manifest.unit(stage, t) is None]
+            for target in adopted:
+                self.manifest.record(stage, target, inputs[target],
+                                     outputs[target])
+            if adopted:
+                log.info(f"{stage}: adopted {len(adopted)} existing results")
+            stale = [t for t in stale if t not in set(adopted)]
+        if self.dry_run or not stale:
+            return
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for target in stale:
+            record = self.manifest.unit(stage, target)
+            # a target interrupted with the same inputs resumes from its
+            # checkpoint, anything else starts from scratch
+            resume = not self.force and record is not None \
+                and record["inputs"] == inputs[target]
+            for suffix in (".ska.done", ".ska", ".ska.ckpt"):
+                if suffix != ".ska.done" and resume:
+                    continue
+                (output_dir / f"{target}{suffix}").unlink(missing_ok=True)
+            self.manifest.record(stage, target, inputs[target], None)
+        self.manifest.save()
+        align_queries({t: targets[t] for t in stale},
+                      database,
+                      output_dir,
+                      self.value("SKA_SUBMAT"),
+                      self.value("SKA_TROLLTOP"),
+                      self.value("SKA_BIN"),
+                      num_cpu=self.num_cpu,
+                      stream=True)
+        for target in stale:
+            self.manifest.record(stage, target, inputs[target],
+                                 self.manifest.digest(
+                                     output_dir / f"{target}.ska"))
+
+    def neighborhood_clusters(self):
+        """
+        Recomputes the neighborhood clusters of the targets whose `.ska`
+        files or the ECOD mapping changed, and merges them into
+        `NEIGHBORHOOD_CLUSTERS`.
+        """
+        from siflib.core.neighborhood import get_neighborhood_clusters
+        stage = "neighborhood-clusters"
+        ska_dir = self.path("SKA_DIR")
+        domain_dir = self.path("SKA_DOMAIN_DIR")
+        ecod_mapping = self.path("ECOD_MAPPING")
+        output_file = self.path("NEIGHBORHOOD_CLUSTERS")
+        psd_threshold = self.config.get("PSD_THRESHOLD") or "0.6"
+        params = text_digest(psd_threshold,
+                             self.manifest.digest(ecod_mapping))
+        rows = self._read_rows(output_file)
+        inputs = {}
+        for target in sorted(self._targets()):
+            ska_file = ska_dir / f"{target}.ska"
+            domain_file = domain_dir / f"{target}.ska"
+            if not (ska_file.with_name(f"{target}.ska.done").is_file() and
+                    domain_file.with_name(f"{target}.ska.done").is_file()):
+                log.info(f"{stage}: SKA files for {target} not found,"
+                         " skipping")
+                continue
+            inputs[target] = text_digest(params,
+                                         self.manifest.digest(ska_file),
+                                         self.manifest.digest(domain_file))
+        # targets without neighbors have no rows
+        outputs = {t: text_digest(*rows.get(t, [])) for t in inputs}
+        stale = self._stale(stage, inputs, outputs)
+        if self.dry_run or (not stale and rows.keys() <= inputs.keys()):
+            return
+        if stale:
+            targets_file = self.work_dir / f"{stage}.targets"
+            with targets_file.open("w") as tf:
+                tf.writelines(f"{t}\n" for t in stale)
+            partial_file = self.work_dir / f"{stage}.tsv"
+            get_neighborhood_clusters(targets_file, ska_dir, domain_dir,
+                                      ecod_mapping, partial_file,
+                                      float(psd_threshold), self.num_cpu)
+            new_rows = self._read_rows(partial_file)
+            for target in stale:
+                rows[target] = new_rows.get(target, [])
+        tmp_file = output_file.with_name(f"{output_file.name}.tmp")
+        with tmp_file.open("w") as of:
+            of.write("target\trepresentative\tscore\n")
+            for target in inputs:
+                of.writelines(rows.get(target, []))
+        os.replace(tmp_file, output_file)
+        for target in stale:
+            self.manifest.record(stage, target, inputs[target],
+                                 text_digest(*rows[target]))
+
+    @staticmethod
+    def _read_rows(clusters_file: Path) -> Dict[str, List[str]]:
+        """
+        Reads the rows of a `neighborhood-clusters` output grouped by target.
+        """
+        rows = {}
+        if not clusters_file.is_file():
+            return rows
+        with clusters_file.open() as cf:
+            cf.readline()
+            for line in cf:
+                rows.setdefault(line.split("\t", 1)[0], []).append(line)
+        return rows
+
+    def expand_clusters(self):
+        from siflib.core.neighborhood import expand_neighborhood_clusters
+        clusters_file = self.path("NEIGHBORHOOD_CLUSTERS")
+        cdhit_clusters = Path(f"{self.value('CDHIT_CLUSTERS')}.clstr")
+        pdb_dir = self.path("PDB_DIR")
+        database_file = self.path("EXPANDED_DATABASE")
+        mapping_file = self.path("EXPANDED_MAPPING")
+        self._run_whole("expand-clusters", [str(pdb_dir.resolve())],
+                        [clusters_file, cdhit_clusters],
+                        [database_file, mapping_file],
+                        lambda: expand_neighborhood_clusters(
+                            clusters_file, cdhit_clusters, pdb_dir,
+                            database_file, mapping_file))
@@ -0,0 +1,111 @@
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from datetime import timedelta
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+import logging
+import os
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+def default_window(num_cpu: Optional[int] = None) -> int:
+    """
+    Default number of in-flight tasks: enough to keep `num_cpu` workers
+    busy (all cores if None) while results are being gathered.
+    """
+    return 4 * (num_cpu or os.cpu_count() or 1)
+
+
+class Progress:
+    """
+    Logs the completion throughput and ETA of a parallel stage every
+    `log_every` completed tasks.
+    """
+
+    def __init__(self,
+                 total: Optional[int],
+                 log_every: int = 1000,
+                 unit: str = "jobs"):
+        self.total = total
+        self.log_every = log_every
+        self.unit = unit
+        self.done = 0
+        self.start = time.monotonic()
+
+    def update(self, n: int = 1) -> None:
+        self.done += n
+        if self.done % self.log_every == 0 or self.done == self.total:
+            self.report()
+
+    def report(self) -> None:
+        elapsed = time.monotonic() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        msg = f"gathered {self.done}"
+        if self.total:
+            msg += f"/{self.total} {self.unit}"
+            msg += f" {self.done/self.total*100:.2f}%"
+            if rate > 0:
+                eta = timedelta(seconds=int((self.total - self.done) / rate))
+                msg += f", ETA {eta}"
+        else:
+            msg += f" {self.unit}"
+        log.info(f"{msg} ({rate:.1f} {self.unit}/s)")
+
+
+def bounded_map(executor: Executor,
+                fn: Callable,
+                tasks: Iterable[Tuple],
+                max_in_flight: Optional[int] = None,
+                total: Optional[int] = None,
+                log_every: int = 1000,
+                unit: str = "jobs") -> Iterator[Any]:
+    """
+    Runs `fn(*args)` in `executor` for each `args` in `tasks`, and yields the
+    results as they complete.
+
+    At most `max_in_flight` tasks are pending at any time: new tasks are
+    only taken from `tasks` (which may be a generator) once earlier ones
+    finish. This keeps the workers busy while bounding the memory used by
+    pending futures and their arguments in the parent process.
+
+    Parameters
+    ----------
+    executor : Executor
+        Pool that runs the tasks
+    fn : Callable
+        Function to run, it must be picklable for process pools
+    tasks : Iterable[Tuple]
+        Arguments for each call of `fn`
+    max_in_flight : int, optional
+        Maximum number of pending tasks, see `default_window` for the
+        default
+    total : int, optional
+        Number of tasks, only used to report progress and ETA
+    log_every : int, default 1000
+        Number of completed tasks between progress reports
+    unit : str, default "jobs"
+        Name of the tasks in the progress reports
+
+    Yields
+    ------
+    Any
+        The result of each call, in completion order
+    """
+    if max_in_flight is None:
+        max_in_flight = default_window()
+    progress = Progress(total, log_every, unit)
+    pending = set()
+    for args in tasks:
+        pending.add(executor.submit(fn, *args))
+        if len(pending) < max_in_flight:
+            continue
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+            progress.update()
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+            progress.update()
@@ -1,25 +1,106 @@
-from typing import List, Dict, Tuple
+from typing import List, Dict, Iterable, Optional, Tuple
 from pathlib import Path
+import numpy as np
 import logging
+import os
+import re
 
 
 log = logging.getLogger(__name__)
 
+# characters of aligned sequences that are not residues
+GAPS = np.frombuffer(b"-.", dtype=np.uint8)
+_residue_number_re = re.compile(r"-?\d+")
+
+
+def _residue_indices(sequences: np.ndarray,
+                     owner: np.ndarray,
+                     starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns, for every column of the concatenated `sequences`, whether it
+    is a residue, and the index of that residue in its own (ungapped)
+    sequence.
+    """
+    is_residue = ~np.isin(sequences, GAPS)
+    count = np.concatenate(([0], np.cumsum(is_residue)))
+    # residues of the alignments that precede each column's alignment
+    return is_residue, count[1:] - count[starts][owner] - 1
+
+
+def residue_pairs(seq1s: List[str],
+                  seq2s: List[str],
+                  start1s: Optional[List[int]] = None,
+                  start2s: Optional[List[int]] = None,
+                  ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Converts a batch of gapped alignments to the residue pairs they align.
+
+    Parameters
+    ----------
+    seq1s, seq2s : List[str]
+        Aligned sequences, `seq1s[k]` and `seq2s[k]` must have the same
+        length. "-" and "." are gaps
+    start1s, start2s : List[int], optional
+        Residue number of the first residue of each sequence, 0 if not
+        given
+
+    Returns
+    -------
+    np.ndarray
+        Alignment (index in `seq1s`) of each aligned residue pair
+    np.ndarray
+        Residue number in the first sequence
+    np.ndarray
+        Residue number in the second sequence
+    """
+    lengths = np.fromiter(map(len, seq1s), dtype=np.int64, count=len(seq1s))
+    owner = np.repeat(np.arange(len(seq1s)), lengths)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    s1 = np.frombuffer("".join(seq1s).encode(), dtype=np.uint8)
+    s2 = np.frombuffer("".join(seq2s).encode(), dtype=np.uint8)
+    assert len(s1) == len(s2), "aligned sequences must have the same length"
+    is_residue1, index1 = _residue_indices(s1, owner, starts)
+    is_residue2, index2 = _residue_indices(s2, owner, starts)
+    if start1s is not None:
+        index1 += np.array(start1s, dtype=np.int64)[owner]
+    if start2s is not None:
+        index2 += np.array(start2s, dtype=np.int64)[owner]
+    aligned = is_residue1 & is_residue2
+    return owner[aligned], index1[aligned], index2[aligned]
+
+
+def _pair_keys(owner: np.ndarray,
+               index1: np.ndarray,
+               index2: np.ndarray,
+               lowest: int,
+               size: int) -> np.ndarray:
+    return (owner * size + index1 - lowest) * size + index2 - lowest
+
 
 def evaluate_alignment(ground_truth: List[Tuple],
                        method_alignments: List[Tuple]) -> Dict:
     """
     Evaluates the sensitivity and precision of sequence alingments.
 
+    The residue pairs aligned by every alignment are computed at once with
+    NumPy (see `residue_pairs`). Sensitivity is the fraction of the residue
+    pairs of the ground truth that the method aligns, and precision the
+    fraction of the residue pairs aligned by the method that are in the
+    ground truth, as in Foldseek's HOMSTRAD benchmark. Residues are numbered
+    from the start of each aligned sequence, so alignments that start at
+    different residues (e.g. local and global ones) are compared correctly.
+
     Parameters
     ----------
-    ground_truth: list of 4-tuples
-        tuples are acc1, acc2, seq1, seq2. If len(seq1) != len(seq2), the entry
-        will be ignored
+    ground_truth: list of 6-tuples
+        tuples are acc1, acc2, start1, seq1, start2, seq2, where `start1`
+        and `start2` are the residue numbers (int) of the first residue of
+        `seq1` and `seq2`. If len(seq1) != len(seq2), the entry will be
+        ignored
 
-    method_alignments: list of 4-tuples
-        tuples are acc1, acc2, seq1, seq2. If len(seq1) != len(seq2), the entry
-        will be ignored
+    method_alignments: list of 6-tuples
+        same as `ground_truth`. A method alignment of (acc2, acc1) is used
+        for the ground truth pair (acc1, acc2) if the latter is missing
 
     Returns
     -------
@@ -28,4 +109,133 @@ def evaluate_alignment(ground_truth: List[Tuple],
         {
             ("acc1", "acc2"):(sensitivity, precision),
         }
+        with every valid ground truth pair. Pairs that the method did not
+        align have a sensitivity of 0 and a precision of NaN, and so do
+        pairs for which the method aligns no residues
+    """
+    reference = {(a1, a2): (start1, seq1, start2, seq2)
+                 for a1, a2, start1, seq1, start2, seq2 in ground_truth
+                 if len(seq1) == len(seq2)}
+    predicted = {(a1, a2): (start1, seq1, start2, seq2)
+                 for a1, a2, start1, seq1, start2, seq2 in method_alignments
+                 if len(seq1) == len(seq2)}
+    skipped = sum(len(alignment[3]) != len(alignment[5])
+                  for alignments in (ground_truth, method_alignments)
+                  for alignment in alignments)
+    if skipped:
+        log.warning(f"{skipped} alignments with sequences of different"
+                    " lengths were ignored")
+
+    pairs = list(reference)
+    ids = []
+    method = []
+    for i, (a1, a2) in enumerate(pairs):
+        if (a1, a2) in predicted:
+            alignment = predicted[(a1, a2)]
+        elif (a2, a1) in predicted:
+            start2, seq2, start1, seq1 = predicted[(a2, a1)]
+            alignment = (start1, seq1, start2, seq2)
+        else:
+            continue
+        ids.append(i)
+        method.append(alignment)
+    missing = len(pairs) - len(ids)
+    if missing:
+        log.info(f"{missing} of {len(pairs)} ground truth pairs were not"
+                 " aligned by the method")
+
+    def batch(alignments):
+        columns = list(zip(*alignments)) or [[], [], [], []]
+        start1s, seq1s, start2s, seq2s = columns
+        return residue_pairs(list(seq1s), list(seq2s),
+                             list(start1s), list(start2s))
+
+    ref_owner, ref_index1, ref_index2 = batch(reference[p] for p in pairs)
+    owner, index1, index2 = batch(method)
+    owner = np.array(ids, dtype=np.int64)[owner]
+
+    indices = [ref_index1, ref_index2, index1, index2]
+    lowest = min((int(i.min()) for i in indices if len(i)), default=0)
+    highest = max((int(i.max()) for i in indices if len(i)), default=0)
+    size = highest - lowest + 1
+    correct = np.isin(
+        _pair_keys(owner, index1, index2, lowest, size),
+        _pair_keys(ref_owner, ref_index1, ref_index2, lowest, size),
+        assume_unique=True)
+    n_reference = np.bincount(ref_owner, minlength=len(pairs))
+    n_predicted = np.bincount(owner, minlength=len(pairs))
+    n_correct = np.bincount(owner[correct], minlength=len(pairs))
+    sensitivity = np.divide(n_correct, n_reference,
+                            out=np.zeros(len(pairs)),
+                            where=n_reference > 0)
+    precision = np.divide(n_correct, n_predicted,
+                          out=np.full(len(pairs), np.nan),
+                          where=n_predicted > 0)
+    return {pair: (float(s), float(p))
+            for pair, s, p in zip(pairs, sensitivity, precision)}
+
+
+def summarize_evaluation(results: Dict) -> Dict[str, float]:
+    """
+    Aggregates the output of `evaluate_alignment`: the number of pairs, and
+    the mean sensitivity (over all pairs) and precision (over the pairs
+    with a precision).
+    """
+    values = np.array(list(results.values()), dtype=float).reshape(-1, 2)
+    has_precision = ~np.isnan(values[:, 1])
+    return {
+        "pairs": len(values),
+        "sensitivity": float(values[:, 0].mean()) if len(values) else
+        float("nan"),
+        "precision": float(values[has_precision, 1].mean())
+        if has_precision.any() else float("nan"),
+    }
+
+
+def write_evaluation(results: Dict, output_file: Path):
+    """
+    Writes the output of `evaluate_alignment` to a tab-separated file with
+    the columns acc1, acc2, sensitivity and precision.
+    """
+    tmp_file = output_file.with_name(f"{output_file.name}.tmp")
+    with tmp_file.open("w") as of:
+        of.write("acc1\tacc2\tsensitivity\tprecision\n")
+        for (a1, a2), (sensitivity, precision) in results.items():
+            of.write(f"{a1}\t{a2}\t{sensitivity:.4f}\t{precision:.4f}\n")
+    os.replace(tmp_file, output_file)
+
+
+def residue_number(residue_id: str) -> Optional[int]:
+    """
+    Returns the number of a residue ID as written in structures and
+    alignments (e.g. "12", "-3" or "12A" with an insertion code), or None if
+    it has none.
+    """
+    match = _residue_number_re.match(residue_id.strip())
+    return int(match.group()) if match else None
+
+
+def alignment_tuples(rows: Iterable[Tuple],
+                     method: Optional[str] = None,
+                     ) -> List[Tuple[str, str, int, str, int, str]]:
+    """
+    Converts rows of an alignment file (see
+    `siflib.io.extract_alingments.iter_alignments_file`) to the tuples used
+    by `evaluate_alignment`, keeping only the alignments of `method` if
+    given. Alignments without a residue number in their starts are skipped.
     """
+    tuples = []
+    skipped = 0
+    for a1, a2, m, start1, seq1, start2, seq2 in rows:
+        if method is not None and m != method:
+            continue
+        start1 = residue_number(start1)
+        start2 = residue_number(start2)
+        if start1 is None or start2 is None:
+            skipped += 1
+            continue
+        tuples.append((a1, a2, start1, seq1, start2, seq2))
+    if skipped:
+        log.warning(f"{skipped} alignments without start residues were"
+                    " skipped")
+    return tuples
@@ -0,0 +1,162 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from siflib.core.scheduler import bounded_map
+from siflib.io.parsers import iter_cdd_blocks, iter_fasta
+import logging
+import os
+import shlex
+import subprocess
+import tempfile
+import time
+
+
+log = logging.getLogger(__name__)
+
+# same arguments as `scripts/cdd-search.sh`
+CDD_ARGS = ["-seg", "no", "-comp_based_stats", "1", "-evalue", "0.01",
+            "-outfmt", "7"]
+
+# (header, sequence)
+Record = Tuple[str, str]
+
+
+def shard_records(records: List[Record],
+                  num_shards: int) -> List[List[Record]]:
+    """
+    Splits `records` into at most `num_shards` contiguous shards with about
+    the same number of residues each. Shards keep the order of `records`, so
+    concatenating their results gives the results of the whole input.
+    """
+    # empty sequences count as one residue, so that they are not split into
+    # shards of their own (every record would be one if all were empty)
+    total = sum(max(len(sequence), 1) for _, sequence in records)
+    shards = []
+    current = []
+    residues = 0
+    for record in records:
+        current.append(record)
+        residues += max(len(record[1]), 1)
+        # shard k ends once the cumulative residue count reaches its share
+        if residues * num_shards >= total * (len(shards) + 1):
+            shards.append(current)
+            current = []
+    if current:
+        shards.append(current)
+    return shards
+
+
+def _search_shard(argv: List[str],
+                  shard_file: Path,
+                  out_file: Path,
+                  num_queries: int,
+                  retries: int) -> Path:
+    """
+    Runs `argv` on `shard_file`, retrying up to `retries` times if it fails
+    or its output does not have a block for every query.
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            log.warning(f"retrying {shard_file.name}"
+                        f" ({attempt}/{retries})")
+            time.sleep(min(2 ** attempt, 60))
+        with out_file.open("w") as out:
+            p = subprocess.run(argv + ["-query", str(shard_file)],
+                               stdout=out, stderr=subprocess.PIPE,
+                               text=True)
+        if p.returncode != 0:
+            log.warning(f"search of {shard_file.name} failed with exit code"
+                        f" {p.returncode}: {p.stderr.strip()}")
+            continue
+        found = sum(1 for _ in iter_cdd_blocks(out_file))
+        if found == num_queries:
+            return out_file
+        log.warning(f"search of {shard_file.name} returned {found} of"
+                    f" {num_queries} queries")
+    raise RuntimeError(f"search of {shard_file} failed after"
+                       f" {retries + 1} attempts")
+
+
+def run_cdd_search(fasta_file: Path,
+                   out_file: Path,
+                   cdd_bin: str,
+                   cdd_db: str,
+                   num_jobs: Optional[int] = None,
+                   num_shards: Optional[int] = None,
+                   retries: int = 2,
+                   work_dir: Optional[Path] = None):
+    """
+    Searches the sequences of `fasta_file` against CDD with rpsblast.
+
+    The queries are split into `num_shards` contiguous shards with about
+    the same number of residues, and up to `num_jobs` shards are searched
+    concurrently. Failed shards are retried. The `-outfmt 7` outputs are
+    merged in query order, so `out_file` is the same as the output of a
+    single rpsblast run over `fasta_file`.
+
+    Parameters
+    ----------
+    fasta_file : Path
+        Path to the query sequences (FASTA format)
+    out_file : Path
+        Path to the merged rpsblast output
+    cdd_bin : str
+        Command to run rpsblast (e.g. a `docker run` command), split with
+        shell rules and run without a shell
+    cdd_db : str
+        Name of the CDD database, passed as `-db`
+    num_jobs : int, optional
+        Number of concurrent searches, defaults to the number of cores
+    num_shards : int, optional
+        Number of shards, defaults to `num_jobs`
+    retries : int, default 2
+        Number of times a failed shard is retried
+    work_dir : Path, optional
+        Directory for the shards and their outputs, it must be visible to
+        `cdd_bin`. Defaults to a temporary directory next to `out_file`,
+        removed once the search is done
+    """
+    assert fasta_file.is_file(), f"{fasta_file} is not a file"
+    if num_jobs is None:
+        num_jobs = os.cpu_count() or 1
+    if num_shards is None:
+        num_shards = num_jobs
+    records = list(iter_fasta(fasta_file))
+    shards = shard_records(records, num_shards)
+    log.info(f"searching {len(records)} sequences in {len(shards)} shards"
+             f" with {num_jobs} concurrent jobs")
+    argv = shlex.split(cdd_bin) + ["-db", cdd_db] + CDD_ARGS
+
+    if work_dir is None:
+        tmp_dir = tempfile.TemporaryDirectory(prefix=".cdd-search-",
+                                              dir=out_file.parent)
+        work_dir = Path(tmp_dir.name)
+    else:
+        tmp_dir = None
+        work_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        tasks = []
+        for i, shard in enumerate(shards):
+            shard_file = work_dir / f"shard-{i:05d}.fasta"
+            with shard_file.open("w") as sf:
+                for header, sequence in shard:
+                    sf.write(f">{header}\n{sequence}\n")
+            tasks.append((argv, shard_file,
+                          work_dir / f"shard-{i:05d}.out",
+                          len(shard), retries))
+        with ThreadPoolExecutor(max_workers=num_jobs) as executor:
+            for _ in bounded_map(executor, _search_shard, tasks, num_jobs,
+                                 len(tasks), log_every=1, unit="shards"):
+                pass
+
+        tmp_file = out_file.with_name(f"{out_file.name}.tmp")
+        with tmp_file.open("w") as of:
+            for _, _, shard_out, _, _ in tasks:
+                for _, block in iter_cdd_blocks(shard_out):
+                    of.write(block)
+            of.write(f"# BLAST processed {len(records)} queries\n")
+        os.replace(tmp_file, out_file)
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+    log.info(f"CDD search results saved to {out_file}")
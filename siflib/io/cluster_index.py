@@ -0,0 +1,260 @@
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+
+log = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+# directory of the cluster indexes, if they should not be kept next to the
+# cluster files
+CACHE_DIR_VARIABLE = "SIF_CACHE_DIR"
+ARRAYS = ("names", "indptr", "representative", "length", "identity",
+          "rep_sorted_names", "rep_sorted_clusters")
+
+
+def index_dir(clusters_file: Path, cache_dir: Optional[Path] = None) -> Path:
+    """
+    Returns the index directory of `clusters_file`: `<clusters_file>.index`,
+    or a directory named after the file and a hash of its path in
+    `cache_dir` (`$SIF_CACHE_DIR` if not given and set).
+    """
+    if cache_dir is None and os.environ.get(CACHE_DIR_VARIABLE):
+        cache_dir = Path(os.environ[CACHE_DIR_VARIABLE])
+    if cache_dir is None:
+        return clusters_file.with_name(f"{clusters_file.name}.index")
+    key = hashlib.sha1(str(clusters_file.resolve()).encode()).hexdigest()
+    return cache_dir / f"{clusters_file.name}.{key[:16]}.index"
+
+
+def user_cache_dir() -> Path:
+    """
+    Directory of the indexes of cluster files whose directory is not
+    writable.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "sif"
+
+
+def _source_stamp(clusters_file: Path) -> str:
+    st = clusters_file.stat()
+    return f"{INDEX_VERSION}\t{st.st_size}\t{st.st_mtime_ns}\n"
+
+
+def _is_current(out_dir: Path, stamp: str) -> bool:
+    try:
+        return (out_dir / "source").read_text() == stamp
+    except OSError:
+        return False
+
+
+def _index_arrays(clusters_file: Path) -> Dict[str, np.ndarray]:
+    """
+    Parses `clusters_file` into the arrays of its index (see
+    `build_cluster_index`).
+    """
+    names = []
+    lengths = []
+    identities = []
+    indptr = []
+    representative = []
+    with clusters_file.open() as cdh:
+        for line in cdh:
+            if line.startswith(">Cluster"):
+                if indptr and len(representative) < len(indptr):
+                    raise ValueError(f"cluster {len(indptr) - 1} in"
+                                     f" {clusters_file} has no"
+                                     " representative")
+                indptr.append(len(names))
+                continue
+            _, aa, member, perc = line.strip().split(maxsplit=3)
+            if "%" in perc:
+                # "at 80.00%", or "at +/80.00%" for nucleotides
+                identity = float(perc.split()[-1].split("/")[-1][:-1])
+            else:
+                identity = 100.0
+                representative.append(len(names))
+            names.append(member[1:-3].encode())
+            lengths.append(int(aa[:-3]))
+            identities.append(identity)
+    if len(representative) < len(indptr):
+        raise ValueError(f"the last cluster in {clusters_file} has no"
+                         " representative")
+    indptr.append(len(names))
+
+    arrays = {
+        "names": np.array(names, dtype=bytes),
+        "indptr": np.array(indptr, dtype=np.int64),
+        "representative": np.array(representative, dtype=np.int64),
+        "length": np.array(lengths, dtype=np.int32),
+        "identity": np.array(identities, dtype=np.float32),
+    }
+    rep_names = arrays["names"][arrays["representative"]]
+    order = np.argsort(rep_names, kind="stable")
+    arrays["rep_sorted_names"] = rep_names[order]
+    arrays["rep_sorted_clusters"] = order.astype(np.int64)
+    log.info(f"indexed {len(indptr) - 1} clusters ({len(names)} members)"
+             f" of {clusters_file}")
+    return arrays
+
+
+def build_cluster_index(clusters_file: Path,
+                        out_dir: Optional[Path] = None) -> Path:
+    """
+    Builds the array-backed index of a CD-HIT `.clstr` file used by
+    `ClusterIndex`, as one `.npy` file per array in `out_dir`:
+
+    - `names`: accession of each member (fixed-width bytes), grouped by
+      cluster in file order
+    - `indptr`: members of cluster `i` are `names[indptr[i]:indptr[i+1]]`
+    - `representative`: member index of the representative of each cluster
+    - `length`: number of amino acids of each member
+    - `identity`: identity of each member to its representative (100 for
+      representatives)
+    - `rep_sorted_names`, `rep_sorted_clusters`: representative accessions
+      in sorted order and their clusters, to look clusters up by
+      representative with a binary search
+
+    The index is written to a unique temporary directory and renamed to
+    `out_dir`, so several processes can build it at once: if another one
+    renames a current index first, that index is kept.
+
+    Parameters
+    ----------
+    clusters_file : Path
+        Path to a cluster definition file generated with CD-HIT
+    out_dir : Path, optional
+        Directory of the index, defaults to `index_dir(clusters_file)`
+
+    Returns
+    -------
+    Path
+        Path to the index directory
+    """
+    assert clusters_file.is_file(), f"{clusters_file} is not a file"
+    if out_dir is None:
+        out_dir = index_dir(clusters_file)
+    stamp = _source_stamp(clusters_file)
+    out_dir.parent.mkdir(parents=True, exist_ok=True)
+    # created before parsing, so an unwritable directory fails fast
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{out_dir.name}.",
+                                    dir=out_dir.parent))
+    try:
+        for name, array in _index_arrays(clusters_file).items():
+            np.save(tmp_dir / f"{name}.npy", array)
+        # written last, an index without it is rebuilt
+        (tmp_dir / "source").write_text(stamp)
+        if _is_current(out_dir, stamp):
+            log.info(f"{out_dir} was built by another process, keeping it")
+            return out_dir
+        shutil.rmtree(out_dir, ignore_errors=True)
+        try:
+            os.replace(tmp_dir, out_dir)
+        except OSError:
+            # another process renamed its index first
+            if not _is_current(out_dir, stamp):
+                raise
+            log.info(f"{out_dir} was built by another process, keeping it")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_dir
+
+
+class ClusterIndex:
+    """
+    Compact, read-only view of a CD-HIT `.clstr` file: accessions are
+    stored once in a fixed-width array, clusters are offsets into it
+    (CSR-style), and lengths and identities are NumPy columns (see
+    `build_cluster_index`).
+
+    The index is built on first use, cached next to the `.clstr` file (or
+    in `cache_dir`), and memory-mapped on later loads, so opening it costs
+    little time and memory regardless of the number of clusters. It is
+    rebuilt if the `.clstr` file changes. If the index cannot be written
+    there, it is cached in `user_cache_dir()` instead, or kept in memory if
+    that fails too.
+
+    It can be used in place of the dictionary returned by
+    `neighborhood.cluster_members`: `index[representative]` returns the
+    accessions of the members of that representative's cluster.
+
+    Parameters
+    ----------
+    clusters_file : Path
+        Path to a cluster definition file generated with CD-HIT
+    cache_dir : Path, optional
+        Directory to cache the index in (see `index_dir`)
+    """
+
+    def __init__(self,
+                 clusters_file: Path,
+                 cache_dir: Optional[Path] = None):
+        self.clusters_file = clusters_file
+        # directory of the loaded index, None if it is kept in memory
+        self.cache_dir = None
+        stamp = _source_stamp(clusters_file)
+        for index in (index_dir(clusters_file, cache_dir),
+                      index_dir(clusters_file, user_cache_dir())):
+            if _is_current(index, stamp):
+                self.cache_dir = index
+                break
+            try:
+                self.cache_dir = build_cluster_index(clusters_file, index)
+                break
+            except OSError as e:
+                log.warning(f"cannot write the index of {clusters_file} to"
+                            f" {index}: {e}")
+        if self.cache_dir is None:
+            log.warning(f"keeping the index of {clusters_file} in memory")
+            arrays = _index_arrays(clusters_file)
+        else:
+            arrays = {name: np.load(self.cache_dir / f"{name}.npy",
+                                    mmap_mode="r")
+                      for name in ARRAYS}
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def cluster_id(self, representative: str) -> Optional[int]:
+        """
+        Returns the cluster of `representative`, or None if it does not
+        represent any cluster.
+        """
+        key = representative.encode()
+        i = int(np.searchsorted(self.rep_sorted_names, key))
+        if i < len(self.rep_sorted_names) and \
+                self.rep_sorted_names[i] == key:
+            return int(self.rep_sorted_clusters[i])
+        return None
+
+    def member_slice(self, cluster_id: int) -> slice:
+        return slice(int(self.indptr[cluster_id]),
+                     int(self.indptr[cluster_id + 1]))
+
+    def members(self, cluster_id: int) -> List[str]:
+        return [m.decode() for m in self.names[self.member_slice(cluster_id)]]
+
+    def representative_of(self, cluster_id: int) -> str:
+        return self.names[self.representative[cluster_id]].decode()
+
+    def __getitem__(self, representative: str) -> List[str]:
+        cluster_id = self.cluster_id(representative)
+        if cluster_id is None:
+            raise KeyError(representative)
+        return self.members(cluster_id)
+
+    def __contains__(self, representative: str) -> bool:
+        return self.cluster_id(representative) is not None
+
+    def expand(self, representatives: Iterable[str]) -> List[str]:
+        """
+        Returns the members of the clusters of `representatives`, in order.
+        """
+        return [m for r in representatives for m in self[r]]
@@ -1,6 +1,10 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Set, Tuple
 from Bio.PDB import PDBParser, PDBIO
 from Bio.PDB.PDBIO import Select
+from siflib.core.scheduler import bounded_map, default_window
+from siflib.io.pdb_resolver import PDBResolver
 import re
 import logging
 log = logging.getLogger(__name__)
@@ -8,7 +12,7 @@ log = logging.getLogger(__name__)
 
 class ECODDomain(Select):
 
-    def __init__(self, residues):
+    def __init__(self, residues: Set[int]):
         self.residues = residues
 
     def accept_residue(self, residue):
@@ -17,32 +21,150 @@ class ECODDomain(Select):
         return 0
 
 
+# ((start resSeq, start iCode), (end resSeq, end iCode))
+ResidueRange = Tuple[Tuple[int, str], Tuple[int, str]]
+
+
+def domain_ranges(ranges: str) -> List[ResidueRange]:
+    """
+    Parses an ECOD `pdb_range`, e.g. "A:-3-45,A:60-102" or "A:1A-50", into a
+    list of residue ranges.
+
+    Insertion codes are compared after the blank one, so a start without an
+    insertion code includes all the insertions of that residue. For the same
+    reason, an end without an insertion code is returned with "~" (which
+    sorts after every insertion code) to include all of them.
+    """
+    parsed = []
+    for r in ranges.split(","):
+        _, ran = r.split(":")
+        match = re.match(r'(-?\d+)([A-Za-z]?)-(-?\d+)([A-Za-z]?)$', ran)
+        if not match:
+            log.warning(f"Couldn't parse the range {r}, skipping it")
+            continue
+        start = (int(match.group(1)), match.group(2) or " ")
+        end = (int(match.group(3)), match.group(4) or "~")
+        parsed.append((start, end))
+    return parsed
+
+
+def domain_residues(ranges: str) -> Set[int]:
+    """
+    Returns the residue numbers covered by an ECOD `pdb_range`, e.g.
+    "A:-3-45,A:60-102" (ranges may start at negative residue numbers).
+    Insertion codes are ignored.
+    """
+    residues = set()
+    for (start, _), (end, _) in domain_ranges(ranges):
+        residues.update(range(start, end+1))
+    return residues
+
+
+def _slice_chain_domains(source_pdb: Path,
+                         domains: List[Tuple[str, str]],
+                         out_dir: Path) -> int:
+    """
+    Text backend of `create_ecod_pdbs`: copies the ATOM, HETATM and ANISOU
+    records of `source_pdb` whose (resSeq, iCode) falls in the range of each
+    domain straight into the domain PDB files, without building a
+    Structure. Records are copied verbatim, so coordinates are identical to
+    the source file.
+    """
+    selections = [(out_dir / f"{ecod_domain_id}.pdb", domain_ranges(ranges))
+                  for ecod_domain_id, ranges in domains]
+    outputs = [path.open("w") for path, _ in selections]
+    try:
+        residue = None
+        selected = []
+        with source_pdb.open() as pdb:
+            for line in pdb:
+                if line[0:6] not in ("ATOM  ", "HETATM", "ANISOU"):
+                    continue
+                # records of a residue are contiguous, so the domains it
+                # belongs to are only computed when the residue changes
+                if line[22:27] != residue:
+                    residue = line[22:27]
+                    key = (int(line[22:26]), line[26])
+                    selected = [of for of, (_, ranges)
+                                in zip(outputs, selections)
+                                if any(start <= key <= end
+                                       for start, end in ranges)]
+                for of in selected:
+                    of.write(line)
+        for of in outputs:
+            of.write("END\n")
+    finally:
+        for of in outputs:
+            of.close()
+    return len(domains)
+
+
+def _create_chain_domains(pdb_chain: str,
+                          source_pdb: Path,
+                          domains: List[Tuple[str, str]],
+                          out_dir: Path,
+                          engine: str = "biopython") -> int:
+    """
+    Parses `source_pdb` once and writes one PDB file per ECOD domain in
+    `domains`, a list of (ecod_domain_id, pdb_range) tuples.
+    """
+    if engine == "text":
+        return _slice_chain_domains(source_pdb, domains, out_dir)
+    s = PDBParser().get_structure(pdb_chain, source_pdb)
+    io = PDBIO()
+    io.set_structure(s)
+    for ecod_domain_id, ranges in domains:
+        out_file = str(out_dir / f"{ecod_domain_id}.pdb")
+        io.save(out_file, ECODDomain(domain_residues(ranges)))
+    return len(domains)
+
+
 def create_ecod_pdbs(pdbs_dir: Path,
                      chain_ranges: Path,
-                     out_dir: Path):
+                     out_dir: Path,
+                     num_cpu: Optional[int] = None,
+                     engine: str = "biopython",
+                     pdb_index: Optional[Path] = None):
+    """
+    Extracts each ECOD domain in `chain_ranges` (created with
+    `extract_domains_ecod`) into its own PDB file in `out_dir`.
+
+    `engine` selects how domains are carved out of the chain files:
+    "biopython" parses them with `PDBParser` and writes them with `PDBIO`,
+    "text" copies the matching ATOM/HETATM records directly (much faster,
+    and records are kept verbatim instead of being renumbered).
+
+    Chain files are located in `pdbs_dir` with a `PDBResolver`, using the
+    index in `pdb_index` (see `PDBResolver` for the default).
+    """
+    assert engine in ("biopython", "text"), f"unknown engine: {engine}"
     log.info("reading ranges")
-    parser = PDBParser()
+    # all the domains of a chain are extracted from a single parse
+    chains = {}
     with chain_ranges.open() as cr:
         for line in cr:
             if line.startswith("#"):
                 continue
             pdb_chain, ranges, ecod_domain_id, _ = line.strip().split("\t")
-            pdb_id, chain = pdb_chain.split("_")
-            pdb_dir_index = pdb_id[1:3]
-            source_pdb = pdbs_dir / pdb_dir_index / f"pdb{pdb_chain}.pdb"
-            if not source_pdb.is_file():
-                log.error(f"Couldn't find a suitable PDB file for {pdb_chain}")
-                continue
-            s = parser.get_structure(pdb_chain, source_pdb)
-            residues = []
-            for r in ranges.split(","):
-                _, ran = r.split(":")
-                match = re.match(r'(-?\d+)-(-?\d+)', ran)
-                if match:
-                    start = int(match.group(1))
-                    end = int(match.group(2))
-                residues.extend(range(int(start), int(end)+1))
-            out_file = str(out_dir / f"{ecod_domain_id}.pdb")
-            io = PDBIO()
-            io.set_structure(s)
-            io.save(out_file, ECODDomain(residues))
+            if pdb_chain not in chains:
+                chains[pdb_chain] = []
+            chains[pdb_chain].append((ecod_domain_id, ranges))
+
+    resolver = PDBResolver(pdbs_dir, pdb_index,
+                           subdirs={c.split("_")[0][1:3] for c in chains})
+    tasks = []
+    for pdb_chain, domains in chains.items():
+        source_pdb = resolver.path(pdb_chain)
+        if source_pdb is None or source_pdb.suffix != ".pdb":
+            log.error(f"Couldn't find a suitable PDB file for {pdb_chain}")
+            continue
+        tasks.append((pdb_chain, source_pdb, domains, out_dir, engine))
+    log.info(f"extracting domains from {len(tasks)} chains")
+
+    written = 0
+    with ProcessPoolExecutor(max_workers=num_cpu) as executor:
+        for n in bounded_map(executor, _create_chain_domains, tasks,
+                             default_window(num_cpu), len(tasks),
+                             unit="chains"):
+            written += n
+    log.info(f"{written} domain PDB files written to {out_dir}")
@@ -1,11 +1,23 @@
 from pathlib import Path
-from typing import Dict
-from siflib.io.parsers import parse_ska_db, parse_homstrad_alignments
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from siflib.core.scheduler import bounded_map
+from siflib.io.parsers import iter_ska_db, parse_homstrad_alignments
 import logging
+import os
+import shutil
+import tempfile
 
 
 log = logging.getLogger(__name__)
 
+# columns of the alignment files written by `extract_alingments_to_file`
+ALIGNMENT_COLUMNS = ("acc1", "acc2", "method",
+                     "start1", "seq1", "start2", "seq2")
+
+# (acc1, acc2, method, start1, seq1, start2, seq2)
+AlignmentRow = Tuple[str, str, str, str, str, str, str]
+
 
 def extract_alignments_homstrad_file(homstrad_file: Path) -> Dict:
     """
@@ -20,7 +32,7 @@ def extract_alignments_homstrad_file(homstrad_file: Path) -> Dict:
     -------
     Dict:
         keys are the tuple (acc1, acc2, method),
-        and values are tuples (seq1, seq2)
+        and values are tuples (start1, seq1, start2, seq2)
     """
     res = {}
     homstrad_alignments = parse_homstrad_alignments(homstrad_file)
@@ -37,9 +49,26 @@ def extract_alignments_homstrad_file(homstrad_file: Path) -> Dict:
     return res
 
 
+def iter_ska_file_alignments(ska_file: Path) -> Iterator[AlignmentRow]:
+    """
+    Streams the alignments of a `.ska` file as rows of the alignment file
+    format (see `extract_alingments_to_file`), with "ska" as the method.
+    Alignments without a start residue (e.g. ska errors) are skipped.
+    """
+    for a1, a2, match in iter_ska_db(ska_file):
+        d = match["alignment"]
+        if "start_query" not in d or "start_subject" not in d:
+            log.debug(f"{ska_file}: no alignment for {a1}, {a2}")
+            continue
+        yield (a1, a2, "ska", d["start_query"], d["seq_query"],
+               d["start_subject"], d["seq_subject"])
+
+
 def extract_alignments_ska_dir(ska_dir: Path) -> Dict:
     """
-    Extracts alignment dictionaries from a homstrad_file
+    Extracts alignment dictionaries from a directory of `.ska` files. The
+    whole result is kept in memory, use `extract_alignments_ska_dir_to_file`
+    for large directories.
 
     Parameters
     ----------
@@ -50,30 +79,128 @@ def extract_alignments_ska_dir(ska_dir: Path) -> Dict:
     -------
     Dict:
         keys are the tuple (acc1, acc2, "ska"),
-        and values are tuples (seq1, seq2)
+        and values are tuples (start1, seq1, start2, seq2)
     """
     res = {}
     for ska_file in ska_dir.glob("*.ska"):
         log.info(ska_file)
-        ska_alignment = parse_ska_db(ska_file)
-        for a1, data_a1 in ska_alignment.items():
-            for a2, data_a2 in data_a1.items():
-                key = (a1, a2, "ska")
-                d = data_a2["alignment"]
-                try:
-                    res[key] = (
-                        d["start_query"],
-                        d["seq_query"],
-                        d["start_subject"],
-                        d["seq_subject"]
-                    )
-                except:
-                    print(key)
-                    continue
+        for a1, a2, method, *alignment in iter_ska_file_alignments(ska_file):
+            res[(a1, a2, method)] = tuple(alignment)
+    return res
 
 
-    return res
+def _format_row(row: Iterable[str]) -> str:
+    return "\t".join(str(value) for value in row) + "\n"
+
+
+def _extract_ska_file(ska_file: Path, part_file: Path) -> Tuple[Path, int]:
+    """
+    Writes the alignments of `ska_file` to `part_file` as rows of the
+    alignment file format, without a header, and returns `part_file` and
+    the number of rows.
+    """
+    count = 0
+    with part_file.open("w") as pf:
+        for row in iter_ska_file_alignments(ska_file):
+            pf.write(_format_row(row))
+            count += 1
+    return part_file, count
 
 
 def extract_alingments_to_file(alignments: Dict, output_file: Path):
-    pass
+    """
+    Writes the alignments returned by `extract_alignments_homstrad_file` or
+    `extract_alignments_ska_dir` to `output_file`.
+
+    The file is tab-separated, with a header line followed by one alignment
+    per line, with the columns:
+
+    - `acc1`, `acc2`: accessions of the aligned structures
+    - `method`: alignment method ("ska", or the method of homstrad)
+    - `start1`, `start2`: residue ID (as written in the structure, it may
+      have an insertion code) of the first aligned residue of each structure
+    - `seq1`, `seq2`: aligned sequences, of the same length, with "-" for
+      gaps
+
+    Use `iter_alignments_file` to read it back.
+    """
+    tmp_file = output_file.with_name(f"{output_file.name}.tmp")
+    with tmp_file.open("w") as of:
+        of.write(_format_row(ALIGNMENT_COLUMNS))
+        for (a1, a2, method), alignment in alignments.items():
+            of.write(_format_row((a1, a2, method, *alignment)))
+    os.replace(tmp_file, output_file)
+    log.info(f"{len(alignments)} alignments saved to {output_file}")
+
+
+def extract_alignments_ska_dir_to_file(ska_dir: Path,
+                                       output_file: Path,
+                                       num_cpu: Optional[int] = None,
+                                       max_in_flight: Optional[int] = None):
+    """
+    Extracts the alignments of every finished `.ska` file in `ska_dir`
+    (the ones with a `.ska.done` marker) to `output_file` (see
+    `extract_alingments_to_file` for the format).
+
+    Each worker streams the alignments of one file to a part file in a
+    temporary directory next to `output_file`, and the parts are appended
+    to the output as they complete. No file is ever held in memory, and
+    the order of the files in the output is not deterministic (the
+    alignments of a file are kept together, in file order).
+
+    Parameters
+    ----------
+    ska_dir : Path
+        Path to a directory containing .ska files
+    output_file : Path
+        Path to the alignment file (will be created)
+    num_cpu : int, optional
+        Number of cores to use, all if None
+    max_in_flight : int, optional
+        Maximum number of part files written and not appended yet, defaults
+        to the number of cores
+    """
+    assert ska_dir.is_dir(), f"{ska_dir} is not a directory"
+    ska_files = []
+    for ska_file in sorted(ska_dir.glob("*.ska")):
+        if ska_file.with_name(f"{ska_file.name}.done").is_file():
+            ska_files.append(ska_file)
+        else:
+            log.warning(f"{ska_file} is not finished, skipping")
+    if max_in_flight is None:
+        max_in_flight = num_cpu or os.cpu_count() or 1
+    log.info(f"extracting the alignments of {len(ska_files)} files in"
+             f" {ska_dir}")
+    total = 0
+    tmp_file = output_file.with_name(f"{output_file.name}.tmp")
+    with tempfile.TemporaryDirectory(prefix=".extract-alignments-",
+                                     dir=output_file.parent) as work_dir, \
+            tmp_file.open("w") as of, \
+            ProcessPoolExecutor(max_workers=num_cpu) as executor:
+        of.write(_format_row(ALIGNMENT_COLUMNS))
+        tasks = ((f, Path(work_dir) / f"{i:06d}.tsv")
+                 for i, f in enumerate(ska_files))
+        for part_file, count in bounded_map(executor, _extract_ska_file,
+                                            tasks, max_in_flight,
+                                            len(ska_files), unit="files"):
+            with part_file.open() as pf:
+                shutil.copyfileobj(pf, of)
+            part_file.unlink()
+            total += count
+    os.replace(tmp_file, output_file)
+    log.info(f"{total} alignments saved to {output_file}")
+
+
+def iter_alignments_file(alignments_file: Path) -> Iterator[AlignmentRow]:
+    """
+    Streams the rows of a file written by `extract_alingments_to_file` or
+    `extract_alignments_ska_dir_to_file`.
+    """
+    with alignments_file.open() as af:
+        header = af.readline().rstrip("\n").split("\t")
+        assert tuple(header) == ALIGNMENT_COLUMNS, \
+            f"{alignments_file} is not an alignment file"
+        for line in af:
+            row = line.rstrip("\n").split("\t")
+            if len(row) == len(ALIGNMENT_COLUMNS):
+                yield tuple(row)
@@ -1,47 +1,122 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+from siflib.core.scheduler import bounded_map, default_window
 import logging
 import gzip
-from rich.progress import track
+import os
 log = logging.getLogger(__name__)
 
+EXTENSIONS = (".pdb", ".ent.gz")
 
-def extract_chains(pdb_path: Path):
-    ext = ".pdb"
-    if pdb_path.name.endswith(".pdb"):
-        lines = pdb_path.open().readlines()
-    elif pdb_path.name.endswith(".ent.gz"):
-        lines = gzip.open(pdb_path, "rt").readlines()
-        ext = ".ent.gz"
-    chains_lines = {}
+
+def _stem(name: str) -> str:
+    for ext in EXTENSIONS:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def extract_chains(pdb_path: Path) -> int:
+    """
+    Splits a PDB file into one `<stem>_<chain>.pdb` file per chain, saved in
+    the same directory. Lines are streamed from the input (gzipped or not)
+    straight into the chain files, which are written under temporary names
+    and renamed once the whole input has been read, so an interrupted run
+    never leaves truncated chain files behind.
+
+    For multi-model files, only the first model is kept.
+
+    Parameters
+    ----------
+    pdb_path : Path
+        Path to a `.pdb` or `.ent.gz` file
+
+    Returns
+    -------
+    int
+        Number of chain files written
+    """
+    if pdb_path.name.endswith(".ent.gz"):
+        pdb = gzip.open(pdb_path, "rt")
+    else:
+        pdb = pdb_path.open()
+    stem = _stem(pdb_path.name)
+    chain_files = {}
     multimodel = False
-    for line in lines:
-        if line.startswith("MODEL"):
-            multimodel = True
-        elif line[0:6] in ["ATOM  ", "HETATM", "TER   "]:
-            chain_id = line[21]
-            if chain_id not in chains_lines:
-                chains_lines[chain_id] = []
-            chains_lines[chain_id].append(line)
-        elif line.startswith("ENDMDL"):
-            if multimodel:
-                break
-            else:
-                log.error(f"Found ENDML without a MODEL {pdb_path}")
-    for chain, clines in chains_lines.items():
-        stem = pdb_path.name.replace(ext, '')
-        outfile = pdb_path.parent / f"{stem}_{chain}.pdb"
-        with outfile.open("w") as of:
-            of.writelines(clines)
-
-
-def run(in_dir: Path):
-    log.info("searching for plain text PDBs (.pdb)")
-    plain_texts = list(in_dir.glob("**/*.pdb"))
-    log.info(f"found {len(plain_texts)} plain text PDBs")
-
-    log.info("searching for gzipped PDBs (.ent.gz)")
-    gzipped = list(in_dir.glob("**/*.ent.gz"))
-    log.info(f"found {len(gzipped)} gzipped PDBs")
-
-    for pdb in track(plain_texts + gzipped, description="extracting..."):
-        extract_chains(pdb)
+    try:
+        with pdb:
+            for line in pdb:
+                record = line[0:6]
+                if record == "MODEL ":
+                    multimodel = True
+                elif record in ("ATOM  ", "HETATM", "TER   "):
+                    chain_id = line[21]
+                    of = chain_files.get(chain_id)
+                    if of is None:
+                        tmp = pdb_path.parent / f".{stem}_{chain_id}.pdb.tmp"
+                        of = chain_files[chain_id] = tmp.open("w")
+                    of.write(line)
+                elif record == "ENDMDL":
+                    if multimodel:
+                        break
+                    else:
+                        log.error(f"Found ENDML without a MODEL {pdb_path}")
+    finally:
+        for of in chain_files.values():
+            of.close()
+    for chain_id, of in chain_files.items():
+        os.replace(of.name, pdb_path.parent / f"{stem}_{chain_id}.pdb")
+    return len(chain_files)
+
+
+def find_pdb_files(in_dir: Path, force: bool = False) -> List[Path]:
+    """
+    Walks `in_dir` once, collecting the `.pdb` and `.ent.gz` files that need
+    their chains extracted.
+
+    Chain files written by `extract_chains` (`<stem>_<chain>.pdb` next to a
+    `<stem>.pdb` or `<stem>.ent.gz` file) are not considered inputs. Unless
+    `force` is set, files whose chain files are at least as recent as the
+    file itself are skipped.
+    """
+    pdb_files = []
+    skipped = 0
+    for dirpath, _, filenames in os.walk(in_dir):
+        stems = {_stem(n) for n in filenames if n.endswith(EXTENSIONS)}
+        # chain files in this directory, grouped by the stem they come from
+        outputs: Dict[str, List[str]] = {}
+        for name in filenames:
+            if name.endswith(".pdb") and name[-6:-5] == "_" \
+                    and name[:-6] in stems:
+                outputs.setdefault(name[:-6], []).append(name)
+        produced = {n for names in outputs.values() for n in names}
+        for name in filenames:
+            if not name.endswith(EXTENSIONS) or name in produced:
+                continue
+            path = Path(dirpath) / name
+            chains = outputs.get(_stem(name))
+            if not force and chains:
+                mtime = path.stat().st_mtime
+                if all(os.stat(Path(dirpath) / c).st_mtime >= mtime
+                       for c in chains):
+                    skipped += 1
+                    continue
+            pdb_files.append(path)
+    log.info(f"skipping {skipped} files with up to date chain files")
+    return pdb_files
+
+
+def run(in_dir: Path,
+        num_cpu: Optional[int] = None,
+        force: bool = False):
+    log.info("searching for PDBs (.pdb and .ent.gz)")
+    pdb_files = find_pdb_files(in_dir, force)
+    log.info(f"found {len(pdb_files)} PDBs to process")
+
+    tasks = ((pdb,) for pdb in pdb_files)
+    with ProcessPoolExecutor(max_workers=num_cpu) as executor:
+        for _ in bounded_map(executor, extract_chains, tasks,
+                             default_window(num_cpu), len(pdb_files),
+                             unit="files"):
+            pass
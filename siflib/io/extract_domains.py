@@ -1,27 +1,149 @@
 from pathlib import Path
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import logging
-from siflib.io.parsers import parse_fasta, parse_cdd, parse_ecod_domains
+from siflib.io.fasta_index import FastaIndex
+from siflib.io.parsers import (CddHit, iter_cdd, iter_fasta, parse_fasta,
+                               parse_cdd, parse_ecod_domains)
 log = logging.getLogger(__name__)
 
 
+def _domain_header(accession: str,
+                   i: int,
+                   subject: str,
+                   evalue: float,
+                   identity: float) -> str:
+    return (f'{accession}-D{i}'
+            f' CDD_ID={subject}'
+            f' evalue={evalue}'
+            f' perc_id={identity}')
+
+
+def iter_domain_sequences(domains: Dict,
+                          fasta: Dict) -> Iterator[Tuple[str, str]]:
+    """
+    Yields the (header, sequence) of each domain found in the CDD search,
+    where `domains` is the output of `parse_cdd` and `fasta` the output of
+    `parse_fasta` for the sequences used in the search.
+    """
+    for accession, seq_info in fasta.items():
+        for i, match in enumerate(domains.get(accession, [])):
+            header = _domain_header(accession, i, match["subject acc.ver"],
+                                    match["evalue"], match["% identity"])
+            start = match["q. start"] - 1
+            end = match["q. end"]
+            yield header, seq_info["sequence"][start:end]
+
+
+def _lockstep(groups: Iterable[Tuple[str, List[CddHit]]],
+              fasta_file: Path) -> Iterator[Tuple[str, List[CddHit], str]]:
+    """
+    Pairs each group of hits with its sequence, walking the CDD results and
+    the FASTA file forward together, which works when both list the queries
+    in the same order (as for the FASTA file used in the search).
+
+    If a query is not found ahead in the FASTA file (it is missing, out of
+    order, or its rows are not contiguous), that query and all the ones
+    after it are fetched through the `.fai` index of the FASTA file
+    instead (see `_fetched`), so only missing queries are skipped.
+    """
+    groups = iter(groups)
+    records = ((header.split()[0], sequence)
+               for header, sequence in iter_fasta(fasta_file))
+    for query, hits in groups:
+        for accession, sequence in records:
+            if accession == query:
+                yield query, hits, sequence
+                break
+        else:
+            log.warning(f"{query} not found in {fasta_file} after the"
+                        " previous query, reading the remaining sequences"
+                        " through its index")
+            with FastaIndex(fasta_file) as index:
+                yield from _fetched(chain([(query, hits)], groups), index)
+            return
+
+
+def _fetched(groups: Iterable[Tuple[str, List[CddHit]]],
+             index: FastaIndex) -> Iterator[Tuple[str, List[CddHit], str]]:
+    for query, hits in groups:
+        if query in index:
+            yield query, hits, index.fetch(query)
+        else:
+            log.warning(f"{query} is not in {index.fasta_file}")
+
+
+def iter_streamed_domains(domains_file: Path,
+                          fasta_file: Path,
+                          index: Optional[FastaIndex] = None
+                          ) -> Iterator[Tuple[str, str]]:
+    """
+    Yields the (header, sequence) of each domain found in the CDD search,
+    reading the hits of one query at a time with `iter_cdd`. Sequences are
+    fetched from `index` if given, otherwise `fasta_file` is read in
+    lockstep with the hits (see `_lockstep`). Only a domain counter per
+    query is kept, so the rows of a query need not be contiguous, and
+    memory use does not otherwise depend on the size of either file.
+    """
+    groups = iter_cdd(domains_file)
+    if index is None:
+        matched = _lockstep(groups, fasta_file)
+    else:
+        matched = _fetched(groups, index)
+    # domains already written for each query, so that rows of a query
+    # split in several groups keep numbering its domains
+    numbered: Dict[str, int] = {}
+    for accession, hits, sequence in matched:
+        first = numbered.get(accession, 0)
+        numbered[accession] = first + len(hits)
+        for i, hit in enumerate(hits, start=first):
+            header = _domain_header(accession, i, hit.subject, hit.evalue,
+                                    hit.identity)
+            yield header, sequence[hit.q_start - 1:hit.q_end]
+
+
 def extract_domains(domains_file: Path,
                     fasta_file: Path,
-                    out_file: Path):
+                    out_file: Path,
+                    use_index: bool = False,
+                    stream: bool = False):
+    """
+    Writes the sequence of each domain found in the CDD search to
+    `out_file`. If `use_index` is true, only the sequences with domains are
+    read from `fasta_file`, through its `.fai` index (built on first use),
+    instead of loading the whole file. If `stream` is true, domains are
+    written as the CDD results are read, see `iter_streamed_domains`.
+    """
+    if stream:
+        log.info("streaming domains")
+        index = FastaIndex(fasta_file) if use_index else None
+        try:
+            with out_file.open("w") as of:
+                for header, domain_seq in iter_streamed_domains(
+                        domains_file, fasta_file, index):
+                    of.write(f">{header}\n")
+                    of.write(f"{domain_seq}\n")
+        finally:
+            if index is not None:
+                index.close()
+        return
     log.info("reading domains")
     domains = parse_cdd(domains_file)
-    log.info("reading FASTA file")
-    fasta = parse_fasta(fasta_file, uniprot_header=False, skip_metadata=True)
+    if use_index:
+        log.info("fetching sequences from the FASTA index")
+        with FastaIndex(fasta_file) as index:
+            fasta = {acc: {"sequence": index.fetch(acc)}
+                     for acc in domains if acc in index}
+        for acc in domains.keys() - fasta.keys():
+            log.warning(f"{acc} is not in {fasta_file}")
+    else:
+        log.info("reading FASTA file")
+        fasta = parse_fasta(fasta_file, uniprot_header=False,
+                            skip_metadata=True)
     with out_file.open("w") as of:
-        for accession, seq_info in fasta.items():
-            for i, match in enumerate(domains.get(accession, [])):
-                of.write(f'>{accession}-D{i}'
-                         f' CDD_ID={match["subject acc.ver"]}'
-                         f' evalue={match["evalue"]}'
-                         f' perc_id={match["% identity"]}\n')
-                start = match["q. start"] - 1
-                end = match["q. end"]
-                domain_seq = seq_info["sequence"][start:end]
-                of.write(f"{domain_seq}\n")
+        for header, domain_seq in iter_domain_sequences(domains, fasta):
+            of.write(f">{header}\n")
+            of.write(f"{domain_seq}\n")
 
 
 def extract_domains_ecod(pdb_chains_file: Path,
@@ -0,0 +1,163 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+
+# length, offset, linebases, linewidth
+FaiEntry = Tuple[int, int, int, int]
+
+
+def fai_path(fasta_file: Path) -> Path:
+    return fasta_file.with_name(f"{fasta_file.name}.fai")
+
+
+def build_fasta_index(fasta_file: Path,
+                      index_file: Optional[Path] = None) -> Path:
+    """
+    Builds a samtools-compatible `.fai` index of a FASTA file, one
+    `name\\tlength\\toffset\\tlinebases\\tlinewidth` line per record, where
+    `name` is the first word of the header, `offset` the byte offset of the
+    first base, `linebases` the number of bases per line and `linewidth` the
+    number of bytes per line (including the line terminator).
+
+    As with samtools, every line of a record but the last must have the
+    same length. The index is written to a temporary file and then moved in
+    place, so readers never see a partial index.
+
+    Parameters
+    ----------
+    fasta_file : Path
+        Path to the FASTA file
+    index_file : Path, optional
+        Path to the index, defaults to `<fasta_file>.fai`
+
+    Returns
+    -------
+    Path
+        Path to the index
+    """
+    assert fasta_file.is_file(), f"{fasta_file} is not a file"
+    if index_file is None:
+        index_file = fai_path(fasta_file)
+    entries: List[Tuple[str, FaiEntry]] = []
+    name = None
+    length = offset = linebases = linewidth = 0
+    short_line = False
+    with fasta_file.open("rb") as f:
+        position = 0
+        for line in f:
+            if line.startswith(b">"):
+                if name is not None:
+                    entries.append((name, (length, offset,
+                                           linebases, linewidth)))
+                name = line[1:].split()[0].decode()
+                offset = position + len(line)
+                length = linebases = linewidth = 0
+                short_line = False
+            elif name is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if length == 0 and not short_line:
+                    linebases = bases
+                    linewidth = len(line)
+                elif short_line or bases > linebases:
+                    raise ValueError(f"{name} in {fasta_file} has lines of"
+                                     " different lengths, it can't be"
+                                     " indexed")
+                # only the last line of a record may be shorter
+                short_line = bases != linebases or len(line) != linewidth
+                length += bases
+            position += len(line)
+    if name is not None:
+        entries.append((name, (length, offset, linebases, linewidth)))
+
+    tmp_file = index_file.with_name(f"{index_file.name}.tmp")
+    seen = set()
+    with tmp_file.open("w") as idx:
+        for name, (length, offset, linebases, linewidth) in entries:
+            if name in seen:
+                log.warning(f"duplicate record {name} in {fasta_file},"
+                            " only the first one is indexed")
+                continue
+            seen.add(name)
+            idx.write(f"{name}\t{length}\t{offset}\t{linebases}"
+                      f"\t{linewidth}\n")
+    os.replace(tmp_file, index_file)
+    log.info(f"indexed {len(seen)} records of {fasta_file}")
+    return index_file
+
+
+class FastaIndex:
+    """
+    Random access to the records of a FASTA file through its `.fai` index,
+    which is built on first use (or rebuilt if it is older than the FASTA
+    file). Only the requested sequences are read from disk.
+
+    Can be used as a context manager to close the FASTA file when done.
+
+    Parameters
+    ----------
+    fasta_file : Path
+        Path to the FASTA file
+    index_file : Path, optional
+        Path to the index, defaults to `<fasta_file>.fai`
+    """
+
+    def __init__(self,
+                 fasta_file: Path,
+                 index_file: Optional[Path] = None):
+        assert fasta_file.is_file(), f"{fasta_file} is not a file"
+        if index_file is None:
+            index_file = fai_path(fasta_file)
+        if not index_file.is_file() or \
+                index_file.stat().st_mtime < fasta_file.stat().st_mtime:
+            build_fasta_index(fasta_file, index_file)
+        self.fasta_file = fasta_file
+        self.index_file = index_file
+        self.entries: Dict[str, FaiEntry] = {}
+        with index_file.open() as idx:
+            for line in idx:
+                name, *values = line.rstrip("\n").split("\t")
+                self.entries[name] = tuple(int(v) for v in values[:4])
+        self._handle = None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def names(self) -> List[str]:
+        return list(self.entries)
+
+    def fetch(self, name: str) -> str:
+        """
+        Returns the sequence of the record `name` (the first word of its
+        header). Raises KeyError if it is not in the index.
+        """
+        length, offset, linebases, linewidth = self.entries[name]
+        if length == 0:
+            return ""
+        # the last line has no terminator to account for
+        nbytes = length + (length - 1) // linebases * (linewidth - linebases)
+        if self._handle is None:
+            self._handle = self.fasta_file.open("rb")
+        self._handle.seek(offset)
+        data = self._handle.read(nbytes)
+        return data.replace(b"\n", b"").replace(b"\r", b"").decode()
+
+    def __getitem__(self, name: str) -> str:
+        return self.fetch(name)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
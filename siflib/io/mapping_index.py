@@ -0,0 +1,157 @@
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+import logging
+import mmap
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+def index_path(mapping_file: Path) -> Path:
+    return mapping_file.with_name(f"{mapping_file.name}.idx")
+
+
+def grouped_path(mapping_file: Path) -> Path:
+    return mapping_file.with_name(
+        f"{mapping_file.stem}.grouped{mapping_file.suffix}")
+
+
+def write_mapping_index(mapping_file: Path,
+                        offsets: Dict[str, Tuple[int, int]]) -> Path:
+    """
+    Writes the index of a mapping file, one `query\\tstart\\tend` line per
+    query, where `start` and `end` are the byte offsets of the query's rows.
+    The index is written to a temporary file and then moved in place, so
+    readers never see a partial index.
+    """
+    idx_file = index_path(mapping_file)
+    tmp_file = idx_file.with_name(f"{idx_file.name}.tmp")
+    with tmp_file.open("w") as idx:
+        for query, (start, end) in sorted(offsets.items()):
+            idx.write(f"{query}\t{start}\t{end}\n")
+    os.replace(tmp_file, idx_file)
+    return idx_file
+
+
+def index_mapping_file(mapping_file: Path) -> Path:
+    """
+    Builds an offset index for a mapping file created by the
+    `expand-clusters` command (a header followed by `query\\tmember` rows).
+
+    The index requires the rows of each query to be contiguous. If they are
+    not, a copy of the mapping file with its rows grouped by query (keeping
+    their relative order) is written next to it, as
+    `<stem>.grouped<suffix>`, and that copy is indexed instead. The mapping
+    file itself is never modified.
+
+    Parameters
+    ----------
+    mapping_file : Path
+        Path to the mapping file
+
+    Returns
+    -------
+    Path
+        Path to the index (`<mapping_file>.idx`, or the index of the
+        grouped copy)
+    """
+    assert mapping_file.is_file(), f"{mapping_file} is not a file"
+    offsets = {}
+    contiguous = True
+    with mapping_file.open("rb") as mf:
+        header = mf.readline()
+        position = len(header)
+        current = None
+        for line in mf:
+            query = line.split(b"\t", 1)[0].decode()
+            if query != current:
+                if query in offsets:
+                    contiguous = False
+                    break
+                offsets[query] = (position, position)
+                current = query
+            position += len(line)
+            offsets[query] = (offsets[query][0], position)
+    if contiguous:
+        return write_mapping_index(mapping_file, offsets)
+
+    grouped_file = grouped_path(mapping_file)
+    log.warning(f"{mapping_file} is not grouped by query, writing a grouped"
+                f" copy to {grouped_file}, use it instead")
+    groups = {}
+    with mapping_file.open("rb") as mf:
+        header = mf.readline()
+        for line in mf:
+            query = line.split(b"\t", 1)[0]
+            if query not in groups:
+                groups[query] = []
+            groups[query].append(line)
+    offsets = {}
+    tmp_file = grouped_file.with_name(f"{grouped_file.name}.tmp")
+    with tmp_file.open("wb") as mf:
+        mf.write(header)
+        position = len(header)
+        for query, lines in groups.items():
+            start = position
+            for line in lines:
+                mf.write(line)
+                position += len(line)
+            offsets[query.decode()] = (start, position)
+    os.replace(tmp_file, grouped_file)
+    return write_mapping_index(grouped_file, offsets)
+
+
+def read_mapping_members(mapping_file: Path, query: str) -> Set[str]:
+    """
+    Returns the members mapped to `query` in a mapping file created by the
+    `expand-clusters` command.
+
+    If an up to date index (see `index_mapping_file`) exists, only the rows
+    of `query` are read, otherwise the whole file is scanned.
+    """
+    span = _lookup_index(mapping_file, query)
+    members = set()
+    with mapping_file.open("rb") as mf:
+        if span is None:
+            log.info(f"no index for {mapping_file}, scanning the whole file")
+            mf.readline()
+            lines = mf
+        else:
+            start, end = span
+            mf.seek(start)
+            lines = mf.read(end - start).splitlines()
+        for line in lines:
+            pdb_id, member = line.decode().strip().split()
+            if pdb_id == query:
+                members.add(member)
+    return members
+
+
+def _lookup_index(mapping_file: Path,
+                  query: str) -> Optional[Tuple[int, int]]:
+    idx_file = index_path(mapping_file)
+    if not idx_file.is_file() or \
+            idx_file.stat().st_mtime < mapping_file.stat().st_mtime:
+        return None
+    if idx_file.stat().st_size == 0:
+        return 0, 0
+    key = query.encode()
+    with idx_file.open("rb") as idx, \
+            mmap.mmap(idx.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # binary search for the first line whose query is not below `key`,
+        # the index is sorted by query and `lo`/`hi` are line starts
+        lo, hi = 0, len(mm)
+        while lo < hi:
+            line_start = mm.rfind(b"\n", 0, (lo + hi) // 2) + 1
+            line_end = mm.find(b"\n", line_start) + 1 or len(mm)
+            if mm[line_start:mm.find(b"\t", line_start)] < key:
+                lo = line_end
+            else:
+                hi = line_start
+        if lo < len(mm):
+            line = mm[lo:mm.find(b"\n", lo) + 1 or len(mm)]
+            idx_query, start, end = line.rstrip(b"\n").split(b"\t")
+            if idx_query == key:
+                return int(start), int(end)
+    return 0, 0
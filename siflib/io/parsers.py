@@ -1,9 +1,40 @@
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
 import warnings
 import re
 
 
+def iter_fasta(fasta_file: Path) -> Iterator[Tuple[str, str]]:
+    """
+    Streams the records of a FASTA file.
+
+    Parameters
+    ----------
+    fasta_file : Path
+        Path to the FASTA file
+
+    Yields
+    ------
+    Tuple[str, str]
+        The header (without ">") and the sequence of each record. Lines
+        before the first header are ignored.
+    """
+    assert fasta_file.is_file()
+    header = None
+    chunks = []
+    with fasta_file.open() as f:
+        for line in f:
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(chunks)
+                header = line[1:].rstrip()
+                chunks = []
+            elif header is not None:
+                chunks.append(line.strip())
+    if header is not None:
+        yield header, "".join(chunks)
+
+
 def parse_fasta(fasta_file: Path,
                 uniprot_header=True,
                 skip_metadata=False) -> Dict:
@@ -41,7 +72,7 @@ def parse_fasta(fasta_file: Path,
     assert fasta_file.is_file()
     uniprot_re = None
     if uniprot_header:
-        regex = (r"^>(?P<db>[a-zA-Z]+)\|(?P<UniqueIdentifier>\w+)\|"
+        regex = (r"^(?P<db>[a-zA-Z]+)\|(?P<UniqueIdentifier>\w+)\|"
                  r"(?P<EntryName>\w+)\s(?P<ProteinName>.*)\s"
                  r"OS=(?P<OrganismName>.*)\sOX=(?P<OrganismIdentifier>\w*)\s"
                  r"(?:GN=(?P<GeneName>.*)\s)?PE=(?P<ProteinExistence>.*)\s"
@@ -49,34 +80,27 @@ def parse_fasta(fasta_file: Path,
         uniprot_re = re.compile(regex)
 
     sequences = {}
-    metadata = {}
-    curr_seq = ""
-    curr_acc = ""
-    with fasta_file.open() as f:
-        for line in f:
-            if line.startswith(">"):
-                if curr_seq != "":
-                    sequences[curr_acc] = {
-                        "sequence": curr_seq
-                    }
-                    if not skip_metadata:
-                        for m, v in metadata.items():
-                            sequences[curr_acc][m] = v
-                        metadata = {}
-                    curr_seq = ""
-                if uniprot_header:
-                    match = uniprot_re.match(line)
-                    if match:
-                        metadata = match.groupdict()
-                        curr_acc = metadata["UniqueIdentifier"]
-                    else:
-                        warnings.warn("Could not parse header, defaulting to"
-                                      f"simple header for this entry {line}")
-                        curr_acc = line[1:].split()[0]
-                else:
-                    curr_acc = line[1:].split()[0]
-            else:
-                curr_seq += line.strip()
+    for header, sequence in iter_fasta(fasta_file):
+        if not sequence:
+            continue
+        match = None
+        # the regex is only tried on headers that can match it
+        if uniprot_header and "|" in header and " OS=" in header:
+            match = uniprot_re.match(header)
+        if match:
+            metadata = match.groupdict()
+            curr_acc = metadata["UniqueIdentifier"]
+        else:
+            if uniprot_header:
+                warnings.warn("Could not parse header, defaulting to"
+                              f" simple header for this entry >{header}")
+            metadata = {}
+            curr_acc = header.split()[0]
+        sequences[curr_acc] = {
+            "sequence": sequence
+        }
+        if not skip_metadata:
+            sequences[curr_acc].update(metadata)
     return sequences
 
 
@@ -137,6 +161,97 @@ def parse_cdd(cdd_file: Path) -> Dict:
     return domains
 
 
+class CddHit(NamedTuple):
+    """
+    A row of rpsblast `-outfmt 7` output (without the query accession).
+    """
+    subject: str
+    identity: float
+    alignment_length: int
+    mismatches: int
+    gap_opens: int
+    q_start: int
+    q_end: int
+    s_start: int
+    s_end: int
+    evalue: float
+    bit_score: float
+
+
+def iter_cdd(cdd_file: Path) -> Iterator[Tuple[str, List[CddHit]]]:
+    """
+    Streams the hits of an rpsblast `-outfmt 7` file, grouped by query.
+    Only the hits of one query are kept in memory at a time, so consecutive
+    rows of the same query (as written by rpsblast) form a group.
+
+    Parameters
+    ----------
+    cdd_file : Path
+        Path to the output file produced by rpsblast
+
+    Yields
+    ------
+    Tuple[str, List[CddHit]]
+        The query accession and its hits
+    """
+    assert cdd_file.is_file()
+    query = None
+    hits = []
+    with cdd_file.open() as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            (qacc, sacc, pid, al, mism,
+             gop, qs, qe, ss, se, ev, bs) = line.strip().split("\t")
+            if qacc != query:
+                if hits:
+                    yield query, hits
+                query = qacc
+                hits = []
+            hits.append(CddHit(sacc, float(pid), int(al), int(mism),
+                               int(gop), int(qs), int(qe), int(ss), int(se),
+                               float(ev), float(bs)))
+    if hits:
+        yield query, hits
+
+
+def iter_cdd_blocks(cdd_file: Path) -> Iterator[Tuple[str, str]]:
+    """
+    Iterates over the per-query blocks of an rpsblast `-outfmt 7` file.
+
+    Parameters
+    ----------
+    cdd_file : Path
+        Path to the output file produced by rpsblast
+
+    Yields
+    ------
+    Tuple[str, str]
+        The query accession (first word of the "# Query:" line) and the text
+        of its block: the comment lines followed by the hits. The trailing
+        "# BLAST processed" line does not belong to any block.
+    """
+    assert cdd_file.is_file()
+    query = None
+    lines = []
+    with cdd_file.open() as f:
+        for line in f:
+            if line.startswith("# BLAST processed"):
+                continue
+            # every block starts with the program line, e.g. "# RPSBLAST 2.x"
+            if line.startswith("# ") and \
+                    line[2:].split(" ", 1)[0].endswith("BLAST"):
+                if query is not None:
+                    yield query, "".join(lines)
+                query = None
+                lines = []
+            elif line.startswith("# Query: "):
+                query = line[9:].split()[0]
+            lines.append(line)
+    if query is not None:
+        yield query, "".join(lines)
+
+
 def parse_cdhit_clusters(cdhit_file: Path) -> Dict:
     """
     Parses CD-HIT cluster files
@@ -269,52 +384,64 @@ def parse_ecod_domains(ecod_domains_file: Path) -> Dict:
     return domains
 
 
-def parse_ska_db(ska_file: Path,
-                 psd_threshold: Optional[float] = None) -> Dict:
+def parse_ecod_mapping(ecod_mapping_file: Path) -> Dict[str, List[str]]:
     """
-    Parses files generated by our `ska-db` command
+    Parses the mapping files generated by our `extract-domains-ecod` command
 
     Parameters
     ----------
-    ska_file : Path
-        Path to the ECOD `domain.txt` files
-    psd_threshold : float, optional
-        if provided, only PSD values below this threshold will be included in
-        the result.
+    ecod_mapping_file : Path
+        Path to the ECOD mapping file (tsv)
 
     Returns
     -------
     Dict
         A dictionary with the following structure:
         {
-            "<query>":{
-                "<subject>": {
-                    "PSD": "...",
-                    "RMSD": "...",
-                    "alignment": {
-                                    "start_query": "..."
-                                    "sse_query": "..."
-                                    "seq_query": "..."
-                                    "start_subject": "..."
-                                    "sse_subject": "..."
-                                    "seq_subject": "..."
-                                 }
-                },
-                ...
-            },
+            "<ecod_domain_id>": ["<PDB ID>_<PDB chain>", ...],
             ...
         }
+    """
+    ecod_mapping = {}
+    with ecod_mapping_file.open() as emf:
+        for line in emf:
+            if line.startswith("#"):
+                continue
+            pdb_chain, _, ecod_domain_id, _ = line.strip().split("\t")
+            if ecod_domain_id not in ecod_mapping:
+                ecod_mapping[ecod_domain_id] = []
+            ecod_mapping[ecod_domain_id].append(pdb_chain)
+    return ecod_mapping
 
-    Note
-    ----
 
-    for a given query and subject, if there is an alignmet error in the SKA
-    file, the subject entry won't be added.
+def iter_ska_db(ska_file: Path,
+                psd_threshold: Optional[float] = None
+                ) -> Iterator[Tuple[str, str, Dict]]:
+    """
+    Iterates over the alignments in files generated by our `ska-db` command,
+    one at a time, without loading the whole file.
+
+    Parameters
+    ----------
+    ska_file : Path
+        Path to the `.ska` file
+    psd_threshold : float, optional
+        if provided, only PSD values below this threshold will be included in
+        the result.
+
+    Yields
+    ------
+    str
+        query
+    str
+        subject
+    Dict
+        A dictionary with the same structure as the subject entries returned
+        by `parse_ska_db`
     """
     # TODO(mateo): resSeq appears with iCode sometimes, maybe fix this
     if psd_threshold is None:
         psd_threshold = float("inf")
-    ska_matches = {}
     query = ""
     subject = ""
     current_match = {
@@ -330,9 +457,7 @@ def parse_ska_db(ska_file: Path,
             if line.startswith("SKA:"):
                 if all([query, subject, "PSD" in current_match]) and \
                         current_match["PSD"] <= psd_threshold:
-                    if query not in ska_matches:
-                        ska_matches[query] = {}
-                    ska_matches[query][subject] = current_match
+                    yield query, subject, current_match
                 _, pair = line.strip().split(":")
                 quer, subj = pair.split(",")
                 _, query = quer.split("=")
@@ -381,12 +506,116 @@ def parse_ska_db(ska_file: Path,
 
     if all([query, subject, "PSD" in current_match]) and\
             current_match["PSD"] <= psd_threshold:
+        yield query, subject, current_match
+
+
+def parse_ska_db(ska_file: Path,
+                 psd_threshold: Optional[float] = None) -> Dict:
+    """
+    Parses files generated by our `ska-db` command
+
+    Parameters
+    ----------
+    ska_file : Path
+        Path to the `.ska` file
+    psd_threshold : float, optional
+        if provided, only PSD values below this threshold will be included in
+        the result.
+
+    Returns
+    -------
+    Dict
+        A dictionary with the following structure:
+        {
+            "<query>":{
+                "<subject>": {
+                    "PSD": "...",
+                    "RMSD": "...",
+                    "alignment": {
+                                    "start_query": "..."
+                                    "sse_query": "..."
+                                    "seq_query": "..."
+                                    "start_subject": "..."
+                                    "sse_subject": "..."
+                                    "seq_subject": "..."
+                                 }
+                },
+                ...
+            },
+            ...
+        }
+
+    Note
+    ----
+
+    for a given query and subject, if there is an alignmet error in the SKA
+    file, the subject entry won't be added.
+    """
+    ska_matches = {}
+    for query, subject, match in iter_ska_db(ska_file, psd_threshold):
         if query not in ska_matches:
             ska_matches[query] = {}
-        ska_matches[query][subject] = current_match
+        ska_matches[query][subject] = match
     return ska_matches
 
 
+def parse_ska_scores(ska_file: Path,
+                     psd_threshold: Optional[float] = None
+                     ) -> Dict[Tuple[str, str], Tuple[float, float]]:
+    """
+    Parses only the scores of files generated by our `ska-db` command. The
+    alignment blocks are skipped, which makes this much faster and lighter
+    than `parse_ska_db` when the alignments are not needed.
+
+    Parameters
+    ----------
+    ska_file : Path
+        Path to the `.ska` file
+    psd_threshold : float, optional
+        if provided, only PSD values below this threshold will be included in
+        the result.
+
+    Returns
+    -------
+    Dict
+        A dictionary with the following structure:
+        {
+            ("<query>", "<subject>"): (PSD, RMSD),
+            ...
+        }
+        RMSD is None if it is missing from the file.
+
+    Note
+    ----
+    As in `parse_ska_db`, pairs without a PSD (e.g. alignment errors) are
+    not included.
+    """
+    if psd_threshold is None:
+        psd_threshold = float("inf")
+    scores = {}
+    pair = None
+    psd = None
+    rmsd = None
+    with ska_file.open() as db:
+        for line in db:
+            first = line[:1]
+            if first == "S" and line.startswith("SKA:"):
+                if pair is not None and psd is not None \
+                        and psd <= psd_threshold:
+                    scores[pair] = (psd, rmsd)
+                quer, subj = line.strip()[4:].split(",")
+                pair = (quer.split("=")[1], subj.split("=")[1])
+                psd = None
+                rmsd = None
+            elif first == "R" and line.startswith("RMSD"):
+                rmsd = float(line.split(":")[1])
+            elif first == "P" and line.startswith("PSD"):
+                psd = float(line.split(":")[1])
+    if pair is not None and psd is not None and psd <= psd_threshold:
+        scores[pair] = (psd, rmsd)
+    return scores
+
+
 def parse_homstrad_alignments(homstrad_file: Path):
     """
     Parses the `homstrad_alignments.txt` file distributed with Foldseek
@@ -0,0 +1,255 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+import logging
+import os
+import tempfile
+
+
+log = logging.getLogger(__name__)
+
+INDEX_HEADER = "# sif pdb index v1\n"
+# suffixes of the entry files, in order of preference when an entry has
+# several files (e.g. `pdb1abc.pdb` and `pdb1abc.ent.gz`)
+SUFFIXES = (".pdb", ".ent.gz")
+
+
+def entry_key(name: str) -> Optional[str]:
+    """
+    Returns the lookup key of a file in the PDB mirror: `<pdb_id>_<chain>`
+    for chain files (`pdb<pdb_id>_<chain>.pdb`), `<pdb_id>` for entry files
+    (`pdb<pdb_id>.pdb` or `pdb<pdb_id>.ent.gz`), and None for anything else.
+    """
+    if not name.startswith("pdb"):
+        return None
+    for suffix in SUFFIXES:
+        if name.endswith(suffix):
+            return name[3:-len(suffix)]
+    return None
+
+
+def _preference(name: str) -> int:
+    return next(i for i, suffix in enumerate(SUFFIXES)
+                if name.endswith(suffix))
+
+
+class PDBResolver:
+    """
+    Resolves PDB IDs and chains to files in a PDB mirror indexed by the
+    center of the PDB ID (e.g. `<pdb_dir>/ab/pdb1abc_A.pdb`).
+
+    The mirror is scanned once and the result (path, mtime and size of every
+    entry) is persisted to `index_file`. Later instances only rescan the
+    subdirectories whose mtime changed since the index was written, so
+    resolving paths costs one `stat` per subdirectory instead of one
+    `stat`/`glob` per entry.
+
+    If an entry has several files, the first one in `SUFFIXES` order is
+    used.
+
+    Only adding, removing or renaming files changes the mtime of a
+    subdirectory, so files replaced in place are not detected (the paths
+    stay valid, but `stat` returns their old mtime and size). Neither are
+    changes made within the mtime granularity of the filesystem (coarse on
+    some NFS servers) after the subdirectory was scanned. Use `rescan` (or
+    `refresh(force=True)`) after such changes.
+
+    Parameters
+    ----------
+    pdb_dir : Path
+        Path to the PDB mirror
+    index_file : Path, optional
+        Path to the persisted index, defaults to `<pdb_dir>/.sif-pdb-index`
+    subdirs : Iterable[str], optional
+        If given, only these subdirectories are scanned
+    persist : bool, default True
+        If false, the index is neither read from nor written to disk
+    num_threads : int, optional
+        Number of subdirectories scanned concurrently, which hides the
+        latency of network filesystems. Defaults to the `ThreadPoolExecutor`
+        default, 1 scans serially
+    rescan : bool, default False
+        If true, every subdirectory is rescanned, even if its mtime did not
+        change
+    """
+
+    def __init__(self,
+                 pdb_dir: Path,
+                 index_file: Optional[Path] = None,
+                 subdirs: Optional[Iterable[str]] = None,
+                 persist: bool = True,
+                 num_threads: Optional[int] = None,
+                 rescan: bool = False):
+        assert pdb_dir.is_dir(), f"{pdb_dir} is not a directory"
+        self.pdb_dir = pdb_dir
+        if index_file is None:
+            index_file = pdb_dir / ".sif-pdb-index"
+        self.index_file = index_file
+        self.persist = persist
+        self.num_threads = num_threads
+        # subdir -> mtime_ns when it was scanned
+        self.dir_mtimes: Dict[str, int] = {}
+        # subdir -> {file name: (mtime_ns, size)}
+        self.files: Dict[str, Dict[str, Tuple[int, int]]] = {}
+        if persist and index_file.is_file():
+            self._load()
+        if not self.refresh(subdirs, rescan):
+            self._build_keys()
+
+    def _load(self):
+        with self.index_file.open() as idx:
+            if idx.readline() != INDEX_HEADER:
+                log.warning(f"{self.index_file} has an unknown format,"
+                            " rebuilding it")
+                return
+            try:
+                for line in idx:
+                    row = line.rstrip("\n").split("\t")
+                    if row[0] == "D":
+                        self.dir_mtimes[row[1]] = int(row[2])
+                        self.files[row[1]] = {}
+                    else:
+                        self.files[row[1]][row[2]] = (int(row[3]),
+                                                      int(row[4]))
+            except (IndexError, ValueError, KeyError):
+                log.warning(f"{self.index_file} is corrupted, rebuilding it")
+                self.dir_mtimes = {}
+                self.files = {}
+
+    def refresh(self,
+                subdirs: Optional[Iterable[str]] = None,
+                force: bool = False) -> int:
+        """
+        Rescans the subdirectories that are new or were modified since they
+        were last scanned (all of them if `force`), and forgets the ones
+        that no longer exist. Returns the number of rescanned
+        subdirectories.
+        """
+        if subdirs is None:
+            current = {e.name: e.stat().st_mtime_ns
+                       for e in os.scandir(self.pdb_dir) if e.is_dir()}
+            for removed in set(self.dir_mtimes) - set(current):
+                del self.dir_mtimes[removed]
+                del self.files[removed]
+        else:
+            current = {}
+            for subdir in subdirs:
+                try:
+                    current[subdir] = os.stat(
+                        self.pdb_dir / subdir).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+        stale = [subdir for subdir, mtime in current.items()
+                 if force or self.dir_mtimes.get(subdir) != mtime]
+        if self.num_threads == 1 or len(stale) <= 1:
+            scanned = map(self._scan, stale)
+        else:
+            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                scanned = list(executor.map(self._scan, stale))
+        for subdir, files in zip(stale, scanned):
+            self.files[subdir] = files
+            self.dir_mtimes[subdir] = current[subdir]
+        rescanned = len(stale)
+        if rescanned:
+            log.info(f"scanned {rescanned} subdirectories of {self.pdb_dir}")
+            self._build_keys()
+            if self.persist:
+                self.save()
+        return rescanned
+
+    def _scan(self, subdir: str) -> Dict[str, Tuple[int, int]]:
+        files = {}
+        for entry in os.scandir(self.pdb_dir / subdir):
+            if entry_key(entry.name) is not None and entry.is_file():
+                st = entry.stat()
+                files[entry.name] = (st.st_mtime_ns, st.st_size)
+        return files
+
+    def _build_keys(self):
+        self.keys: Dict[str, Path] = {}
+        # pdb_id -> {chain: key}
+        self.entry_chains: Dict[str, Dict[str, str]] = {}
+        # pdb_id -> {upper case chain: keys}
+        self.folded_chains: Dict[str, Dict[str, List[str]]] = {}
+        collisions = 0
+        for subdir, files in sorted(self.files.items()):
+            for name in sorted(files):
+                key = entry_key(name)
+                other = self.keys.get(key)
+                if other is not None:
+                    collisions += 1
+                    log.debug(f"{other} and {subdir}/{name} are both {key}")
+                    if _preference(other.name) <= _preference(name):
+                        continue
+                self.keys[key] = self.pdb_dir / subdir / name
+                if other is None and "_" in key:
+                    pdb_id, chain = key.split("_", 1)
+                    self.entry_chains.setdefault(pdb_id, {})[chain] = key
+                    self.folded_chains.setdefault(pdb_id, {}).setdefault(
+                        chain.upper(), []).append(key)
+        if collisions:
+            log.warning(f"{collisions} entries of {self.pdb_dir} have"
+                        " several files, using the first of"
+                        f" {', '.join(SUFFIXES)}")
+
+    def save(self):
+        tmp_file = None
+        try:
+            # unique, so concurrent instances do not write the same file
+            with tempfile.NamedTemporaryFile(
+                    "w", dir=self.index_file.parent,
+                    prefix=f"{self.index_file.name}.", suffix=".tmp",
+                    delete=False) as idx:
+                tmp_file = Path(idx.name)
+                idx.write(INDEX_HEADER)
+                for subdir in sorted(self.files):
+                    idx.write(f"D\t{subdir}\t{self.dir_mtimes[subdir]}\n")
+                    for name, (mtime, size) in sorted(
+                            self.files[subdir].items()):
+                        idx.write(f"F\t{subdir}\t{name}\t{mtime}\t{size}\n")
+            # readable by the other users of the mirror, as `open` would
+            os.chmod(tmp_file, 0o644)
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            log.warning(f"could not save the PDB index: {e}")
+            if tmp_file is not None:
+                tmp_file.unlink(missing_ok=True)
+
+    def path(self, key: str) -> Optional[Path]:
+        """
+        Returns the path of `key`, either `<pdb_id>_<chain>` or `<pdb_id>`,
+        or None if it is not in the mirror.
+        """
+        return self.keys.get(key)
+
+    def stat(self, key: str) -> Optional[Tuple[int, int]]:
+        """
+        Returns the (mtime_ns, size) of `key` when it was indexed, or None.
+        """
+        path = self.keys.get(key)
+        if path is None:
+            return None
+        return self.files[path.parent.name][path.name]
+
+    def chains(self, pdb_id: str) -> Dict[str, Path]:
+        """
+        Returns a dictionary mapping the chains of `pdb_id` to their files.
+        """
+        return {chain: self.keys[key] for chain, key
+                in self.entry_chains.get(pdb_id, {}).items()}
+
+    def chain_path(self,
+                   pdb_id: str,
+                   chain: str,
+                   case_sensitive: bool = True) -> Optional[Path]:
+        """
+        Returns the file of `chain` in `pdb_id`. If `case_sensitive` is
+        false, chain IDs are compared ignoring case, and the match is only
+        returned if it is unique.
+        """
+        key = self.entry_chains.get(pdb_id, {}).get(chain)
+        if key is None and not case_sensitive:
+            matches = self.folded_chains.get(pdb_id, {}).get(chain.upper(), [])
+            if len(matches) == 1:
+                key = matches[0]
+        return None if key is None else self.keys[key]
@@ -0,0 +1,177 @@
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+from siflib.io.parsers import iter_ska_db
+import sqlite3
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ska (
+    query TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    psd REAL NOT NULL,
+    rmsd REAL,
+    start_query TEXT,
+    sse_query TEXT,
+    seq_query TEXT,
+    start_subject TEXT,
+    sse_subject TEXT,
+    seq_subject TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ska_pair ON ska (query, subject);
+CREATE INDEX IF NOT EXISTS ska_query_psd ON ska (query, psd);
+"""
+
+_ALIGNMENT_COLUMNS = ["start_query", "sse_query", "seq_query",
+                      "start_subject", "sse_subject", "seq_subject"]
+
+
+def build_ska_store(ska_files: Iterable[Path],
+                    store_file: Path,
+                    batch_size: int = 10000) -> int:
+    """
+    Converts `.ska` files into a SQLite store with one row per
+    (query, subject) pair. Pairs already in the store are replaced, so
+    files can be added to an existing store.
+
+    A new store is built in a temporary file without journaling, and moved
+    in place once complete. An existing store is updated with SQLite's
+    default journaling, so an interrupted update is rolled back instead of
+    corrupting it.
+
+    Parameters
+    ----------
+    ska_files : Iterable[Path]
+        Paths to files generated by our `ska-db` command
+    store_file : Path
+        Path to the SQLite store, it will be created if it doesn't exist
+    batch_size : int, default 10000
+        Number of rows inserted per transaction
+
+    Returns
+    -------
+    int
+        Number of alignments written to the store
+    """
+    fresh = not store_file.exists()
+    if fresh:
+        db_file = store_file.with_name(f"{store_file.name}.tmp")
+        db_file.unlink(missing_ok=True)
+    else:
+        db_file = store_file
+    con = sqlite3.connect(db_file)
+    if fresh:
+        # nothing to protect until the store is moved in place
+        con.execute("PRAGMA journal_mode = OFF")
+        con.execute("PRAGMA synchronous = OFF")
+    con.executescript(_SCHEMA)
+    insert = ("INSERT OR REPLACE INTO ska VALUES"
+              " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+    total = 0
+    for ska_file in ska_files:
+        log.info(f"adding {ska_file}")
+        rows = []
+        for query, subject, match in iter_ska_db(ska_file):
+            alignment = match["alignment"]
+            rows.append((query, subject, match["PSD"], match.get("RMSD"),
+                         *[alignment.get(c) for c in _ALIGNMENT_COLUMNS]))
+            if len(rows) == batch_size:
+                with con:
+                    con.executemany(insert, rows)
+                total += len(rows)
+                rows = []
+        with con:
+            con.executemany(insert, rows)
+        total += len(rows)
+    con.close()
+    if fresh:
+        os.replace(db_file, store_file)
+    log.info(f"{total} alignments written to {store_file}")
+    return total
+
+
+class SkaStore:
+    """
+    Read-only access to a store created with `build_ska_store`.
+
+    Lookups use the (query, subject) and (query, PSD) indices of the store,
+    so a single pair, or all the subjects of a query under a PSD threshold,
+    can be fetched without parsing any `.ska` file.
+    """
+
+    def __init__(self, store_file: Path):
+        assert store_file.is_file(), f"{store_file} is not a file"
+        self.con = sqlite3.connect(f"file:{store_file}?mode=ro", uri=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.con.close()
+
+    def queries(self) -> List[str]:
+        return [q for q, in self.con.execute(
+            "SELECT DISTINCT query FROM ska ORDER BY query")]
+
+    def get(self, query: str, subject: str) -> Optional[Dict]:
+        """
+        Returns the alignment of `query` and `subject`, with the same
+        structure as the subject entries returned by `parse_ska_db`, or None
+        if the pair is not in the store.
+        """
+        row = self.con.execute(
+            "SELECT psd, rmsd, " + ", ".join(_ALIGNMENT_COLUMNS) +
+            " FROM ska WHERE query = ? AND subject = ?",
+            (query, subject)).fetchone()
+        if row is None:
+            return None
+        return self._to_match(row)
+
+    def scores(self,
+               query: str,
+               psd_threshold: Optional[float] = None
+               ) -> Dict[str, Tuple[float, float]]:
+        """
+        Returns a dictionary mapping the subjects of `query` with a
+        PSD <= `psd_threshold` (all of them if not provided) to their
+        (PSD, RMSD) scores.
+        """
+        if psd_threshold is None:
+            psd_threshold = float("inf")
+        cur = self.con.execute(
+            "SELECT subject, psd, rmsd FROM ska"
+            " WHERE query = ? AND psd <= ?", (query, psd_threshold))
+        return {subject: (psd, rmsd) for subject, psd, rmsd in cur}
+
+    def matches(self,
+                query: str,
+                psd_threshold: Optional[float] = None) -> Dict:
+        """
+        Returns the alignments of `query` with a PSD <= `psd_threshold`, with
+        the same structure returned by `parse_ska_db` for a `.ska` file.
+        """
+        if psd_threshold is None:
+            psd_threshold = float("inf")
+        cur = self.con.execute(
+            "SELECT subject, psd, rmsd, " + ", ".join(_ALIGNMENT_COLUMNS) +
+            " FROM ska WHERE query = ? AND psd <= ?", (query, psd_threshold))
+        subjects = {row[0]: self._to_match(row[1:]) for row in cur}
+        return {query: subjects} if subjects else {}
+
+    @staticmethod
+    def _to_match(row: Tuple) -> Dict:
+        psd, rmsd, *alignment = row
+        match = {
+            "PSD": psd,
+            "alignment": {c: v for c, v in zip(_ALIGNMENT_COLUMNS, alignment)
+                          if v is not None},
+        }
+        if rmsd is not None:
+            match["RMSD"] = rmsd
+        return match
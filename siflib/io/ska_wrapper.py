@@ -1,17 +1,25 @@
 from pathlib import Path
-from typing import Dict, Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Set
 import subprocess
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import queue
 import threading
 from subprocess import PIPE, STDOUT
+from siflib.core.scheduler import bounded_map, default_window
+from siflib.io.mapping_index import read_mapping_members
 import logging
 import io
 import shutil
+import shlex
+import os
+import time
 
 
 log = logging.getLogger(__name__)
 
+# maximum number of seconds between two syncs of a streaming checkpoint
+CHECKPOINT_INTERVAL = 5
+
 
 def run_ska(pdb1: str,
             pdb1_path: str,
@@ -25,6 +33,149 @@ def run_ska(pdb1: str,
     return pdb1, pdb2, p.stdout
 
 
+def run_ska_argv(pdb1: str,
+                 pdb1_path: str,
+                 pdb2: str,
+                 pdb2_path: str,
+                 argv: List[str],
+                 env: Optional[Dict]) -> Tuple[str, str, str]:
+    """
+    Same as `run_ska`, but executes `argv` directly instead of going through
+    `/bin/sh`. `argv` is the command line of the ska binary (see
+    `ska_command`), the two PDB paths are appended to it.
+    """
+    p = subprocess.run(argv + [pdb1_path, pdb2_path], env=env,
+                       stdout=PIPE, stderr=STDOUT, text=True)
+    return pdb1, pdb2, p.stdout
+
+
+def ska_command(skabin: str,
+                env: Dict,
+                container: Optional[str] = None) -> Tuple[List[str],
+                                                          Optional[Dict]]:
+    """
+    Builds the argument vector and environment used by the `exec` backend.
+
+    Parameters
+    ----------
+    skabin : str
+        Path to the ska binary. If `container` is given, this is the path of
+        the binary inside the container.
+    env : Dict
+        Environment for ska (TROLLTOP and SUBMAT)
+    container : str, optional
+        Name or ID of an already running container. Every alignment is run
+        with `docker exec` in this container, instead of starting a new one.
+
+    Returns
+    -------
+    List
+        argv prefix, the two PDB paths are appended to it for each pair
+    Dict
+        environment for the spawned process, None means the current one
+    """
+    argv = shlex.split(skabin)
+    if container is not None:
+        docker = ["docker", "exec"]
+        for key, value in env.items():
+            docker.extend(["-e", f"{key}={value}"])
+        # the docker client needs the caller's environment (PATH, HOME, ...)
+        return docker + [container] + argv, None
+    # `env` has no PATH, so the binary is resolved here once
+    argv[0] = shutil.which(argv[0]) or argv[0]
+    return argv, env
+
+
+def ska_scores_only(output: str,
+                    psd_cutoff: float) -> str:
+    """
+    Reduces the output of ska to its RMSD and PSD lines when the PSD is above
+    `psd_cutoff`. Alignments with a PSD <= `psd_cutoff`, and outputs without
+    a PSD (e.g. alignment errors), are returned unchanged.
+
+    The result is still readable by `parse_ska_db`, the subject is reported
+    with its scores and an empty alignment.
+    """
+    scores = []
+    psd = None
+    for line in output.split("\n"):
+        if line.startswith("RMSD"):
+            scores.append(line)
+        elif line.startswith("PSD"):
+            scores.append(line)
+            psd = float(line.split(":")[-1])
+    if psd is None or psd <= psd_cutoff:
+        return output
+    return "\n".join(scores)
+
+
+# state of each pool worker, set once by `_init_ska_worker`
+_worker_ska = {}
+
+
+def _init_ska_worker(skabin: str,
+                     env: Dict,
+                     backend: str,
+                     container: Optional[str],
+                     prefilter_psd: Optional[float]) -> None:
+    _worker_ska["prefilter_psd"] = prefilter_psd
+    _worker_ska["backend"] = backend
+    if backend == "exec":
+        argv, argv_env = ska_command(skabin, env, container)
+        _worker_ska["argv"] = argv
+        _worker_ska["env"] = argv_env
+    else:
+        _worker_ska["skabin"] = skabin
+        _worker_ska["env"] = env
+
+
+def _run_ska_task(pdb1: str,
+                  pdb1_path: str,
+                  pdb2: str,
+                  pdb2_path: str) -> Tuple[str, str, str]:
+    if _worker_ska["backend"] == "exec":
+        result = run_ska_argv(pdb1, pdb1_path, pdb2, pdb2_path,
+                              _worker_ska["argv"], _worker_ska["env"])
+    else:
+        result = run_ska(pdb1, pdb1_path, pdb2, pdb2_path,
+                         _worker_ska["skabin"], _worker_ska["env"])
+    if _worker_ska["prefilter_psd"] is not None:
+        pdb1, pdb2, output = result
+        result = pdb1, pdb2, ska_scores_only(output,
+                                             _worker_ska["prefilter_psd"])
+    return result
+
+
+def _ska_executor(num_cpu: Optional[int],
+                  skabin: str,
+                  env: Dict,
+                  backend: str = "shell",
+                  container: Optional[str] = None,
+                  prefilter_psd: Optional[float] = None
+                  ) -> ProcessPoolExecutor:
+    """
+    Creates a pool whose long-lived workers know how to run ska, so that each
+    task only carries the pair of structures to align.
+
+    `backend` is either "shell", which runs `skabin` through `/bin/sh` for
+    every pair, or "exec", which executes the binary directly (see
+    `ska_command`).
+
+    If `prefilter_psd` is given, workers only return the full alignment for
+    pairs with a PSD <= `prefilter_psd`, and only the scores for every other
+    pair (see `ska_scores_only`).
+    """
+    if backend not in ("shell", "exec"):
+        raise ValueError(f"unknown ska backend: {backend}")
+    if container is not None and backend != "exec":
+        raise ValueError("running ska in a container requires the exec"
+                         " backend")
+    return ProcessPoolExecutor(max_workers=num_cpu,
+                               initializer=_init_ska_worker,
+                               initargs=(skabin, env, backend, container,
+                                         prefilter_psd))
+
+
 # This implementation writes each result to an individual file
 def run_ska_file(pdb1: str,
                  pdb1_path: str,
@@ -43,6 +194,281 @@ def run_ska_file(pdb1: str,
                              skabin, env))
 
 
+def _write_ska_block(of, query: str, subject: str, output: str) -> None:
+    of.write(f"SKA: query={query}, subject={subject}\n")
+    of.write(f"{output}\n")
+
+
+def _load_checkpoint(outfile: Path, ckptfile: Path) -> Set[str]:
+    """
+    Reads the checkpoint log of a partially written `.ska` file and truncates
+    the `.ska` file right after the last block recorded in it, discarding any
+    block that was interrupted while being written.
+
+    Parameters
+    ----------
+    outfile : Path
+        Path to the partially written `.ska` file
+    ckptfile : Path
+        Path to the checkpoint log, each line is `<subject>\t<offset>` where
+        `offset` is the size of `outfile` after the block was written
+
+    Returns
+    -------
+    Set
+        subjects that are already aligned in `outfile`
+
+    Note
+    ----
+    The log is read up to its first invalid line: a line that was torn
+    while being written (no trailing newline, or an offset that does not
+    parse), an offset smaller than the previous one, or an offset past the
+    end of `outfile`. The log is rewritten with the lines before it.
+    """
+    done = set()
+    if not (outfile.is_file() and ckptfile.is_file()):
+        return done
+    size = outfile.stat().st_size
+    offset = 0
+    valid = []
+    with ckptfile.open() as cf:
+        for line in cf:
+            if not line.endswith("\n"):
+                break
+            row = line[:-1].split("\t")
+            if len(row) != 2:
+                break
+            try:
+                block_end = int(row[1])
+            except ValueError:
+                break
+            if block_end < offset or block_end > size:
+                break
+            done.add(row[0])
+            offset = block_end
+            valid.append(line)
+    with outfile.open("r+") as of:
+        of.truncate(offset)
+    tmp_file = ckptfile.with_name(f"{ckptfile.name}.tmp")
+    with tmp_file.open("w") as cf:
+        cf.writelines(valid)
+        cf.flush()
+        os.fsync(cf.fileno())
+    os.replace(tmp_file, ckptfile)
+    return done
+
+
+def _align_query(query_id: str,
+                 query_path: str,
+                 database: Dict[str, str],
+                 outfile: Path,
+                 donefile: Path,
+                 batch_size: int,
+                 executor: ProcessPoolExecutor,
+                 max_in_flight: int,
+                 stream: bool = False) -> None:
+    """
+    Aligns `query_id` against every entry in `database` and writes the
+    results to `outfile`, creating `donefile` once everything is on disk.
+
+    Parameters
+    ----------
+    query_id : str
+        ID of the query, used in the `SKA:` header of each block
+    query_path : str
+        Path to the query PDB file
+    database : Dict
+        Maps subject IDs to their PDB paths
+    outfile : Path
+        Path to the `.ska` file
+    donefile : Path
+        Path to the `.ska.done` marker
+    batch_size : int
+        Number of jobs between progress reports, and, when streaming, the
+        maximum number of blocks written between two checkpoints
+    executor : ProcessPoolExecutor
+        Pool created with `_ska_executor`, it can be shared by several
+        queries
+    max_in_flight : int
+        Maximum number of pairs submitted to `executor` and not gathered yet
+    stream : bool, default False
+        If true, each `SKA: query=..., subject=...` block is appended to
+        `outfile` as soon as it arrives, instead of keeping all of them in
+        memory until the end. `donefile` is only written after the output
+        has been fsync'ed.
+
+        Streaming runs keep a checkpoint log next to `outfile`
+        (`<query>.ska.ckpt`), synced every `batch_size` blocks or
+        `CHECKPOINT_INTERVAL` seconds. If a streaming run is interrupted,
+        running it again resumes from the checkpoint and only aligns the
+        subjects that are missing from `outfile`. Streaming is turned on
+        for queries that have a checkpoint, so they resume even if `stream`
+        is false. Non-streaming runs write no checkpoint and cannot resume.
+    """
+    results = {}
+    # bounded, so finished pairs wait in the pool rather than in memory
+    # when the gatherer falls behind
+    results_queue = queue.Queue(maxsize=max_in_flight)
+    of = None
+    cf = None
+    ckptfile = outfile.with_name(f"{outfile.name}.ckpt")
+    if not stream and ckptfile.is_file():
+        log.info(f"{ckptfile} found, resuming in streaming mode")
+        stream = True
+    if stream:
+        done = _load_checkpoint(outfile, ckptfile)
+        if done:
+            log.info(f"Resuming from {ckptfile}, {len(done)} subjects done")
+            database = {pdb_id: pdb_path
+                        for pdb_id, pdb_path in database.items()
+                        if pdb_id not in done}
+        of = outfile.open("a" if done else "w")
+        cf = ckptfile.open("a" if done else "w")
+    total = len(database)
+
+    # checkpoint lines of the blocks written since the last sync
+    pending = []
+    last_sync = time.monotonic()
+
+    def sync():
+        nonlocal last_sync
+        # the blocks must be on disk before the checkpoint says so, an
+        # unsynced tail is truncated by `_load_checkpoint` when resuming
+        of.flush()
+        os.fsync(of.fileno())
+        cf.writelines(pending)
+        cf.flush()
+        os.fsync(cf.fileno())
+        pending.clear()
+        last_sync = time.monotonic()
+
+    errors = []
+
+    def gatherer_worker():
+        try:
+            while True:
+                _, subject, output = results_queue.get()
+                if subject is None and output is None:
+                    break
+                if stream:
+                    _write_ska_block(of, query_id, subject, output)
+                    pending.append(f"{subject}\t{of.tell()}\n")
+                    if len(pending) >= batch_size or time.monotonic() - \
+                            last_sync >= CHECKPOINT_INTERVAL:
+                        sync()
+                else:
+                    results[subject] = output
+                results_queue.task_done()
+        except Exception as e:
+            errors.append(e)
+
+    def put(item):
+        # the queue is bounded, so stop waiting if the gatherer died
+        while True:
+            try:
+                results_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not gatherer_thread.is_alive():
+                    raise RuntimeError(f"writing {outfile} failed") \
+                        from errors[0] if errors else None
+
+    # a daemon, so an interrupted run does not wait for it forever
+    gatherer_thread = threading.Thread(target=gatherer_worker, daemon=True)
+    gatherer_thread.start()
+
+    log.info(f"Aligning {total} pairs in parallel...")
+    tasks = ((query_id, query_path, pdb_id, pdb_path)
+             for pdb_id, pdb_path in database.items())
+    for result in bounded_map(executor, _run_ska_task, tasks,
+                              max_in_flight, total, batch_size, "pairs"):
+        put(result)
+    log.info("Submitting sentinel to queue...")
+    put((None, None, None))
+    gatherer_thread.join()
+    if errors:
+        raise RuntimeError(f"writing {outfile} failed") from errors[0]
+
+    if stream:
+        log.info(f"Syncing results to {outfile}")
+        sync()
+        of.close()
+        cf.close()
+    else:
+        log.info("Building result buffer")
+        result_buffer = io.StringIO()
+        log.info(f"len results = {len(results)}")
+        for key, output_str in results.items():
+            _write_ska_block(result_buffer, query_id, key, output_str)
+        log.info(f"Writing results to {outfile}")
+
+        with outfile.open("w") as of:
+            result_buffer.seek(0)
+            shutil.copyfileobj(result_buffer, of)
+    with donefile.open("w") as of:
+        of.write("FINISHED")
+    if stream:
+        ckptfile.unlink()
+    log.info("Done")
+
+
+def read_structure_list(info_file: Path) -> Dict[str, str]:
+    """
+    Reads a `ska-db` query or database file (`id path` per line) into a
+    dictionary mapping IDs to structure paths.
+    """
+    structures = {}
+    with info_file.open() as fi:
+        for line in fi:
+            pdb_id, pdb_path = line.strip().split()
+            structures[pdb_id] = pdb_path
+    return structures
+
+
+def align_queries(queries: Dict[str, str],
+                  database: Dict[str, str],
+                  output_dir: Path,
+                  submat: str,
+                  trolltop: str,
+                  skabin: str,
+                  batch_size: int = 1000,
+                  num_cpu: Optional[int] = None,
+                  stream: bool = False,
+                  backend: str = "shell",
+                  container: Optional[str] = None,
+                  prefilter_psd: Optional[float] = None,
+                  max_in_flight: Optional[int] = None):
+    """
+    Aligns each query in `queries` against every structure in `database`
+    with a single pool of workers, writing `<output_dir>/<query>.ska` and
+    its `.done` marker. Queries that are already done are not skipped here,
+    callers are expected to pass only the pending ones.
+
+    Parameters
+    ----------
+    queries : Dict[str, str]
+        Query IDs mapped to their structure paths
+    database : Dict[str, str]
+        Database IDs mapped to their structure paths
+    output_dir : Path
+        Directory where the `.ska` files are written
+
+    The remaining parameters are the same as in `run`.
+    """
+    env = {"TROLLTOP": trolltop, "SUBMAT": submat}
+    if max_in_flight is None:
+        max_in_flight = default_window(num_cpu)
+    with _ska_executor(num_cpu, skabin, env, backend,
+                       container, prefilter_psd) as executor:
+        for query_element, query_path in queries.items():
+            log.info(f"query = {query_element}")
+            outfile = output_dir / f"{query_element}.ska"
+            donefile = output_dir / f"{query_element}.ska.done"
+            _align_query(query_element, query_path, database,
+                         outfile, donefile, batch_size, executor,
+                         max_in_flight, stream)
+
+
 def run(query_info: Path,
         database_info: Path,
         output_dir: Path,
@@ -51,84 +477,43 @@ def run(query_info: Path,
         skabin: str,
         array_idx: int = 0,
         batch_size: int = 1000,
-        num_cpu: Optional[int] = None):
-    env = {"TROLLTOP": trolltop, "SUBMAT": submat}
-
-    query = {}
-    with query_info.open() as qi:
-        for line in qi:
-            pdb_id, pdb_path = line.strip().split()
-            query[pdb_id] = pdb_path
+        num_cpu: Optional[int] = None,
+        stream: bool = False,
+        queries_per_task: int = 1,
+        backend: str = "shell",
+        container: Optional[str] = None,
+        prefilter_psd: Optional[float] = None,
+        max_in_flight: Optional[int] = None):
+    query = read_structure_list(query_info)
     query_list = sorted(query.keys())
-    query_element = query_list[array_idx]
-    log.info(f"query_list[{array_idx}] = {query_element}")
-
-    outfile = output_dir / f"{query_element}.ska"
-    donefile = output_dir / f"{query_element}.ska.done"
-
-    if donefile.exists():
+    # each array task handles a contiguous slice of `queries_per_task` queries
+    first = array_idx * queries_per_task
+    query_slice = query_list[first:first + queries_per_task]
+    if not query_slice:
+        log.error(f"array index {array_idx} is out of range")
+        exit(1)
+    pending = {}
+    for query_element in query_slice:
+        donefile = output_dir / f"{query_element}.ska.done"
+        if donefile.exists():
+            log.info(f"Computation already finished for {query_element}")
+        else:
+            pending[query_element] = query[query_element]
+    log.info(f"query_list[{first}:{first + len(query_slice)}]:"
+             f" {len(pending)} of {len(query_slice)} queries pending")
+
+    if not pending:
         log.info("Computation already finished, done")
         exit(0)
 
-    database = {}
     log.info("collecting database info...")
-    with database_info.open() as di:
-        for line in di:
-            pdb_id, pdb_path = line.strip().split()
-            database[pdb_id] = pdb_path
+    database = read_structure_list(database_info)
     total = len(database)
-
-    log.info(f"query = {query_element}")
     log.info(f"Total = {total}")
 
-    results = {}
-    results_queue = queue.Queue()
-
-    def gatherer_worker():
-        while True:
-            _, subject, output = results_queue.get()
-            if subject is None and output is None:
-                break
-            results[subject] = output
-            results_queue.task_done()
-
-    gatherer_thread = threading.Thread(target=gatherer_worker)
-    gatherer_thread.start()
-
-    with ProcessPoolExecutor(max_workers=num_cpu) as executor:
-        query_path = query[query_element]
-        futures = []
-        for i, (pdb_id, pdb_path) in enumerate(database.items(), start=1):
-            futures.append(
-                executor.submit(run_ska, query_element, query_path,
-                                pdb_id, pdb_path, skabin, env)
-            )
-            if i % batch_size == 0 or i == total:
-                log.info(f"submitted {i} jobs {i/total*100:.2f}%")
-        log.info("Gathering results in parallel...")
-        gathered = 0
-        for future in as_completed(futures):
-            results_queue.put(future.result())
-            gathered += 1
-            if gathered % batch_size == 0 or gathered == total:
-                log.info(f"gathered {gathered} jobs {gathered/total*100:.2f}%")
-    log.info("Submitting sentinel to queue...")
-    results_queue.put((None, None, None))
-    gatherer_thread.join()
-    log.info("Building result buffer")
-    result_buffer = io.StringIO()
-    log.info(f"len results = {len(results)}")
-    for key, output_str in results.items():
-        result_buffer.write(f"SKA: query={query_element}, subject={key}\n")
-        result_buffer.write(f"{output_str}\n")
-    log.info(f"Writing results to {outfile}")
-
-    with outfile.open("w") as of:
-        result_buffer.seek(0)
-        shutil.copyfileobj(result_buffer, of)
-    with donefile.open("w") as of:
-        of.write("FINISHED")
-    log.info("Done")
+    align_queries(pending, database, output_dir, submat, trolltop, skabin,
+                  batch_size, num_cpu, stream, backend, container,
+                  prefilter_psd, max_in_flight)
 
 
 def run_with_mapping(query_info: Path,
@@ -140,8 +525,15 @@ def run_with_mapping(query_info: Path,
                      skabin: str,
                      array_idx: int = 0,
                      batch_size: int = 1000,
-                     num_cpu: Optional[int] = None):
+                     num_cpu: Optional[int] = None,
+                     stream: bool = False,
+                     backend: str = "shell",
+                     container: Optional[str] = None,
+                     prefilter_psd: Optional[float] = None,
+                     max_in_flight: Optional[int] = None):
     env = {"TROLLTOP": trolltop, "SUBMAT": submat}
+    if max_in_flight is None:
+        max_in_flight = default_window(num_cpu)
 
     query_element = "not_found"
     with query_info.open() as qi:
@@ -155,16 +547,7 @@ def run_with_mapping(query_info: Path,
     log.info(f"query_list[{array_idx}] = {query_pdb_id}")
 
     log.info(f"Loading mapping file: {mapping_file}")
-    jobs = []
-    with mapping_file.open() as mf:
-        header = True
-        for line in mf:
-            if header:
-                header = False
-                continue
-            pdb_id, cmember = line.strip().split()
-            if pdb_id == query_pdb_id:
-                jobs.append(cmember)
+    jobs = read_mapping_members(mapping_file, query_pdb_id)
     log.info(f"Number of comparisons for {query_pdb_id}: {len(jobs)}")
 
     if query_element == "not_found":
@@ -189,55 +572,11 @@ def run_with_mapping(query_info: Path,
     log.info(f"Total = {total}")
     log.info(f"Total(jobs) = {len(jobs)}")
 
-    results = {}
-    results_queue = queue.Queue()
-
-    def gatherer_worker():
-        while True:
-            _, subject, output = results_queue.get()
-            if subject is None and output is None:
-                break
-            results[subject] = output
-            results_queue.task_done()
-
-    gatherer_thread = threading.Thread(target=gatherer_worker)
-    gatherer_thread.start()
-
-    with ProcessPoolExecutor(max_workers=num_cpu) as executor:
-        query_path = query_element
-        futures = []
-        for i, (pdb_id, pdb_path) in enumerate(database.items(), start=1):
-            futures.append(
-                executor.submit(run_ska, query_pdb_id, query_path,
-                                pdb_id, pdb_path, skabin, env)
-            )
-            if i % batch_size == 0 or i == total:
-                log.info(f"submitted {i} jobs {i/total*100:.2f}%")
-        log.info("Gathering results in parallel...")
-        gathered = 0
-        for future in as_completed(futures):
-            results_queue.put(future.result())
-            gathered += 1
-            if gathered % batch_size == 0 or gathered == total:
-                log.info(f"gathered {gathered} jobs {gathered/total*100:.2f}%")
-    log.info("Submitting sentinel to queue...")
-    results_queue.put((None, None, None))
-    gatherer_thread.join()
-    log.info("Building result buffer")
-    result_buffer = io.StringIO()
-    log.info(f"len results = {len(results)}")
-    for key, output_str in results.items():
-        log.info(f"{key, output_str}")
-        result_buffer.write(f"SKA: query={query_pdb_id}, subject={key}\n")
-        result_buffer.write(f"{output_str}\n")
-    log.info(f"Writing results to {outfile}")
-
-    with outfile.open("w") as of:
-        result_buffer.seek(0)
-        shutil.copyfileobj(result_buffer, of)
-    with donefile.open("w") as of:
-        of.write("FINISHED")
-    log.info("Done")
+    with _ska_executor(num_cpu, skabin, env, backend,
+                       container, prefilter_psd) as executor:
+        _align_query(query_pdb_id, query_element, database,
+                     outfile, donefile, batch_size, executor,
+                     max_in_flight, stream)
 
 # This is an earlier version that writes each result to a file, which may
 # result in a I/O bottleneck